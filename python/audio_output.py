@@ -0,0 +1,85 @@
+import numpy as np
+import os
+import queue
+import struct
+import threading
+from instrumentation import timed, currentScope
+
+
+def wavBytes(audio, sample_rate):
+    # Mono 32 bit float WAV, the same format AudioBuffer.save writes
+    data = np.asarray(audio, dtype='<f4').tobytes()
+    header = struct.pack('<4sI4s4sIHHIIHHH4sII4sI',
+                         b'RIFF', 50 + len(data), b'WAVE',
+                         b'fmt ', 18, 3, 1, sample_rate, sample_rate * 4, 4, 32, 0,
+                         b'fact', 4, len(data) // 4,
+                         b'data', len(data))
+    return header + data
+
+def writeWav(path, audio, sample_rate, scope=None):
+    # Whole file is built in memory and written with a single write. scope is
+    # the instrumentation scope to record under when called from another thread.
+    with timed('file_io.write_wav', scope=scope):
+        with open(path, 'wb') as f:
+            f.write(wavBytes(audio, sample_rate))
+
+
+class EstimateWriter():
+    """
+    Saves sound matching results for one model: {model}/{model}_prediction_{i}.wav
+    and, unless concat=False, {model}_concat/concat_{model}_prediction_{i}.wav
+    with the target followed by the estimate. The concatenation is built from
+    the audio already in memory. With background=True files are written on a
+    separate thread while matching carries on; close() waits for them.
+    """
+
+    def __init__(self, output_folder_eval, model_name, concat=True, background=True):
+        self.model_name = model_name
+        self.concat = concat
+        self.output_folder_pred = os.path.join(output_folder_eval, model_name)
+        self.output_folder_concat = os.path.join(output_folder_eval, '%s_concat' % model_name)
+        os.makedirs(self.output_folder_pred, exist_ok=True)
+        if concat:
+            os.makedirs(self.output_folder_concat, exist_ok=True)
+
+        self.error = None
+        self.queue = None
+        if background:
+            self.queue = queue.Queue(maxsize=64)
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def write(self, i, target, estimate):
+        # target and estimate are AudioBuffers
+        sample_rate = estimate.get_sample_rate()
+        est_path = os.path.join(self.output_folder_pred, '%s_prediction_%s.wav' % (self.model_name, i))
+        files = [(est_path, estimate.get_audio())]
+        if self.concat:
+            concat_path = os.path.join(self.output_folder_concat,
+                                       'concat_%s_prediction_%s.wav' % (self.model_name, i))
+            files.append((concat_path, np.concatenate([target.get_audio(), estimate.get_audio()])))
+
+        for path, audio in files:
+            if self.queue is not None:
+                # The target being matched now, not when the thread gets to it
+                self.queue.put((path, audio, sample_rate, currentScope()))
+            else:
+                writeWav(path, audio, sample_rate)
+
+    def close(self):
+        if self.queue is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.queue = None
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            try:
+                writeWav(*item)
+            except Exception as e:
+                self.error = e
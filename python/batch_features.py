@@ -0,0 +1,172 @@
+import spiegelib as spgl
+import spiegelib.core.utils as spgl_utils
+import numpy as np
+import librosa
+import inspect
+import joblib
+from functools import lru_cache
+from instrumentation import uninstrumentedType
+
+# Match whatever padding the installed librosa uses for centered frames, since
+# that is what spgl.features.MFCC/STFT (and so the saved scalers) were computed with
+PAD_MODE = inspect.signature(librosa.stft).parameters['pad_mode'].default
+
+MEL_BANDS = 128
+TOP_DB = 80.0
+AMIN = 1e-10
+
+
+@lru_cache(maxsize=None)
+def _window(frame_size):
+    return librosa.filters.get_window('hann', frame_size, fftbins=True)
+
+@lru_cache(maxsize=None)
+def _mfccBasis(frame_size, hop_size, num_mfccs, sample_rate):
+    # Mel filterbank and orthonormal DCT-II matrix, identical to what
+    # librosa.feature.mfcc builds on every call
+    mel_basis = librosa.filters.mel(sr=sample_rate, n_fft=frame_size, n_mels=MEL_BANDS)
+    n = np.arange(MEL_BANDS)
+    k = np.arange(num_mfccs)[:, np.newaxis]
+    dct = np.cos(np.pi * k * (2 * n + 1) / (2 * MEL_BANDS)) * np.sqrt(2.0 / MEL_BANDS)
+    dct[0] /= np.sqrt(2.0)
+    return mel_basis, dct
+
+def _audioBatch(audio):
+    # Accepts a (batch, samples) array or a list of AudioBuffers
+    if isinstance(audio, np.ndarray):
+        return np.atleast_2d(audio)
+    return np.stack([a.get_audio() if isinstance(a, spgl.AudioBuffer) else a for a in audio])
+
+def _sampleRate(audio, sample_rate):
+    if sample_rate is None and not isinstance(audio, np.ndarray) and isinstance(audio[0], spgl.AudioBuffer):
+        return audio[0].get_sample_rate()
+    if sample_rate is None:
+        raise ValueError("sample_rate is required when passing a raw audio array")
+    return sample_rate
+
+def batchSTFT(audio, frame_size, hop_size):
+    # Framed FFT of every row at once, returns (batch, frames, bins) complex
+    pad = frame_size // 2
+    padded = np.pad(audio, ((0, 0), (pad, pad)), mode=PAD_MODE)
+    frames = np.lib.stride_tricks.sliding_window_view(padded, frame_size, axis=-1)[:, ::hop_size]
+    return np.fft.rfft(frames * _window(frame_size), axis=-1)
+
+
+class BatchFeaturesBase():
+    """
+    Batched counterpart of spgl.features.FeaturesBase: prescale modifiers,
+    scaling and output modifiers are applied the same way, with the
+    modifiers run on each sound's features separately. Scalers are loaded
+    with joblib, like FeaturesBase.load_scaler.
+    """
+
+    def __init__(self, scale=False):
+        self.should_scale = scale
+        self.scaler = None
+        self.prescale_modifiers = []
+        self.output_modifiers = []
+
+    def has_scaler(self):
+        return self.scaler is not None
+
+    def set_scaler(self, scaler):
+        self.scaler = scaler
+
+    def load_scaler(self, path):
+        self.scaler = joblib.load(path)
+
+    def scale(self, data):
+        assert self.has_scaler(), "Scaler must be set first"
+        return self.scaler.transform(data)
+
+    def __call__(self, audio, sample_rate=None, scale=None):
+        features = self.get_features(_audioBatch(audio), _sampleRate(audio, sample_rate))
+        features = _modifyRows(features, self.prescale_modifiers)
+        if self.should_scale if scale is None else scale:
+            features = self.scale(features)
+        return _modifyRows(features, self.output_modifiers)
+
+
+def _modifyRows(features, modifiers):
+    for modifier in modifiers:
+        features = np.stack([modifier(row) for row in features])
+    return features
+
+
+class BatchMFCC(BatchFeaturesBase):
+    """
+    MFCCs for a whole batch of equal length sounds, matching
+    spgl.features.MFCC on each row.
+    """
+
+    def __init__(self, num_mfccs=20, frame_size=2048, hop_size=512, time_major=True, scale=False):
+        super().__init__(scale=scale)
+        self.num_mfccs = num_mfccs
+        self.frame_size = frame_size
+        self.hop_size = hop_size
+        self.time_major = time_major
+
+    def get_features(self, audio, sample_rate):
+        mel_basis, dct = _mfccBasis(self.frame_size, self.hop_size, self.num_mfccs, sample_rate)
+        power = np.abs(batchSTFT(audio, self.frame_size, self.hop_size)) ** 2
+        mel = power @ mel_basis.T
+
+        # power_to_db with ref=1.0 and top_db applied per sound
+        log_mel = 10.0 * np.log10(np.maximum(AMIN, mel))
+        peak = log_mel.max(axis=(1, 2), keepdims=True)
+        log_mel = np.maximum(log_mel, peak - TOP_DB)
+
+        mfccs = (log_mel @ dct.T).astype(audio.dtype)
+        return mfccs if self.time_major else np.swapaxes(mfccs, 1, 2)
+
+
+class BatchSTFT(BatchFeaturesBase):
+    """
+    STFT for a whole batch of equal length sounds, matching
+    spgl.features.STFT on each row.
+    """
+
+    def __init__(self, fft_size=1024, hop_size=512, output='complex', time_major=True, scale=False):
+        super().__init__(scale=scale)
+        if output not in spgl_utils.spectrum_types:
+            raise TypeError('output must be one of %s' % spgl_utils.spectrum_types)
+        self.frame_size = fft_size
+        self.hop_size = hop_size
+        self.output = output
+        self.time_major = time_major
+
+    def get_features(self, audio, sample_rate):
+        stft = spgl_utils.convert_spectrum(batchSTFT(audio, self.frame_size, self.hop_size), self.output)
+        return stft if self.time_major else np.swapaxes(stft, 1, 2)
+
+
+def batchFeaturesFor(features):
+    # Batched equivalent of a spiegelib MFCC/STFT extractor, with the same
+    # scaling, scaler and modifiers, or None if there isn't one. Input
+    # modifiers work on single AudioBuffers, so extractors with any are left
+    # to the per sound path.
+    if features.input_modifiers:
+        return None
+    features_type = uninstrumentedType(features)
+    if features_type == spgl.features.MFCC:
+        batch_features = BatchMFCC(num_mfccs=features.num_mfccs, frame_size=features.frame_size,
+                                   hop_size=features.hop_size, time_major=features.time_major)
+    elif features_type == spgl.features.STFT:
+        batch_features = BatchSTFT(fft_size=features.frame_size, hop_size=features.hop_size,
+                                   output=features.output, time_major=features.time_major)
+    else:
+        return None
+    batch_features.should_scale = features.should_scale
+    batch_features.scaler = features.scaler
+    batch_features.prescale_modifiers = list(features.prescale_modifiers)
+    batch_features.output_modifiers = list(features.output_modifiers)
+    return batch_features
+
+def extractBatch(features, audio, sample_rate, scale=None):
+    # Features for a (batch, samples) array with any spiegelib extractor, using
+    # the batched path when there is one. scale overrides the extractor's
+    # should_scale, as in FeaturesBase.__call__.
+    batch_features = batchFeaturesFor(features)
+    if batch_features is not None:
+        return batch_features(audio, sample_rate, scale=scale)
+    return np.stack([features(spgl.AudioBuffer(a, sample_rate), scale=scale) for a in audio])
@@ -0,0 +1,124 @@
+import spiegelib as spgl
+import numpy as np
+import multiprocessing
+import os
+from synth_config import loadSynth, renderPatches
+from batch_features import batchFeaturesFor
+from render_cache import renderCacheConfig, setRenderCacheConfig
+from instrumentation import (timed, uninstrumentedType, instrumentationConfig, initWorkerInstrumentation,
+                             workerInstrumentation, mergeWorkerInstrumentation)
+from lite_inference import LiteModel, liteModelPath
+
+# Saved model file for each deep learning estimator and whether it takes
+# flattened MFCC frames (the MLP) or the time series (LSTM, Bi-LSTM)
+MODEL_FILES = {
+    'mlp': 'simple_fm_mlp.h5',
+    'lstm': 'simple_fm_lstm.h5',
+    'bi_lstm': 'simple_fm_bi_lstm.h5',
+}
+FLATTENED_INPUT = ['mlp']
+
+class LiteEstimator(spgl.estimator.EstimatorBase):
+    """
+    A LiteModel as a spiegelib estimator, so a TFLite export can be passed to
+    SoundMatch like the Keras model it was made from.
+    """
+
+    def __init__(self, path, num_threads=None):
+        super().__init__()
+        self.model = LiteModel(path, num_threads=num_threads)
+
+    def predict(self, features):
+        return self.model.predict(features)
+
+
+def loadModel(model_folder, name, precision=None):
+    # The saved Keras model, or with a precision its TFLite export (see
+    # exportLiteModel), which loads without building the Keras graph
+    model_path = os.path.join(model_folder, MODEL_FILES[name])
+    if precision is None:
+        return spgl.estimator.TFEstimatorBase.load(model_path)
+    return LiteEstimator(liteModelPath(model_path, precision))
+
+
+# Per-process synth for parallel rendering
+_worker = {}
+
+def _initRenderWorker(synth_path, synth_state, note_len, render_len, cache_config, instrument):
+    initWorkerInstrumentation(instrument)
+    setRenderCacheConfig(cache_config)
+    _worker['synth'] = loadSynth(synth_path, synth_state, note_len=note_len, render_len=render_len)
+
+def _renderChunk(patches):
+    return np.concatenate(list(renderPatches(_worker['synth'], patches))), workerInstrumentation()
+
+
+class BatchMatcher():
+    """
+    Sound matching for many targets at once with the deep learning estimators.
+    MFCCs are extracted and scaled for all targets in one go, shared by every
+    model, each model runs one batched forward pass and the predicted patches
+    are rendered together (optionally across a process pool).
+    """
+
+    def __init__(self, synth_path, synth_state, model_folder, models=['mlp', 'lstm', 'bi_lstm'], num_mfccs=13,
+                 hop_size=1024, note_len=1.0, render_len=1.0, num_workers=None, precision=None):
+        self.synth_path = synth_path
+        self.synth_state = synth_state
+        self.note_len = note_len
+        self.render_len = render_len
+        self.num_workers = num_workers
+        self.synth = loadSynth(synth_path, synth_state, note_len=note_len, render_len=render_len)
+
+        # Same extractor as runMLP/runLSTM/runBiLSTM, run on the whole batch
+        features = spgl.features.MFCC(num_mfccs=num_mfccs, time_major=True, hop_size=hop_size, scale=True)
+        features.load_scaler(os.path.join(model_folder, 'data_scaler.pkl'))
+        self.extractor = batchFeaturesFor(features)
+
+        self.models = {name: loadModel(model_folder, name, precision) for name in models}
+
+    def extract(self, targets):
+        audio = np.stack([target.get_audio() for target in targets])
+        with timed('features.%s' % uninstrumentedType(self.extractor).__name__, items=len(audio)):
+            return self.extractor(audio, targets[0].get_sample_rate())
+
+    def predict(self, features):
+        return {name: self.predict_model(name, features) for name in self.models}
+
+    def predict_model(self, name, features):
+        inputs = features.reshape(len(features), -1) if name in FLATTENED_INPUT else features
+        model = self.models[name]
+        with timed('%s.predict' % name, items=len(inputs)):
+            # TFEstimatorBase.predict only takes a single example, the Keras
+            # model underneath takes the whole batch
+            if isinstance(model, spgl.estimator.TFEstimatorBase):
+                prediction = model.model.predict(inputs, verbose=0)
+            else:
+                prediction = model.predict(inputs)
+        return np.clip(prediction, 0.0, 1.0)
+
+    def render(self, patches):
+        if not self.num_workers or self.num_workers < 2:
+            return np.concatenate(list(renderPatches(self.synth, patches)))
+
+        with multiprocessing.Pool(self.num_workers, initializer=_initRenderWorker,
+                                  initargs=(self.synth_path, self.synth_state, self.note_len,
+                                            self.render_len, renderCacheConfig(), instrumentationConfig())) as pool:
+            chunks = np.array_split(patches, min(len(patches), self.num_workers))
+            with timed('synth.render_pool', items=len(patches)):
+                results = pool.map(_renderChunk, chunks)
+            for _, recorded in results:
+                mergeWorkerInstrumentation(recorded)
+            return np.concatenate([audio for audio, _ in results])
+
+    def match(self, targets):
+        # Returns {model name: (predicted patches, list of rendered AudioBuffers)}
+        predictions = self.predict(self.extract(targets))
+
+        # Every model's predictions are rendered together in one pass
+        audio = self.render(np.concatenate(list(predictions.values())))
+        results = {}
+        for i, (name, patches) in enumerate(predictions.items()):
+            rendered = audio[i * len(targets):(i + 1) * len(targets)]
+            results[name] = (patches, [spgl.AudioBuffer(a, self.synth.sample_rate) for a in rendered])
+        return results
@@ -0,0 +1,223 @@
+import numpy as np
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+# Pipeline sizes. Training runs a fixed number of epochs over a fixed size
+# dataset so every run does the same number of steps.
+SIZES = {
+    'small': {'train_size': 200, 'test_size': 50, 'epochs': 1, 'eval_samples': 5, 'pop_size': 20, 'gen_size': 3},
+    'medium': {'train_size': 2000, 'test_size': 500, 'epochs': 2, 'eval_samples': 10, 'pop_size': 50, 'gen_size': 5},
+    'large': {'train_size': 10000, 'test_size': 2000, 'epochs': 3, 'eval_samples': 25, 'pop_size': 100, 'gen_size': 10},
+}
+
+# Same feature settings as main.py
+NOTE_LEN = 1.0
+RENDER_LEN = 1.0
+MFCCS = 13
+FRAME = 1024
+HOP = 512
+SYNTH_PATH = "simple_fm"
+
+DL_MODELS = ['mlp', 'lstm', 'bi_lstm']
+GA_MODELS = ['ga', 'nsga']
+
+# Stages in pipeline order, later stages use the output of earlier ones
+STAGES = ['generate_dataset', 'generate_dataset_parallel', 'train_mlp', 'train_lstm', 'train_bi_lstm',
+          'generate_eval', 'match_mlp', 'match_lstm', 'match_bi_lstm', 'match_ga', 'match_nsga', 'evaluate']
+
+
+def _runStage(stage, work_folder, size):
+    # Runs one stage and returns the number of samples it processed. Modules are
+    # imported per stage so stages that don't use TensorFlow don't pay for it
+    # in peak RSS.
+    from synth_config import configDexed
+    from dataset_generation import initMFCCFeatures, generateDataset, generateDatasetParallel, generateEval
+
+    config = SIZES[size]
+    synth_state = os.path.join(work_folder, "modified_param_space.json")
+    eval_folder = os.path.join(work_folder, "evaluation")
+    features = initMFCCFeatures(num_mfccs=MFCCS, frame_size=FRAME, hop_size=HOP)
+    if not os.path.exists(synth_state):
+        configDexed(SYNTH_PATH, synth_state)
+
+    match_args = dict(num_mfccs=MFCCS, hop_size=HOP, note_len=NOTE_LEN, render_len=RENDER_LEN, save_concat=False)
+    ga_args = dict(match_args, pop_size=config['pop_size'], gen_size=config['gen_size'])
+    dataset_size = config['train_size'] + config['test_size']
+
+    if stage == 'generate_dataset':
+        generateDataset(SYNTH_PATH, work_folder, synth_state, features, train_size=config['train_size'],
+                        test_size=config['test_size'], note_len=NOTE_LEN, render_len=RENDER_LEN)
+        return dataset_size
+    if stage == 'generate_dataset_parallel':
+        generateDatasetParallel(SYNTH_PATH, os.path.join(work_folder, 'parallel'), synth_state, features,
+                                train_size=config['train_size'], test_size=config['test_size'], note_len=NOTE_LEN,
+                                render_len=RENDER_LEN, num_workers=os.cpu_count())
+        return dataset_size
+    if stage.startswith('train_'):
+        from train_dl_models import trainMLP, trainLSTM, trainBiLSTM
+        trainer = {'train_mlp': trainMLP, 'train_lstm': trainLSTM, 'train_bi_lstm': trainBiLSTM}[stage]
+        trainer(work_folder, epochs=config['epochs'])
+        return config['train_size'] * config['epochs']
+    if stage == 'generate_eval':
+        generateEval(SYNTH_PATH, eval_folder, synth_state, features, num_samples=config['eval_samples'],
+                     note_len=NOTE_LEN, render_len=RENDER_LEN)
+        return config['eval_samples']
+    if stage in ('match_mlp', 'match_lstm', 'match_bi_lstm'):
+        from sound_match_dl import runMLP, runLSTM, runBiLSTM
+        matcher = {'match_mlp': runMLP, 'match_lstm': runLSTM, 'match_bi_lstm': runBiLSTM}[stage]
+        matcher(SYNTH_PATH, work_folder, eval_folder, synth_state, **match_args)
+        return config['eval_samples']
+    if stage in ('match_ga', 'match_nsga'):
+        from sound_match_genetic import runGeneticAlgBasic, runGeneticAlgNSGA
+        matcher = {'match_ga': runGeneticAlgBasic, 'match_nsga': runGeneticAlgNSGA}[stage]
+        matcher(SYNTH_PATH, work_folder, eval_folder, synth_state, **ga_args)
+        return config['eval_samples']
+    if stage == 'evaluate':
+        from evaluation import evaluate
+        evaluate(eval_folder, models=DL_MODELS + GA_MODELS)
+        return config['eval_samples'] * len(DL_MODELS + GA_MODELS)
+    raise ValueError("Unknown stage '%s'" % stage)
+
+def _peakRSS(who):
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(who).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def _stageProcess(stage, work_folder, size, results):
+    # Each stage runs in a fresh process so peak RSS belongs to that stage only
+    np.random.seed(0)
+    random.seed(0)
+    start = time.perf_counter()
+    samples = _runStage(stage, work_folder, size)
+    wall = time.perf_counter() - start
+    peak = max(_peakRSS(resource.RUSAGE_SELF), _peakRSS(resource.RUSAGE_CHILDREN))
+    results.put({
+        'wall_secs': wall,
+        'samples': samples,
+        'samples_per_sec': samples / wall,
+        'peak_rss_mb': peak / (1024.0 * 1024.0)
+    })
+
+def benchmarkStage(stage, work_folder, size):
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=_stageProcess, args=(stage, work_folder, size, results))
+    process.start()
+
+    # The result is read before joining: a child can't exit until what it put
+    # on the queue has been read, so joining first can deadlock
+    result = None
+    while result is None:
+        alive = process.is_alive()
+        try:
+            result = results.get(timeout=1.0)
+        except queue.Empty:
+            if not alive:
+                break
+    process.join()
+    if result is None or process.exitcode != 0:
+        raise RuntimeError("Benchmark stage '%s' failed with exit code %s" % (stage, process.exitcode))
+    return result
+
+def runBenchmarks(output_folder="./benchmarks", sizes=['small'], stages=STAGES):
+    # Runs the pipeline stages at each size against the built in FM synth and
+    # appends the results to {output_folder}/history.json
+    os.makedirs(output_folder, exist_ok=True)
+    run = {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'commit': _gitCommit(),
+        'cpu_count': os.cpu_count(),
+        'results': {}
+    }
+
+    for size in sizes:
+        # Start from scratch so resumable stages (dataset shards) redo their work
+        work_folder = os.path.join(output_folder, 'work', size)
+        shutil.rmtree(work_folder, ignore_errors=True)
+        os.makedirs(work_folder)
+        run['results'][size] = {}
+        for stage in stages:
+            print("Benchmarking %s (%s)" % (stage, size))
+            result = benchmarkStage(stage, work_folder, size)
+            print("  %.2fs, %.1f samples/sec, %.0f MB peak RSS" % (result['wall_secs'], result['samples_per_sec'],
+                                                                   result['peak_rss_mb']))
+            run['results'][size][stage] = result
+
+    history_path = os.path.join(output_folder, 'history.json')
+    history = []
+    if os.path.exists(history_path):
+        with open(history_path, 'r') as f:
+            history = json.load(f)
+    history.append(run)
+    with open(history_path, 'w') as f:
+        json.dump(history, f, indent=4)
+    return run
+
+def saveBaseline(run, output_folder="./benchmarks"):
+    # Results of a run become the baseline for the sizes and stages it covers
+    baseline_path = os.path.join(output_folder, 'baseline.json')
+    baseline = {}
+    if os.path.exists(baseline_path):
+        with open(baseline_path, 'r') as f:
+            baseline = json.load(f)
+    for size, stages in run['results'].items():
+        baseline.setdefault(size, {}).update(stages)
+    with open(baseline_path, 'w') as f:
+        json.dump(baseline, f, indent=4)
+
+def findRegressions(run, output_folder="./benchmarks", tolerance=0.15):
+    # Stages whose throughput dropped, or whose peak RSS grew, by more than
+    # tolerance compared to the stored baseline
+    baseline_path = os.path.join(output_folder, 'baseline.json')
+    if not os.path.exists(baseline_path):
+        return []
+    with open(baseline_path, 'r') as f:
+        baseline = json.load(f)
+
+    regressions = []
+    for size, stages in run['results'].items():
+        for stage, result in stages.items():
+            base = baseline.get(size, {}).get(stage)
+            if base is None:
+                continue
+            if result['samples_per_sec'] < base['samples_per_sec'] * (1.0 - tolerance):
+                regressions.append("%s (%s): %.1f samples/sec, baseline %.1f" % (
+                    stage, size, result['samples_per_sec'], base['samples_per_sec']))
+            if result['peak_rss_mb'] > base['peak_rss_mb'] * (1.0 + tolerance):
+                regressions.append("%s (%s): %.0f MB peak RSS, baseline %.0f MB" % (
+                    stage, size, result['peak_rss_mb'], base['peak_rss_mb']))
+    return regressions
+
+def _gitCommit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Pipeline stage benchmarks")
+    parser.add_argument('--output-folder', default='./benchmarks')
+    parser.add_argument('--sizes', nargs='+', default=['small'], choices=list(SIZES))
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES)
+    parser.add_argument('--tolerance', type=float, default=0.15)
+    parser.add_argument('--save-baseline', action='store_true')
+    args = parser.parse_args()
+
+    run = runBenchmarks(args.output_folder, sizes=args.sizes, stages=args.stages)
+    regressions = findRegressions(run, args.output_folder, tolerance=args.tolerance)
+    if args.save_baseline:
+        saveBaseline(run, args.output_folder)
+    for regression in regressions:
+        print("REGRESSION: %s" % regression)
+    sys.exit(1 if regressions else 0)
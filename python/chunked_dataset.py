@@ -0,0 +1,113 @@
+import numpy as np
+import json
+import os
+from instrumentation import timed
+
+
+def manifestPath(folder, file_prefix=""):
+    return os.path.join(folder, '%smanifest.json' % file_prefix)
+
+
+class ChunkedDatasetWriter():
+    """
+    Writes a dataset as a list of .npy chunks plus a small JSON manifest
+    (shapes, dtypes, scaler file, chunk list), so it never has to be held in
+    memory as a whole and can be memory-mapped back chunk by chunk.
+    """
+
+    def __init__(self, output_folder, file_prefix="", scaler=None):
+        self.output_folder = output_folder
+        self.file_prefix = file_prefix
+        self.chunk_folder = '%schunks' % file_prefix
+        self.manifest = {
+            'num_samples': 0,
+            'features_shape': None,
+            'features_dtype': None,
+            'patches_shape': None,
+            'patches_dtype': None,
+            'scaler': scaler,
+            'chunks': []
+        }
+        os.makedirs(os.path.join(output_folder, self.chunk_folder), exist_ok=True)
+
+    def append(self, features, patches):
+        if len(features) != len(patches):
+            raise ValueError("Chunk has %d feature rows but %d patches" % (len(features), len(patches)))
+
+        name = os.path.join(self.chunk_folder, 'chunk_%05d_' % len(self.manifest['chunks']))
+        with timed('file_io.write_chunk', items=len(features)):
+            np.save(os.path.join(self.output_folder, name + 'features.npy'), features)
+            np.save(os.path.join(self.output_folder, name + 'patches.npy'), patches)
+
+        self.manifest['num_samples'] += len(features)
+        self.manifest['features_shape'] = list(features.shape[1:])
+        self.manifest['features_dtype'] = str(features.dtype)
+        self.manifest['patches_shape'] = list(patches.shape[1:])
+        self.manifest['patches_dtype'] = str(patches.dtype)
+        self.manifest['chunks'].append({
+            'features': name + 'features.npy',
+            'patches': name + 'patches.npy',
+            'size': len(features)
+        })
+
+    def close(self):
+        # The manifest is written last, a dataset without one is incomplete
+        with open(manifestPath(self.output_folder, self.file_prefix), 'w') as f:
+            json.dump(self.manifest, f, indent=4)
+
+
+class ChunkedDataset():
+    """
+    Memory-mapped view of a dataset written by ChunkedDatasetWriter. A folder
+    with plain {prefix}features.npy/{prefix}patches.npy files from
+    DatasetGenerator is opened as a single chunk.
+    """
+
+    def __init__(self, folder, file_prefix=""):
+        path = manifestPath(folder, file_prefix)
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self.manifest = json.load(f)
+            chunks = self.manifest['chunks']
+        else:
+            self.manifest = None
+            chunks = [{'features': '%sfeatures.npy' % file_prefix, 'patches': '%spatches.npy' % file_prefix}]
+
+        self.features = [np.load(os.path.join(folder, c['features']), mmap_mode='r') for c in chunks]
+        self.patches = [np.load(os.path.join(folder, c['patches']), mmap_mode='r') for c in chunks]
+        self.num_samples = sum(len(f) for f in self.features)
+        self.features_shape = self.features[0].shape[1:]
+        self.features_dtype = self.features[0].dtype
+        self.patches_dtype = self.patches[0].dtype
+        self.num_params = self.patches[0].shape[-1]
+
+    def __len__(self):
+        return self.num_samples
+
+    def batches(self, batch_size=64, shuffle=True, seed=None):
+        # One pass over the data in (features, patches) batches. With shuffle the
+        # chunk order and the order within each chunk are randomized, which
+        # keeps reads local to one mapped chunk at a time.
+        rng = np.random.default_rng(seed)
+        order = rng.permutation(len(self.features)) if shuffle else range(len(self.features))
+        leftover = None
+
+        for c in order:
+            indices = rng.permutation(len(self.features[c])) if shuffle else np.arange(len(self.features[c]))
+            for start in range(0, len(indices), batch_size):
+                # Sorted indices read the memory map in order
+                index = np.sort(indices[start:start + batch_size])
+                batch = (np.asarray(self.features[c][index]), np.asarray(self.patches[c][index]))
+
+                if leftover is not None:
+                    batch = (np.concatenate([leftover[0], batch[0]]), np.concatenate([leftover[1], batch[1]]))
+                    leftover = None
+                if len(batch[0]) < batch_size:
+                    leftover = batch
+                    continue
+                yield batch[0][:batch_size], batch[1][:batch_size]
+                if len(batch[0]) > batch_size:
+                    leftover = (batch[0][batch_size:], batch[1][batch_size:])
+
+        if leftover is not None:
+            yield leftover
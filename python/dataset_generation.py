@@ -1,4 +1,15 @@
 import spiegelib as spgl
+import numpy as np
+import os
+import json
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from synth_config import loadSynth, renderPatches
+from batch_features import extractBatch
+from chunked_dataset import ChunkedDatasetWriter
+from render_cache import renderCacheConfig, setRenderCacheConfig
+from instrumentation import (instrumentedStage, instrumentedFeatures, timed, uninstrumentedType,
+                             instrumentationConfig, initWorkerInstrumentation, workerInstrumentation,
+                             mergeWorkerInstrumentation)
 
 def initMFCCFeatures(num_mfccs=13, frame_size=2048, hop_size=1024):
     return spgl.features.MFCC(num_mfccs=num_mfccs, frame_size=frame_size, hop_size=hop_size, time_major=True)
@@ -6,11 +17,11 @@ def initMFCCFeatures(num_mfccs=13, frame_size=2048, hop_size=1024):
 def initSTFTFeatures(fft_size=2048, hop_size=1024):
     return spgl.features.STFT(fft_size=fft_size, hop_size=hop_size, output='magnitude', time_major=True)
 
+@instrumentedStage
 def generateDataset(synth_path, output_folder, synth_state, features, train_size=10000, test_size=1000, note_len=1.0, render_len=1.0):
-    synth = spgl.synth.SynthVST(synth_path, note_length_secs=note_len, render_length_secs=render_len)
-    synth.load_state(synth_state)
+    synth = loadSynth(synth_path, synth_state, note_len=note_len, render_len=render_len)
 
-    generator = spgl.DatasetGenerator(synth, features,
+    generator = spgl.DatasetGenerator(synth, instrumentedFeatures(features),
                                   output_folder=output_folder,
                                   scale=True)
 
@@ -18,12 +29,186 @@ def generateDataset(synth_path, output_folder, synth_state, features, train_size
     generator.generate(test_size, file_prefix="test_")
     generator.save_scaler('data_scaler.pkl')
 
+@instrumentedStage
 def generateEval(synth_path, output_folder, synth_state, features, num_samples=25, note_len=1.0, render_len=1.0):
-    synth = spgl.synth.SynthVST(synth_path, note_length_secs=note_len, render_length_secs=render_len)
-    synth.load_state(synth_state)
+    synth = loadSynth(synth_path, synth_state, note_len=note_len, render_len=render_len)
 
-    eval_generator = spgl.DatasetGenerator(synth, features,
+    eval_generator = spgl.DatasetGenerator(synth, instrumentedFeatures(features),
                                         output_folder=output_folder,
                                         save_audio=True)
     eval_generator.generate(num_samples)
 
+
+RENDER_BATCH_SIZE = 64
+
+# Training samples the scaler is fit on by default, so fitting it doesn't need
+# the whole training set in memory
+SCALER_FIT_SIZE = 10000
+
+# Per-process state for the parallel generator. Each worker loads its own synth
+# once and reuses it for every shard it is handed.
+_worker = {}
+
+def _initWorker(synth_path, synth_state, features, note_len, render_len, cache_config, instrument):
+    initWorkerInstrumentation(instrument)
+    setRenderCacheConfig(cache_config)
+    _worker['synth'] = loadSynth(synth_path, synth_state, note_len=note_len, render_len=render_len)
+    _worker['features'] = features
+
+def _generateShard(shard_prefix, num_samples, seed):
+    synth = _worker['synth']
+    features = _worker['features']
+
+    # Patches are drawn from a per-shard generator so every shard is reproducible
+    # no matter which worker renders it or in what order
+    rng = np.random.default_rng(seed)
+    patch_set = rng.uniform(0.0, 1.0, (num_samples, synth.param_space.num_free))
+
+    feature_set = _extractFeatures(synth, features, patch_set)
+
+    # Write to temp files first so a crash never leaves a half written shard behind
+    _saveAtomic(shard_prefix + 'features.npy', feature_set)
+    _saveAtomic(shard_prefix + 'patches.npy', patch_set)
+    return shard_prefix, workerInstrumentation()
+
+def _extractFeatures(synth, features, patch_set):
+    # Shards hold unscaled features, the scaler is applied when they are merged
+    feature_set = []
+    for block in renderPatches(synth, patch_set, batch_size=RENDER_BATCH_SIZE):
+        with timed('features.%s' % uninstrumentedType(features).__name__, items=len(block)):
+            feature_set.append(extractBatch(features, block, synth.sample_rate, scale=False))
+    return np.concatenate(feature_set)
+
+def _saveAtomic(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, data)
+    os.replace(tmp_path, path)
+
+def _planShards(shard_folder, file_prefix, size, shard_size, seed):
+    manifest_path = os.path.join(shard_folder, '%sshards.json' % file_prefix)
+    plan = {
+        'size': size,
+        'shard_size': shard_size,
+        'seed': seed,
+        'shards': []
+    }
+    for i, start in enumerate(range(0, size, shard_size)):
+        plan['shards'].append({
+            'prefix': '%sshard_%05d_' % (file_prefix, i),
+            'size': min(shard_size, size - start),
+            'seed': seed * 1000003 + i
+        })
+
+    # Resuming only makes sense if the shard layout is the same as last time
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            previous = json.load(f)
+        if previous != plan:
+            raise ValueError("Existing shards in %s were generated with a different size, shard_size "
+                             "or seed. Remove them or pass matching arguments to resume." % shard_folder)
+    else:
+        with open(manifest_path, 'w') as f:
+            json.dump(plan, f, indent=4)
+
+    return plan['shards']
+
+def _loadShards(shards, limit=None):
+    # Concatenates shards, or only enough of them to cover `limit` samples
+    features, patches, count = [], [], 0
+    for shard_features, shard_patches in shards:
+        if limit is not None and count >= limit:
+            break
+        features.append(np.load(shard_features, mmap_mode='r'))
+        patches.append(np.load(shard_patches, mmap_mode='r'))
+        count += len(features[-1])
+    return np.concatenate(features)[:limit], np.concatenate(patches)[:limit]
+
+def generateShards(synth_path, output_folder, synth_state, features, size, file_prefix="", num_workers=None,
+                   shard_size=1000, seed=0, note_len=1.0, render_len=1.0):
+    shard_folder = os.path.join(output_folder, 'shards')
+    os.makedirs(shard_folder, exist_ok=True)
+    shards = _planShards(shard_folder, file_prefix, size, shard_size, seed)
+
+    # Skip anything that was completed by a previous (possibly crashed) run
+    pending = [s for s in shards
+               if not (os.path.exists(os.path.join(shard_folder, s['prefix'] + 'features.npy')) and
+                       os.path.exists(os.path.join(shard_folder, s['prefix'] + 'patches.npy')))]
+    print("%s: %d/%d shards already complete" % (file_prefix or 'dataset', len(shards) - len(pending), len(shards)))
+
+    if pending:
+        with ProcessPoolExecutor(max_workers=num_workers or os.cpu_count(), initializer=_initWorker,
+                                 initargs=(synth_path, synth_state, features, note_len, render_len,
+                                           renderCacheConfig(), instrumentationConfig())) as pool:
+            futures = [pool.submit(_generateShard, os.path.join(shard_folder, s['prefix']), s['size'], s['seed'])
+                       for s in pending]
+            for done, future in enumerate(as_completed(futures), 1):
+                mergeWorkerInstrumentation(future.result()[1])
+                print("%s: finished shard %d/%d" % (file_prefix or 'dataset', done, len(pending)))
+
+    return [(os.path.join(shard_folder, s['prefix'] + 'features.npy'),
+             os.path.join(shard_folder, s['prefix'] + 'patches.npy')) for s in shards]
+
+def _writeMerged(output_folder, file_prefix, shards, features):
+    # Writes train_features.npy etc. through memory maps, one shard at a time
+    loaded = [(np.load(f, mmap_mode='r'), np.load(p, mmap_mode='r')) for f, p in shards]
+    size = sum(len(shard_features) for shard_features, _ in loaded)
+    first_features, first_patches = features.scale(np.asarray(loaded[0][0][:1])), loaded[0][1]
+    with timed('file_io.write_dataset', items=size):
+        feature_set = np.lib.format.open_memmap(os.path.join(output_folder, '%sfeatures.npy' % file_prefix),
+                                                mode='w+', dtype=first_features.dtype,
+                                                shape=(size,) + first_features.shape[1:])
+        patch_set = np.lib.format.open_memmap(os.path.join(output_folder, '%spatches.npy' % file_prefix),
+                                              mode='w+', dtype=first_patches.dtype,
+                                              shape=(size,) + first_patches.shape[1:])
+        start = 0
+        for shard_features, shard_patches in loaded:
+            feature_set[start:start + len(shard_features)] = features.scale(np.asarray(shard_features))
+            patch_set[start:start + len(shard_patches)] = shard_patches
+            start += len(shard_features)
+        feature_set.flush()
+        patch_set.flush()
+
+@instrumentedStage
+def generateDatasetParallel(synth_path, output_folder, synth_state, features, train_size=10000, test_size=1000,
+                            note_len=1.0, render_len=1.0, num_workers=None, shard_size=1000, seed=0,
+                            output_format='npy', scaler_fit_size=SCALER_FIT_SIZE, scaler_path=None):
+    # output_format='npy' writes train_features.npy etc. like DatasetGenerator,
+    # 'chunked' writes memory-mappable chunks with a manifest (see ChunkedDataset)
+    # so the full dataset never has to fit in memory. scaler_fit_size limits how
+    # many training samples the scaler is fit on (None fits it on all of them).
+    # scaler_path reuses an existing
+    # data_scaler.pkl instead, so the new dataset is on the same scale as an
+    # earlier one (e.g. to add it to that run's PatchIndex).
+    if output_format not in ('npy', 'chunked'):
+        raise ValueError("Unknown output_format '%s'" % output_format)
+
+    os.makedirs(output_folder, exist_ok=True)
+    with timed('generate_shards', items=train_size + test_size):
+        splits = [
+            ("train_", generateShards(synth_path, output_folder, synth_state, features, train_size,
+                                      file_prefix="train_", num_workers=num_workers, shard_size=shard_size,
+                                      seed=seed, note_len=note_len, render_len=render_len)),
+            ("test_", generateShards(synth_path, output_folder, synth_state, features, test_size,
+                                     file_prefix="test_", num_workers=num_workers, shard_size=shard_size,
+                                     seed=seed + 1, note_len=note_len, render_len=render_len))
+        ]
+
+    # Same as DatasetGenerator with scale=True: the scaler is fit on the
+    # training set only and then applied to the test set
+    if scaler_path is not None:
+        features.load_scaler(scaler_path)
+    else:
+        with timed('fit_scaler'):
+            features.fit_scaler(_loadShards(splits[0][1], limit=scaler_fit_size)[0], transform=False)
+
+    for file_prefix, shards in splits:
+        if output_format == 'chunked':
+            writer = ChunkedDatasetWriter(output_folder, file_prefix, scaler='data_scaler.pkl')
+            for shard_features, shard_patches in shards:
+                writer.append(features.scale(np.load(shard_features)), np.load(shard_patches))
+            writer.close()
+        else:
+            _writeMerged(output_folder, file_prefix, shards, features)
+
+    features.save_scaler(os.path.join(output_folder, 'data_scaler.pkl'))
@@ -1,7 +1,15 @@
 import spiegelib as spgl
+from spiegelib.core.utils import NumpyNumberEncoder
 import numpy as np
 import os
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from batch_features import extractBatch
+from render_cache import extractorConfig
+from instrumentation import instrumentedStage, timed
 
+@instrumentedStage
 def evaluate(eval_folder, models=['mlp', 'lstm', 'bi_lstm', 'ga', 'nsga']):
     # Load the sound targets used for sound matching
     targets = spgl.AudioBuffer.load_folder(os.path.join(eval_folder, 'audio'))
@@ -11,6 +19,153 @@ def evaluate(eval_folder, models=['mlp', 'lstm', 'bi_lstm', 'ga', 'nsga']):
 
     # Evaluate the results and save to JSON file
     evaluation = spgl.evaluation.MFCCEval(targets, estimations)
+    with timed('mfcc_eval', items=len(targets) * len(models)):
+        evaluation.evaluate()
+    evaluation.save_stats_json(os.path.join(eval_folder, 'evaluation_stats.json'))
+    evaluation.save_scores_json(os.path.join(eval_folder, 'evaluation_scores.json'))
+
+
+
+# Distance metrics reported by spgl.evaluation.MFCCEval for each target/estimate
+# pair, under MFCCEval's key names. Each is computed for a whole model at once
+# over a (targets, values) array of estimate minus target features.
+METRICS = [
+    ('mean_abs_error', lambda diff: np.mean(np.abs(diff), axis=1)),
+    ('mean_squared_error', lambda diff: np.mean(np.square(diff), axis=1)),
+    ('euclidian_distance', lambda diff: np.linalg.norm(diff, axis=1)),
+    ('manhattan_distance', lambda diff: np.sum(np.abs(diff), axis=1)),
+]
+
+def _mfccFeatures(audio, sample_rate, mfcc_kwargs):
+    return list(extractBatch(spgl.features.MFCC(**mfcc_kwargs), np.stack(audio), sample_rate))
+
+def _fileHash(audio, config):
+    # Content hash of an AudioBuffer together with the MFCC settings
+    h = hashlib.sha1(config.encode())
+    h.update(np.ascontiguousarray(audio.get_audio()).tobytes())
+    h.update(str(audio.get_sample_rate()).encode())
+    return h.hexdigest()
+
+def _cacheFeatures(buffers, paths, mfcc_kwargs, num_workers, pool):
+    # Extracts MFCCs for the buffers whose cache file doesn't exist yet. Audio of
+    # the same length and sample rate is batched, and batches are spread across
+    # the pool when there is one.
+    groups = {}
+    for buffer, path in zip(buffers, paths):
+        if not os.path.exists(path):
+            key = (len(buffer.get_audio()), buffer.get_sample_rate())
+            groups.setdefault(key, {})[path] = buffer
+    if not groups:
+        return
+
+    jobs = []
+    for (_, sample_rate), group in groups.items():
+        group_paths = list(group)
+        for chunk in np.array_split(np.arange(len(group_paths)), min(len(group_paths), max(1, (num_workers or 1) * 2))):
+            jobs.append(([group_paths[i] for i in chunk], [group[group_paths[i]].get_audio() for i in chunk], sample_rate))
+
+    if pool is not None:
+        results = list(pool.map(_mfccFeatures, [j[1] for j in jobs], [j[2] for j in jobs],
+                                [mfcc_kwargs] * len(jobs)))
+    else:
+        results = [_mfccFeatures(j[1], j[2], mfcc_kwargs) for j in jobs]
+
+    for (job_paths, _, _), features in zip(jobs, results):
+        for path, feature in zip(job_paths, features):
+            np.save(path, feature)
+
+def _scoreModel(target_paths, estimate_paths):
+    # Scores of one model for every target, as MFCCEval.evaluate_target computes
+    # them. Pairs are stacked by feature shape, so each metric is one NumPy
+    # operation per shape rather than one call per target.
+    pairs = {}
+    for i, (target_path, estimate_path) in enumerate(zip(target_paths, estimate_paths)):
+        target, estimate = np.load(target_path), np.load(estimate_path)
+        pairs.setdefault((target.shape, estimate.shape), []).append((i, target, estimate))
+
+    scores = [None] * len(target_paths)
+    for group in pairs.values():
+        diff = (np.stack([t for _, t, _ in group]).astype(np.float64) -
+                np.stack([e for _, _, e in group])).reshape(len(group), -1)
+        values = {name: metric(diff) for name, metric in METRICS}
+        for row, (i, _, _) in enumerate(group):
+            scores[i] = {name: float(values[name][row]) for name in values}
+    return scores
+
+
+class CachedScoresEval(spgl.evaluation.EvaluationBase):
+    """
+    Evaluation over scores that were already computed, so the scores and
+    stats files come out of spiegelib's own EvaluationBase code exactly as
+    MFCCEval writes them. model_scores maps each model to its list of score
+    dicts, one per target.
+    """
+
+    def __init__(self, model_scores, models):
+        self.model_scores = model_scores
+        num_targets = len(model_scores[models[0]])
+        super().__init__(list(range(num_targets)), [[model] * num_targets for model in models])
+
+    def evaluate_target(self, target, predictions):
+        return [self.model_scores[model][target] for model in predictions]
+
+
+@instrumentedStage
+def evaluateIncremental(eval_folder, models=['mlp', 'lstm', 'bi_lstm', 'ga', 'nsga'], num_workers=None, **mfcc_kwargs):
+    # Writes the same evaluation_stats.json/evaluation_scores.json as evaluate.
+    # MFCCs are cached per file by content hash in evaluation_cache/features and
+    # each model's scores are stored with a fingerprint of its inputs, so after
+    # re-running one estimator only that model is extracted and scored again.
+    cache_folder = os.path.join(eval_folder, 'evaluation_cache')
+    feature_folder = os.path.join(cache_folder, 'features')
+    os.makedirs(feature_folder, exist_ok=True)
+    config = extractorConfig(spgl.features.MFCC(**mfcc_kwargs))
+    metric_names = [name for name, _ in METRICS]
+
+    targets = spgl.AudioBuffer.load_folder(os.path.join(eval_folder, 'audio'))
+    target_hashes = [_fileHash(t, config) for t in targets]
+    estimations = {}
+    estimate_hashes = {}
+    model_scores = {}
+    for model_name in models:
+        estimations[model_name] = spgl.AudioBuffer.load_folder(os.path.join(eval_folder, model_name))
+        estimate_hashes[model_name] = [_fileHash(e, config) for e in estimations[model_name]]
+        score_path = os.path.join(cache_folder, 'scores_%s.json' % model_name)
+        if os.path.exists(score_path):
+            with open(score_path, 'r') as f:
+                cached = json.load(f)
+            if cached['inputs'] == [metric_names, target_hashes, estimate_hashes[model_name]]:
+                model_scores[model_name] = cached['scores']
+
+    # Features for the targets and every model that needs scoring in one pass,
+    # then one scoring job per model, both spread across the same pool
+    to_score = [m for m in models if m not in model_scores]
+    buffers = list(targets) + [e for m in to_score for e in estimations[m]]
+    hashes = target_hashes + [h for m in to_score for h in estimate_hashes[m]]
+    path = lambda h: os.path.join(feature_folder, '%s.npy' % h)
+    pool = ProcessPoolExecutor(max_workers=num_workers) if num_workers and num_workers > 1 else None
+    try:
+        with timed('features.MFCC', items=len(buffers)):
+            _cacheFeatures(buffers, [path(h) for h in hashes], mfcc_kwargs, num_workers, pool)
+
+        jobs = [([path(h) for h in target_hashes], [path(h) for h in estimate_hashes[m]]) for m in to_score]
+        with timed('score', items=len(targets) * len(to_score)):
+            if pool is not None:
+                results = list(pool.map(_scoreModel, [j[0] for j in jobs], [j[1] for j in jobs]))
+            else:
+                results = [_scoreModel(*j) for j in jobs]
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    for model_name, scores in zip(to_score, results):
+        print("Scoring %s" % model_name)
+        with open(os.path.join(cache_folder, 'scores_%s.json' % model_name), 'w') as f:
+            json.dump({'inputs': [metric_names, target_hashes, estimate_hashes[model_name]], 'scores': scores}, f,
+                      cls=NumpyNumberEncoder)
+        model_scores[model_name] = scores
+
+    evaluation = CachedScoresEval(model_scores, models)
     evaluation.evaluate()
     evaluation.save_stats_json(os.path.join(eval_folder, 'evaluation_stats.json'))
     evaluation.save_scores_json(os.path.join(eval_folder, 'evaluation_scores.json'))
@@ -0,0 +1,219 @@
+import spiegelib as spgl
+import numpy as np
+import numbers
+import time
+from param_space import ParamSpace, loadParamSpace
+
+# Name to pass as synth_path to use the built in NumPy synth instead of a VST
+SIMPLE_FM_SYNTH = "simple_fm"
+
+NUM_PARAMETERS = 155
+
+# Parameter indices in the Dexed layout that this synth reads. Everything else
+# is accepted and stored (so Dexed states load unchanged) but does not affect
+# the sound, which matches the parameters configDexed leaves fixed.
+OP1 = {'rates': [23, 24, 25, 26], 'levels': [27, 28, 29, 30], 'output': 31,
+       'coarse': 33, 'fine': 34, 'detune': 35}
+OP2 = {'rates': [45, 46, 47, 48], 'levels': [49, 50, 51, 52], 'output': 53,
+       'coarse': 55, 'fine': 56, 'detune': 57}
+
+# Peak modulation index (radians) of operator 2 at full output level
+MAX_MOD_INDEX = 4.0 * np.pi
+
+# Approximate DX7 scaling: one level step is 0.75dB, rate 99 is close to
+# instant and each 6 rate steps halves the time of an envelope segment
+DB_PER_LEVEL_STEP = 0.75
+SLOWEST_SEGMENT_SECS = 38.0
+DETUNE_CENTS_PER_STEP = 1.5
+
+
+class SimpleFMSynth(spgl.synth.SynthBase):
+    """
+    Two operator FM synth (operator 2 modulating operator 1) with the same
+    155 parameter layout and state files as Dexed. Parameter values are kept
+    in a NumPy array, and whole batches of patches are rendered in one
+    vectorized call with render_batch.
+    """
+
+    def __init__(self, **kwargs):
+        # Set before SynthBase's constructor, which assigns overridden_params and patch
+        self.values = np.zeros(NUM_PARAMETERS)
+        self.overridden = np.zeros(NUM_PARAMETERS, dtype=bool)
+        super().__init__(**kwargs)
+        self.parameters = {i: 'Param %d' % i for i in range(NUM_PARAMETERS)}
+        self.audio = None
+
+    # SynthBase's patch and overridden_params lists, as views of the arrays
+
+    @property
+    def patch(self):
+        return [(i, float(v)) for i, v in enumerate(self.values)]
+
+    @patch.setter
+    def patch(self, patch):
+        if patch:
+            indices, values = np.array(patch, dtype=np.float64).reshape(-1, 2).T
+            self.values[indices.astype(int)] = values
+
+    @property
+    def overridden_params(self):
+        return [(int(i), float(self.values[i])) for i in np.flatnonzero(self.overridden)]
+
+    @overridden_params.setter
+    def overridden_params(self, overridden_params):
+        self.overridden[:] = False
+        self.set_overridden_parameters(overridden_params or [])
+
+    def load_state(self, path):
+        # Goes through the compiled parameter space, see loadParamSpace
+        self.load_param_space(loadParamSpace(path))
+
+    def load_param_space(self, space):
+        self.values = space.values.copy()
+        self.overridden = space.overridden.copy()
+        self.parameters = dict(enumerate(space.descriptions))
+        self.rendered_patch = False
+
+    def to_param_space(self):
+        # Not param_space, loadSynth sets that attribute to the loaded state's space
+        return ParamSpace(self.values, self.overridden, [self.parameters[i] for i in range(NUM_PARAMETERS)])
+
+    def save_state(self, path):
+        self.to_param_space().save_state(path)
+
+    def set_overridden_parameters(self, parameters):
+        indices, values = np.array(parameters, dtype=np.float64).reshape(-1, 2).T
+        self.values[indices.astype(int)] = values
+        self.overridden[indices.astype(int)] = True
+        self.rendered_patch = False
+
+    def free_parameters(self):
+        return np.flatnonzero(~self.overridden)
+
+    def get_patch(self, skip_overridden=True):
+        indices = self.free_parameters() if skip_overridden else range(NUM_PARAMETERS)
+        return [(int(i), float(self.values[i])) for i in indices]
+
+    def set_patch(self, parameters):
+        # Same rules as SynthBase.set_patch: (index, value) pairs, or values for
+        # either the free parameters or all of them. Overridden parameters are
+        # left alone and values are clamped to param_range.
+        if len(parameters) == 0:
+            return
+        if isinstance(parameters[0], numbers.Number):
+            values = np.asarray(parameters, dtype=np.float64)
+            indices = self.free_parameters()
+            if len(values) == NUM_PARAMETERS and len(indices) != NUM_PARAMETERS:
+                values = values[indices]
+            elif len(values) != len(indices):
+                raise Exception("Unclear on how to map parameters, received %d parameters and there are %d "
+                                "non-overridden parameters and %d total parameters."
+                                % (len(values), len(indices), NUM_PARAMETERS))
+        else:
+            indices, values = np.array(parameters, dtype=np.float64).reshape(-1, 2).T
+            indices = indices.astype(int)
+            free = ~self.overridden[indices]
+            indices, values = indices[free], values[free]
+
+        if self.clamp_params:
+            values = np.clip(values, self.param_range[0], self.param_range[1])
+        self.values[indices] = values
+        self.rendered_patch = False
+        self.load_patch()
+
+    def load_patch(self):
+        # render_batch reads the values array directly, nothing to load
+        pass
+
+    def randomize_patch(self):
+        free = self.free_parameters()
+        self.values[free] = np.random.uniform(0.0, 1.0, len(free))
+        self.rendered_patch = False
+
+    def render_patch(self):
+        self.audio = self.render_batch(self.values[np.newaxis])[0]
+        self.rendered_patch = True
+
+    def get_audio(self):
+        if not self.rendered_patch:
+            raise Exception('Patch must be rendered before audio can be retrieved')
+        return spgl.AudioBuffer(self.audio, self.sample_rate)
+
+    def render_batch(self, patches):
+        # patches is (batch, free parameters) or (batch, 155). Overridden
+        # parameters always come from the loaded state.
+        patches = np.atleast_2d(np.asarray(patches, dtype=np.float64))
+        free = self.free_parameters()
+        full = np.empty((patches.shape[0], NUM_PARAMETERS))
+        full[:] = self.values
+        full[:, free] = patches[:, free] if patches.shape[1] == NUM_PARAMETERS else patches
+
+        num_samples = int(self.render_length_secs * self.sample_rate)
+        t = np.arange(num_samples)[np.newaxis] / self.sample_rate
+        base_freq = 440.0 * 2.0 ** ((self.midi_note - 69) / 12.0)
+
+        mod_env = _levelToAmp(full[:, [OP2['output']]]) * _envelope(full, OP2, t, self.note_length_secs)
+        car_env = _levelToAmp(full[:, [OP1['output']]]) * _envelope(full, OP1, t, self.note_length_secs)
+        mod_freq = base_freq * _frequencyRatio(full, OP2)
+        car_freq = base_freq * _frequencyRatio(full, OP1)
+
+        # Key sync is on in the Dexed config so both operators start at phase 0
+        modulator = MAX_MOD_INDEX * mod_env * np.sin(2.0 * np.pi * mod_freq * t)
+        audio = car_env * np.sin(2.0 * np.pi * car_freq * t + modulator)
+        return audio.astype(np.float32)
+
+
+def _levelToAmp(level):
+    steps = np.rint(level * 99.0)
+    return np.where(steps > 0, 10.0 ** ((steps - 99.0) * DB_PER_LEVEL_STEP / 20.0), 0.0)
+
+def _segmentSecs(rate, level_from, level_to):
+    full_range = SLOWEST_SEGMENT_SECS * 2.0 ** (-np.rint(rate * 99.0) / 6.0)
+    return np.maximum(full_range * np.abs(level_to - level_from), 1e-4)
+
+def _ramp(t, start, duration, level_from, level_to):
+    progress = np.clip((t - start) / duration, 0.0, 1.0)
+    return level_from + (level_to - level_from) * progress
+
+def _envelope(full, op, t, note_length):
+    # DX7 style 4 rate / 4 level envelope. Starts at L4, moves through L1 and L2,
+    # holds at L3 until note off, then releases to L4. Levels are interpolated
+    # linearly in level steps (ie. in dB) and converted to amplitude at the end.
+    r1, r2, r3, r4 = [full[:, [i]] for i in op['rates']]
+    l1, l2, l3, l4 = [full[:, [i]] for i in op['levels']]
+    d1 = _segmentSecs(r1, l4, l1)
+    d2 = _segmentSecs(r2, l1, l2)
+    d3 = _segmentSecs(r3, l2, l3)
+
+    def held(t):
+        return np.where(t < d1, _ramp(t, 0.0, d1, l4, l1),
+               np.where(t < d1 + d2, _ramp(t, d1, d2, l1, l2),
+                        _ramp(t, d1 + d2, d3, l2, l3)))
+
+    off_level = held(np.full_like(l1, note_length))
+    d4 = _segmentSecs(r4, off_level, l4)
+    level = np.where(t < note_length, held(t), _ramp(t, note_length, d4, off_level, l4))
+    return _levelToAmp(level)
+
+def _frequencyRatio(full, op):
+    coarse = np.rint(full[:, [op['coarse']]] * 31.0)
+    fine = np.rint(full[:, [op['fine']]] * 99.0)
+    detune = np.rint(full[:, [op['detune']]] * 14.0) - 7.0
+    ratio = np.where(coarse == 0, 0.5, coarse) * (1.0 + fine / 100.0)
+    return ratio * 2.0 ** (detune * DETUNE_CENTS_PER_STEP / 1200.0)
+
+
+def renderThroughput(synth, num_patches=1000, batch_size=100):
+    # Patches rendered per second. Uses render_batch when the synth has it,
+    # otherwise renders one patch at a time like the VST path does.
+    start = time.perf_counter()
+    if hasattr(synth, 'render_batch'):
+        num_free = len(synth.get_patch())
+        for i in range(0, num_patches, batch_size):
+            synth.render_batch(np.random.uniform(0.0, 1.0, (min(batch_size, num_patches - i), num_free)))
+    else:
+        for i in range(num_patches):
+            synth.randomize_patch()
+            synth.render_patch()
+            synth.get_audio()
+    return num_patches / (time.perf_counter() - start)
@@ -0,0 +1,338 @@
+import cProfile
+import functools
+import io
+import json
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+# Opt-in timers and counters for the pipeline. Until enableInstrumentation is
+# called every hook is a single check and objects are not wrapped at all. Only
+# the process that enabled it records. Pool workers record when their
+# initializer calls initWorkerInstrumentation and send their timers back with
+# each result (see workerInstrumentation and mergeWorkerInstrumentation).
+_state = None
+
+NO_STAGE = '(none)'
+
+
+class _Recorder():
+
+    def __init__(self, output_folder, profile):
+        self.output_folder = output_folder
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.stage = NO_STAGE
+        self.target = None
+        # (stage, target, name) -> [count, items, total secs, min secs, max secs]
+        self.timers = {}
+        # Same for time spent in pool workers, summed over all of them
+        self.worker_timers = {}
+        # (stage, target, name) -> value
+        self.counters = {}
+        # stage -> [runs, wall secs], (stage, target) -> wall secs
+        self.stages = {}
+        self.targets = {}
+        self.profiler = None
+        if profile:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def scope(self):
+        return (self.stage, self.target)
+
+    def record(self, name, secs, items=1, scope=None):
+        key = (scope or self.scope()) + (name,)
+        with self.lock:
+            timer = self.timers.get(key)
+            if timer is None:
+                self.timers[key] = [1, items, secs, secs, secs]
+            else:
+                timer[0] += 1
+                timer[1] += items
+                timer[2] += secs
+                timer[3] = min(timer[3], secs)
+                timer[4] = max(timer[4], secs)
+
+    def count(self, name, n, scope=None):
+        key = (scope or self.scope()) + (name,)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+
+def enableInstrumentation(output_folder, profile=False):
+    # Starts recording. With profile=True the whole run is also profiled with
+    # cProfile. Call writeInstrumentationReport at the end of the run.
+    global _state
+    _state = _Recorder(output_folder, profile)
+
+def _recorder():
+    if _state is not None and _state.pid == os.getpid():
+        return _state
+    return None
+
+def currentScope():
+    # The (stage, target) being recorded, for work handed to another thread to
+    # pass back to timed() so it is counted where it was queued
+    recorder = _recorder()
+    return None if recorder is None else recorder.scope()
+
+def timed(name, items=1, scope=None):
+    # Context manager that adds the time spent in its block to the `name` timer
+    # of the current stage and target, or of `scope` from currentScope
+    recorder = _recorder()
+    if recorder is None:
+        return nullcontext()
+    return _timed(recorder, name, items, scope)
+
+@contextmanager
+def _timed(recorder, name, items, scope):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        recorder.record(name, time.perf_counter() - start, items, scope)
+
+def record(name, secs, items=1):
+    # For times that were measured anyway (e.g. GA generations)
+    recorder = _recorder()
+    if recorder is not None:
+        recorder.record(name, secs, items)
+
+def count(name, n=1):
+    recorder = _recorder()
+    if recorder is not None:
+        recorder.count(name, n)
+
+def instrumentedStage(func):
+    # Decorator for pipeline stages, everything recorded while the function runs
+    # is grouped under its name
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        recorder = _recorder()
+        if recorder is None:
+            return func(*args, **kwargs)
+
+        previous = (recorder.stage, recorder.target)
+        recorder.stage, recorder.target = func.__name__, None
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            with recorder.lock:
+                runs = recorder.stages.setdefault(recorder.stage, [0, 0.0])
+                runs[0] += 1
+                runs[1] += elapsed
+            recorder.stage, recorder.target = previous
+    return wrapper
+
+def instrumentationConfig():
+    # Whether pool workers should record, for pool initializers to pass on to
+    # initWorkerInstrumentation
+    return _recorder() is not None
+
+def initWorkerInstrumentation(enabled):
+    # Called from a pool initializer before anything it wants timed is loaded
+    global _state
+    _state = _Recorder(None, False) if enabled else None
+
+def workerInstrumentation():
+    # Timers and counters recorded in this worker since the last call, to be
+    # returned along with a task's result
+    recorder = _recorder()
+    if recorder is None:
+        return None
+    with recorder.lock:
+        timers, counters = recorder.timers, recorder.counters
+        recorder.timers, recorder.counters = {}, {}
+    return {
+        'timers': {name: timer for (_, _, name), timer in timers.items()},
+        'counters': {name: value for (_, _, name), value in counters.items()}
+    }
+
+def mergeWorkerInstrumentation(recorded):
+    # Adds what workerInstrumentation returned to the worker timers of the
+    # current stage and target. Counters are added to the normal counters.
+    recorder = _recorder()
+    if recorder is None or recorded is None:
+        return
+    scope = recorder.scope()
+    with recorder.lock:
+        for name, timer in recorded['timers'].items():
+            key = scope + (name,)
+            recorder.worker_timers[key] = _merge(recorder.worker_timers.get(key), timer)
+    for name, value in recorded['counters'].items():
+        recorder.count(name, value)
+
+
+@contextmanager
+def instrumentationTarget(target):
+    # Groups everything recorded in the block under one sound matching target
+    recorder = _recorder()
+    if recorder is None:
+        yield
+        return
+
+    previous = recorder.target
+    recorder.target = target
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with recorder.lock:
+            key = (recorder.stage, str(target))
+            recorder.targets[key] = recorder.targets.get(key, 0.0) + elapsed
+        recorder.target = previous
+
+
+def _timedMethod(method, name, batched):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        items = len(args[0]) if batched and args else 1
+        with timed(name, items):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+@functools.lru_cache(maxsize=None)
+def _instrumentedClass(cls, name, methods, batched):
+    # Subclass of cls that times calls to the selected methods (and to the
+    # object itself for __call__). Methods in `batched` take a batch as their
+    # first argument and record its length as the item count.
+    namespace = {'_instrumented_base': cls}
+    for attr in methods + batched:
+        method = getattr(cls, attr, None)
+        if callable(method):
+            timer = name if attr == '__call__' else '%s.%s' % (name, attr)
+            namespace[attr] = _timedMethod(method, timer, attr in batched)
+    return type('Instrumented%s' % cls.__name__, (cls,), namespace)
+
+def uninstrumentedType(obj):
+    # The class obj had before it was instrumented
+    return type(obj).__dict__.get('_instrumented_base', type(obj))
+
+def instrumented(obj, name, methods=(), batched=()):
+    # Returns obj unchanged unless instrumentation is enabled in this process.
+    # Otherwise returns an instance of an instrumented subclass of obj's class
+    # that shares obj's attributes, so it passes the same isinstance checks
+    # and changes made through either object are seen by both.
+    if _recorder() is None:
+        return obj
+    cls = _instrumentedClass(uninstrumentedType(obj), name, tuple(methods), tuple(batched))
+    wrapped = object.__new__(cls)
+    wrapped.__dict__ = obj.__dict__
+    return wrapped
+
+def instrumentedSynth(synth):
+    return instrumented(synth, 'synth', methods=['render_patch'], batched=['render_batch'])
+
+def instrumentedFeatures(features, batched=False):
+    name = 'features.%s' % uninstrumentedType(features).__name__
+    return instrumented(features, name, methods=['get_features', 'fit_scaler'],
+                        batched=['__call__'] if batched else ())
+
+def instrumentedEstimator(estimator, name):
+    return instrumented(estimator, name, methods=['predict'])
+
+
+def _timerSummary(timers):
+    return {name: {
+        'count': t[0],
+        'items': t[1],
+        'total_secs': t[2],
+        'mean_ms': t[2] / t[0] * 1000.0,
+        'min_ms': t[3] * 1000.0,
+        'max_ms': t[4] * 1000.0
+    } for name, t in sorted(timers.items(), key=lambda item: -item[1][2])}
+
+def _merge(timers, timer):
+    if timers is None:
+        return list(timer)
+    return [timers[0] + timer[0], timers[1] + timer[1], timers[2] + timer[2],
+            min(timers[3], timer[3]), max(timers[4], timer[4])]
+
+def _targetEntry(entry, target):
+    return entry['targets'].setdefault(str(target), {'timers': {}, 'worker_timers': {}, 'counters': {}})
+
+def instrumentationReport():
+    # {stage: {wall_secs, runs, timers, worker_timers, counters, unaccounted_secs,
+    # targets: {...}}}. Timers are summed over targets at the stage level.
+    # unaccounted_secs is the wall time not covered by any timer (selection,
+    # Python overhead, ...). worker_timers is time spent in pool workers, summed
+    # over workers, so it overlaps the parent's timers and can exceed wall time.
+    recorder = _recorder()
+    if recorder is None:
+        return None
+
+    with recorder.lock:
+        timers = dict(recorder.timers)
+        worker_timers = dict(recorder.worker_timers)
+        counters = dict(recorder.counters)
+        stage_runs = dict(recorder.stages)
+        target_walls = dict(recorder.targets)
+
+    stages = {}
+    for stage in set([k[0] for k in timers] + [k[0] for k in worker_timers] + [k[0] for k in counters] +
+                     list(stage_runs)):
+        stages[stage] = {'timers': {}, 'worker_timers': {}, 'counters': {}, 'targets': {}}
+
+    for kind, recorded in (('timers', timers), ('worker_timers', worker_timers)):
+        for (stage, target, name), timer in recorded.items():
+            entry = stages[stage]
+            entry[kind][name] = _merge(entry[kind].get(name), timer)
+            if target is not None:
+                _targetEntry(entry, target)[kind][name] = timer
+    for (stage, target, name), value in counters.items():
+        entry = stages[stage]
+        entry['counters'][name] = entry['counters'].get(name, 0) + value
+        if target is not None:
+            _targetEntry(entry, target)['counters'][name] = value
+
+    for stage, entry in stages.items():
+        runs, wall = stage_runs.get(stage, [0, None])
+        entry['runs'] = runs
+        entry['wall_secs'] = wall
+        if wall is not None:
+            entry['unaccounted_secs'] = max(0.0, wall - sum(t[2] for t in entry['timers'].values()))
+        entry['timers'] = _timerSummary(entry['timers'])
+        entry['worker_timers'] = _timerSummary(entry['worker_timers'])
+
+        for target, target_entry in entry['targets'].items():
+            target_wall = target_walls.get((stage, target))
+            target_entry['wall_secs'] = target_wall
+            if target_wall is not None:
+                target_entry['unaccounted_secs'] = max(0.0, target_wall - sum(
+                    t[2] for t in target_entry['timers'].values()))
+            target_entry['timers'] = _timerSummary(target_entry['timers'])
+            target_entry['worker_timers'] = _timerSummary(target_entry['worker_timers'])
+
+    return stages
+
+def writeInstrumentationReport():
+    # Writes {output_folder}/instrumentation/report.json and, when profiling,
+    # profile.prof (loadable by pstats, snakeviz, flameprof or gprof2dot) plus
+    # a plain text summary of the top functions
+    recorder = _recorder()
+    if recorder is None:
+        return None
+
+    report_folder = os.path.join(recorder.output_folder, 'instrumentation')
+    os.makedirs(report_folder, exist_ok=True)
+    report_path = os.path.join(report_folder, 'report.json')
+    with open(report_path, 'w') as f:
+        json.dump(instrumentationReport(), f, indent=4)
+
+    if recorder.profiler is not None:
+        recorder.profiler.disable()
+        recorder.profiler.dump_stats(os.path.join(report_folder, 'profile.prof'))
+        summary = io.StringIO()
+        pstats.Stats(recorder.profiler, stream=summary).sort_stats('cumulative').print_stats(50)
+        with open(os.path.join(report_folder, 'profile.txt'), 'w') as f:
+            f.write(summary.getvalue())
+        recorder.profiler.enable()
+
+    print("Instrumentation report written to %s" % report_path)
+    return report_path
@@ -0,0 +1,131 @@
+import numpy as np
+import importlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+# Only NumPy and the LiteRT/TFLite runtime are imported here, so a process that
+# just needs predictions from an export starts without TensorFlow or spiegelib.
+# batch_matching.LiteEstimator wraps LiteModel as a spiegelib estimator.
+
+# Reduced precision exports written by exportLiteModel
+PRECISIONS = ('float32', 'float16', 'int8')
+
+
+def liteModelPath(model_path, precision):
+    # simple_fm_bi_lstm.h5 -> simple_fm_bi_lstm_float16.tflite
+    if precision not in PRECISIONS:
+        raise ValueError("Unknown precision '%s', expected one of %s" % (precision, ', '.join(PRECISIONS)))
+    return os.path.splitext(model_path)[0] + '_%s.tflite' % precision
+
+def _interpreterClass():
+    # The standalone LiteRT runtime, or the older tflite_runtime package
+    try:
+        from ai_edge_litert.interpreter import Interpreter
+    except ImportError:
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            raise ImportError("Running TFLite exports needs the LiteRT runtime (pip install ai-edge-litert) "
+                              "or tflite_runtime")
+    return Interpreter
+
+
+class LiteModel():
+    """
+    Runs a TFLite export of a trained estimator on the CPU. Takes one example
+    or a batch. Exports with a dynamic batch size are resized to each batch,
+    fixed size ones (the LSTMs) are run one exported batch at a time.
+    """
+
+    def __init__(self, path, num_threads=None):
+        self.path = path
+        self.interpreter = _interpreterClass()(model_path=path, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+        self.input_shape = tuple(self.input['shape'])
+        # The signature has -1 for dimensions that can be resized
+        self.fixed_batch = self.input.get('shape_signature', self.input['shape'])[0] > 0
+
+    def predict(self, features):
+        features = np.asarray(features, dtype=self.input['dtype'])
+        single = features.ndim == len(self.input_shape) - 1
+        if single:
+            features = features[np.newaxis]
+
+        if self.fixed_batch:
+            size = self.input_shape[0]
+            prediction = np.concatenate([self._invoke(features[start:start + size])
+                                         for start in range(0, len(features), size)])
+        else:
+            prediction = self._invoke(features)
+        return prediction[0] if single else prediction
+
+    def _invoke(self, batch):
+        num_rows = len(batch)
+        if self.fixed_batch and num_rows < self.input_shape[0]:
+            padding = np.zeros((self.input_shape[0] - num_rows,) + batch.shape[1:], dtype=batch.dtype)
+            batch = np.concatenate([batch, padding])
+        elif batch.shape != self.input_shape:
+            self.interpreter.resize_tensor_input(self.input['index'], batch.shape)
+            self.interpreter.allocate_tensors()
+            self.input_shape = batch.shape
+        self.interpreter.set_tensor(self.input['index'], batch)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.output['index'])[:num_rows].copy()
+
+
+def _peakRSSMB():
+    # VmHWM starts over when the process execs, while ru_maxrss can keep the
+    # high water mark of the parent it was forked from
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2.0 ** 20 if sys.platform == 'darwin' else peak / 1024.0
+
+def _measureLoad(module, loader, args, example):
+    start = time.perf_counter()
+    load = getattr(importlib.import_module(module), loader)
+    imported = time.perf_counter()
+    model = load(*args)
+    loaded = time.perf_counter()
+    # A single example, as SoundMatch predicts one target at a time
+    model.predict(example)
+    return {
+        'import_secs': imported - start,
+        'load_secs': loaded - imported,
+        'first_prediction_secs': time.perf_counter() - loaded,
+        'peak_rss_mb': _peakRSSMB()
+    }
+
+def measureLoad(module, loader, args, example, timeout=600):
+    # Start up cost of getting a first prediction from module.loader(*args),
+    # e.g. ('lite_inference', 'LiteModel', [path]) for an export or
+    # ('batch_matching', 'loadModel', [model_folder, name]) for the Keras
+    # model: importing the loader's module, loading and the first prediction.
+    # Measured by running this file in a new interpreter, so nothing the
+    # caller imported (or a multiprocessing child would re-import) is loaded.
+    with tempfile.TemporaryDirectory() as folder:
+        example_path = os.path.join(folder, 'example.npy')
+        np.save(example_path, example)
+        process = subprocess.run([sys.executable, os.path.abspath(__file__), module, loader, json.dumps(list(args)),
+                                  example_path], capture_output=True, text=True, timeout=timeout)
+    if process.returncode != 0:
+        raise RuntimeError("Loading with %s.%s failed with exit code %d:\n%s" % (module, loader, process.returncode,
+                                                                               process.stderr[-2000:]))
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    # Run by measureLoad: module loader args_json example.npy
+    print(json.dumps(_measureLoad(sys.argv[1], sys.argv[2], json.loads(sys.argv[3]), np.load(sys.argv[4]))))
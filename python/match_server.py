@@ -0,0 +1,246 @@
+import numpy as np
+import librosa
+import argparse
+import base64
+import io
+import json
+import queue
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from synth_config import renderPatches
+from batch_matching import BatchMatcher
+from audio_output import wavBytes
+
+
+class _MatchRequest():
+
+    def __init__(self, audio, model, render):
+        self.audio = audio
+        self.model = model
+        self.render = render
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class MatchService():
+    """
+    Keeps the synth, the deep learning models and the data scaler loaded and
+    answers match requests. Requests that arrive close together are collected
+    into micro-batches (up to max_batch_size, waiting at most max_wait_ms for
+    more) so features and predictions are computed once per batch. All model
+    and synth work happens on a single worker thread until close().
+    """
+
+    def __init__(self, synth_path, synth_state, model_folder, models=['mlp', 'lstm', 'bi_lstm'], num_mfccs=13,
+                 hop_size=1024, note_len=1.0, render_len=1.0, max_batch_size=32, max_wait_ms=5.0):
+        self.matcher = BatchMatcher(synth_path, synth_state, model_folder, models=models, num_mfccs=num_mfccs,
+                                    hop_size=hop_size, note_len=note_len, render_len=render_len)
+        self.synth = self.matcher.synth
+        self.param_ids = self.synth.param_space.free.tolist()
+        self.num_samples = int(render_len * self.synth.sample_rate)
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+
+        self.queue = queue.Queue()
+        self.closed = False
+        self.close_lock = threading.Lock()
+        self.latencies = deque(maxlen=10000)
+        self.batch_sizes = deque(maxlen=10000)
+        self.stats_lock = threading.Lock()
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def match(self, audio, model='bi_lstm', render=False):
+        # audio is a mono array at the synth sample rate. Blocks until the batch
+        # holding this request has been processed.
+        if model not in self.matcher.models:
+            raise ValueError("Unknown model '%s', serving %s" % (model, list(self.matcher.models)))
+
+        start = time.perf_counter()
+        request = _MatchRequest(self._fitLength(audio), model, render)
+        with self.close_lock:
+            if self.closed:
+                raise RuntimeError("The match service has been closed")
+            self.queue.put(request)
+        request.done.wait()
+        with self.stats_lock:
+            self.latencies.append(time.perf_counter() - start)
+
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def stats(self):
+        with self.stats_lock:
+            latencies = np.array(self.latencies) * 1000.0
+            batch_sizes = np.array(self.batch_sizes)
+        return {
+            'requests': len(latencies),
+            'p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+            'p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else None,
+            'queue_depth': self.queue.qsize(),
+            'batches': len(batch_sizes),
+            'mean_batch_size': float(batch_sizes.mean()) if len(batch_sizes) else None
+        }
+
+    def close(self):
+        # Answers every request queued so far, then stops the worker thread
+        with self.close_lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.queue.put(None)
+        self.worker.join()
+
+    def _fitLength(self, audio):
+        # Models expect exactly as many frames as the training renders had
+        audio = np.asarray(audio, dtype=np.float32)[:self.num_samples]
+        return np.pad(audio, (0, self.num_samples - len(audio)))
+
+    def _run(self):
+        # None in the queue is the close() marker, nothing is queued after it
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while batch[-1] is not None and len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                stopping = True
+                batch.pop()
+            if not batch:
+                continue
+
+            try:
+                self._process(batch)
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+            with self.stats_lock:
+                self.batch_sizes.append(len(batch))
+            for request in batch:
+                request.done.set()
+
+    def _process(self, batch):
+        features = self.matcher.extractor(np.stack([r.audio for r in batch]), self.synth.sample_rate)
+
+        for model in set(r.model for r in batch):
+            index = [i for i, r in enumerate(batch) if r.model == model]
+            patches = self.matcher.predict_model(model, features[index])
+            for i, patch in zip(index, patches):
+                batch[i].result = {
+                    'model': model,
+                    'patch': patch.tolist(),
+                    'parameters': [[p, float(v)] for p, v in zip(self.param_ids, patch)]
+                }
+
+        to_render = [r for r in batch if r.render]
+        if to_render:
+            patches = np.array([r.result['patch'] for r in to_render])
+            audio = np.concatenate(list(renderPatches(self.synth, patches)))
+            for request, a in zip(to_render, audio):
+                request.result['audio'] = base64.b64encode(wavBytes(a, self.synth.sample_rate)).decode('ascii')
+
+
+def _readAudio(body, content_type, query, sample_rate):
+    # WAV (or anything else librosa can read) is resampled to the synth rate.
+    # Raw PCM is little-endian float32 mono, at ?sample_rate= if it differs.
+    if content_type.startswith('application/octet-stream'):
+        audio = np.frombuffer(body, dtype='<f4')
+        source_rate = int(query.get('sample_rate', [sample_rate])[0])
+        if source_rate != sample_rate:
+            audio = librosa.resample(audio, orig_sr=source_rate, target_sr=sample_rate)
+        return audio
+    audio, _ = librosa.load(io.BytesIO(body), sr=sample_rate, mono=True)
+    return audio
+
+
+def makeHandler(service):
+
+    class MatchHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if urlparse(self.path).path == '/stats':
+                self._reply(200, service.stats())
+            else:
+                self._reply(404, {'error': 'Not found'})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path != '/match':
+                self._reply(404, {'error': 'Not found'})
+                return
+
+            query = parse_qs(url.query)
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            try:
+                audio = _readAudio(body, self.headers.get('Content-Type', ''), query, service.synth.sample_rate)
+                result = service.match(audio, model=query.get('model', ['bi_lstm'])[0],
+                                       render=query.get('render', ['0'])[0] in ('1', 'true'))
+            except ValueError as e:
+                self._reply(400, {'error': str(e)})
+                return
+            except Exception as e:
+                self._reply(500, {'error': str(e)})
+                return
+            self._reply(200, result)
+
+        def _reply(self, status, data):
+            body = json.dumps(data).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return MatchHandler
+
+
+def serveMatching(synth_path, synth_state, model_folder, host='127.0.0.1', port=8765, **kwargs):
+    # POST /match?model=bi_lstm&render=1 with a WAV body returns the predicted
+    # patch (and base64 WAV audio with render=1). GET /stats returns p50/p99
+    # latency, queue depth and batch sizes.
+    service = MatchService(synth_path, synth_state, model_folder, **kwargs)
+    server = ThreadingHTTPServer((host, port), makeHandler(service))
+    print("Serving sound matching on http://%s:%d" % (host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local sound matching server")
+    parser.add_argument('synth_path')
+    parser.add_argument('synth_state')
+    parser.add_argument('model_folder')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--models', nargs='+', default=['mlp', 'lstm', 'bi_lstm'])
+    parser.add_argument('--num-mfccs', type=int, default=13)
+    parser.add_argument('--hop-size', type=int, default=1024)
+    parser.add_argument('--note-len', type=float, default=1.0)
+    parser.add_argument('--render-len', type=float, default=1.0)
+    parser.add_argument('--max-batch-size', type=int, default=32)
+    parser.add_argument('--max-wait-ms', type=float, default=5.0)
+    args = parser.parse_args()
+
+    serveMatching(args.synth_path, args.synth_state, args.model_folder, host=args.host, port=args.port,
+                  models=args.models, num_mfccs=args.num_mfccs, hop_size=args.hop_size, note_len=args.note_len,
+                  render_len=args.render_len, max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms)
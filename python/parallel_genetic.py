@@ -0,0 +1,220 @@
+import spiegelib as spgl
+import numpy as np
+import multiprocessing
+import random
+import time
+import os
+from deap import base, creator, tools, algorithms
+from synth_config import loadSynth, renderPatches
+from batch_features import extractBatch
+from render_cache import CachedSynth, renderCacheConfig, setRenderCacheConfig
+from instrumentation import (record, count, timed, uninstrumentedType, instrumentationConfig,
+                             initWorkerInstrumentation, workerInstrumentation, mergeWorkerInstrumentation)
+
+
+def buildExtractors(objectives, num_mfccs=13, hop_size=1024):
+    # Same feature extractors runGeneticAlgBasic/runGeneticAlgNSGA use, by name
+    extractors = {
+        'mfcc': lambda: spgl.features.MFCC(num_mfccs=num_mfccs, hop_size=hop_size),
+        'spectral': lambda: spgl.features.SpectralSummarized(hop_size=hop_size),
+        'fft': lambda: spgl.features.FFT(output='magnitude'),
+    }
+    return [extractors[name]() for name in objectives]
+
+def scorePatches(synth, extractors, patches, targets):
+    # Renders every patch once and scores that render against each objective,
+    # returns (patches, objectives) mean absolute errors
+    if isinstance(synth, CachedSynth):
+        features = synth.features(extractors, patches)
+        return np.stack([_meanAbsError(f, target) for f, target in zip(features, targets)], axis=1)
+
+    errors = []
+    for block in renderPatches(synth, patches):
+        scores = []
+        for extractor, target in zip(extractors, targets):
+            with timed('features.%s' % uninstrumentedType(extractor).__name__, items=len(block)):
+                features = extractBatch(extractor, block, synth.sample_rate)
+            scores.append(_meanAbsError(features, target))
+        errors.append(np.stack(scores, axis=1))
+    return np.concatenate(errors)
+
+def _meanAbsError(features, target):
+    return np.mean(np.abs(features - target).reshape(len(features), -1), axis=1)
+
+
+# Per-process state for the evaluation pool, each worker keeps its own synth
+_worker = {}
+
+def _initWorker(synth_path, synth_state, note_len, render_len, objectives, num_mfccs, hop_size, cache_config,
+                instrument):
+    initWorkerInstrumentation(instrument)
+    setRenderCacheConfig(cache_config)
+    _worker['synth'] = loadSynth(synth_path, synth_state, note_len=note_len, render_len=render_len)
+    _worker['extractors'] = buildExtractors(objectives, num_mfccs=num_mfccs, hop_size=hop_size)
+
+def _evaluateChunk(patches, targets):
+    synth = _worker['synth']
+    errors = scorePatches(synth, _worker['extractors'], patches, targets)
+    stats = synth.cache.stats() if isinstance(synth, CachedSynth) else None
+    return errors, os.getpid(), stats, workerInstrumentation()
+
+def _individualClass(num_objectives):
+    name = 'ParallelIndividual%d' % num_objectives
+    if not hasattr(creator, name):
+        fitness = 'ParallelFitness%d' % num_objectives
+        creator.create(fitness, base.Fitness, weights=(-1.0,) * num_objectives)
+        creator.create(name, list, fitness=getattr(creator, fitness))
+    return getattr(creator, name)
+
+
+class ParallelGABase(spgl.estimator.EstimatorBase):
+    """
+    Genetic sound matching where each generation's population is rendered and
+    scored as a batch across a pool of worker processes. A spiegelib
+    estimator, so it can be used with SoundMatch and self.synth as the synth.
+    Subclasses register the mate, mutate and select operators.
+    """
+
+    def __init__(self, synth_path, synth_state, objectives, num_mfccs=13, hop_size=1024, note_len=1.0,
+                 render_len=1.0, pop_size=300, ngen=100, cxpb=0.5, mutpb=0.5, num_workers=None, seed=None):
+        super().__init__()
+        self.synth = loadSynth(synth_path, synth_state, note_len=note_len, render_len=render_len)
+        self.extractors = buildExtractors(objectives, num_mfccs=num_mfccs, hop_size=hop_size)
+        self.pop_size = pop_size
+        self.ngen = ngen
+        self.cxpb = cxpb
+        self.mutpb = mutpb
+        self.num_workers = num_workers or os.cpu_count()
+        self.generation_times = []
+        self.worker_cache_stats = {}
+        self.target = None
+        self.hof = None
+        self.renders = 0
+
+        # Same as the spiegelib GAs, seed=None seeds from the system time
+        random.seed(seed)
+
+        self.num_params = self.synth.param_space.num_free
+        self.toolbox = base.Toolbox()
+        self.toolbox.register('attr_float', random.random)
+        self.toolbox.register('individual', tools.initRepeat, _individualClass(len(objectives)),
+                              self.toolbox.attr_float, n=self.num_params)
+        self.toolbox.register('population', tools.initRepeat, list, self.toolbox.individual)
+
+        self.pool = multiprocessing.Pool(self.num_workers, initializer=_initWorker,
+                                         initargs=(synth_path, synth_state, note_len, render_len,
+                                                   objectives, num_mfccs, hop_size, renderCacheConfig(),
+                                                   instrumentationConfig()))
+
+    def evaluate_population(self, individuals):
+        if not individuals:
+            return
+        count('ga_evaluations', len(individuals))
+        self.renders += len(individuals)
+        # A couple of chunks per worker so a slow chunk doesn't stall the generation
+        chunks = np.array_split(np.array(individuals), min(len(individuals), self.num_workers * 2))
+        results = self.pool.starmap(_evaluateChunk, [(chunk, self.target) for chunk in chunks])
+        errors = np.concatenate([result[0] for result in results])
+        for _, pid, stats, recorded in results:
+            if stats is not None:
+                self.worker_cache_stats[pid] = stats
+            mergeWorkerInstrumentation(recorded)
+        for individual, error in zip(individuals, errors):
+            individual.fitness.values = tuple(error)
+
+    def predict(self, target):
+        self.target = [extractor(target) for extractor in self.extractors]
+        self.generation_times = []
+        self.hof = tools.HallOfFame(1)
+        self.renders = 0
+
+        start = time.perf_counter()
+        population = self.initial_population(target)
+        self.evaluate_population(population)
+        self._logGeneration(0, start, population)
+
+        for gen in range(1, self.ngen + 1):
+            start = time.perf_counter()
+            population = self.next_generation(population)
+            self._logGeneration(gen, start, population)
+
+        return list(self.best(population))
+
+    def initial_population(self, target):
+        return self.toolbox.population(n=self.pop_size)
+
+    def best(self, population):
+        # Same pick as NSGA3.predict: the first by (lexicographic) fitness, so
+        # for NSGA3 the closest MFCC match out of the trade-offs found
+        return tools.selBest(population, 1)[0]
+
+    def _logGeneration(self, gen, start, population):
+        elapsed = time.perf_counter() - start
+        self.generation_times.append(elapsed)
+        self.hof.update(population)
+        record('ga_generation', elapsed, items=self.pop_size)
+        best = self.hof[0].fitness.values
+        print("Generation %d: %.3fs, best %s" % (gen, elapsed, ', '.join('%.4f' % v for v in best)))
+
+    def cacheStats(self):
+        # Render cache hit/miss counts summed over all workers
+        totals = {'hits': 0, 'disk_hits': 0, 'misses': 0}
+        for stats in self.worker_cache_stats.values():
+            for key in totals:
+                totals[key] += stats[key]
+        return totals
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+class ParallelBasicGA(ParallelGABase):
+    """
+    spgl.estimator.BasicGA with parallel evaluation: the same operators,
+    probabilities and eaSimple generation loop, returning the best individual
+    ever evaluated (BasicGA's hall of fame).
+    """
+
+    def __init__(self, synth_path, synth_state, num_mfccs=13, hop_size=1024, **kwargs):
+        kwargs.setdefault('mutpb', 0.3)
+        super().__init__(synth_path, synth_state, ['mfcc'], num_mfccs=num_mfccs, hop_size=hop_size, **kwargs)
+        self.toolbox.register('mate', tools.cxTwoPoint)
+        self.toolbox.register('mutate', tools.mutFlipBit, indpb=0.05)
+        self.toolbox.register('select', tools.selTournament, tournsize=3)
+
+    def next_generation(self, population):
+        offspring = algorithms.varAnd(self.toolbox.select(population, len(population)), self.toolbox,
+                                      self.cxpb, self.mutpb)
+        self.evaluate_population([ind for ind in offspring if not ind.fitness.valid])
+        return offspring
+
+    def best(self, population):
+        return self.hof[0]
+
+
+class ParallelNSGA3(ParallelGABase):
+    """
+    spgl.estimator.NSGA3 with parallel evaluation, over MFCC,
+    SpectralSummarized and FFT magnitude error. Same operators, probabilities
+    and generation loop; all three objectives are computed from a single
+    render of each individual.
+    """
+
+    def __init__(self, synth_path, synth_state, num_mfccs=13, hop_size=1024, **kwargs):
+        super().__init__(synth_path, synth_state, ['mfcc', 'spectral', 'fft'], num_mfccs=num_mfccs,
+                         hop_size=hop_size, **kwargs)
+        registerNSGA3(self.toolbox, 3, self.num_params)
+
+    def next_generation(self, population):
+        offspring = algorithms.varAnd(population, self.toolbox, self.cxpb, self.mutpb)
+        self.evaluate_population([ind for ind in offspring if not ind.fitness.valid])
+        return self.toolbox.select(population + offspring, self.pop_size)
+
+
+def registerNSGA3(toolbox, num_objectives, num_params):
+    # spgl.estimator.NSGA3's operators
+    ref_points = tools.uniform_reference_points(num_objectives, 12)
+    toolbox.register('mate', tools.cxSimulatedBinaryBounded, low=0.0, up=1.0, eta=30.0)
+    toolbox.register('mutate', tools.mutPolynomialBounded, low=0.0, up=1.0, eta=20.0, indpb=1.0 / num_params)
+    toolbox.register('select', tools.selNSGA3, ref_points=ref_points)
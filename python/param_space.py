@@ -0,0 +1,134 @@
+import numpy as np
+import hashlib
+import json
+import os
+import struct
+import tempfile
+
+# Compiled file layout: header, float64 values, packed overridden bits, then
+# the descriptions as newline separated UTF-8
+MAGIC = b'PSPC'
+HEADER = struct.Struct('<4sII')
+
+
+class ParamSpace():
+    """
+    Compiled synth state: the value of every parameter, which ones are
+    overridden and the indices of the free ones, as NumPy arrays. Converts
+    between full and reduced (free parameter) patches and applies patches
+    without going through the per parameter JSON state.
+    """
+
+    def __init__(self, values, overridden, descriptions=None):
+        self.values = np.asarray(values, dtype=np.float64)
+        self.overridden = np.asarray(overridden, dtype=bool)
+        self.num_params = len(self.values)
+        self.descriptions = (list(descriptions) if descriptions is not None else
+                             ['Param %d' % i for i in range(self.num_params)])
+        self.free = np.flatnonzero(~self.overridden)
+        self.fixed = np.flatnonzero(self.overridden)
+        self.num_free = len(self.free)
+        self._free_ids = self.free.tolist()
+
+    @classmethod
+    def from_state(cls, path):
+        # Parses a state file written by save_state (spiegelib's JSON layout)
+        with open(path, 'r') as f:
+            state = json.load(f)
+        params = sorted(state.values(), key=lambda p: int(p['id']))
+        return cls([p['value'] for p in params], [p['overridden'] for p in params], [p['desc'] for p in params])
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        magic, num_params, text_size = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError("%s is not a compiled parameter space" % path)
+        offset = HEADER.size
+        values = np.frombuffer(data, dtype='<f8', count=num_params, offset=offset)
+        offset += 8 * num_params
+        bits = np.frombuffer(data, dtype=np.uint8, count=(num_params + 7) // 8, offset=offset)
+        offset += len(bits)
+        descriptions = data[offset:offset + text_size].decode('utf-8').split('\n')
+        return cls(values.copy(), np.unpackbits(bits)[:num_params], descriptions)
+
+    def save(self, path):
+        text = '\n'.join(self.descriptions).encode('utf-8')
+        with open(path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, self.num_params, len(text)))
+            f.write(self.values.astype('<f8').tobytes())
+            f.write(np.packbits(self.overridden).tobytes())
+            f.write(text)
+
+    def save_state(self, path):
+        state = {str(i): {'desc': self.descriptions[i], 'id': i, 'overridden': bool(self.overridden[i]),
+                          'value': float(self.values[i])} for i in range(self.num_params)}
+        with open(path, 'w') as f:
+            json.dump(state, f, indent=1)
+
+    def to_full(self, patches):
+        # (..., num_free) reduced patches to (..., num_params) full patches
+        patches = np.asarray(patches, dtype=np.float64)
+        full = np.empty(patches.shape[:-1] + (self.num_params,))
+        full[...] = self.values
+        full[..., self.free] = patches
+        return full
+
+    def to_reduced(self, patches):
+        # (..., num_params) full patches to (..., num_free) reduced patches
+        return np.asarray(patches)[..., self.free]
+
+    def apply(self, synth, patch):
+        # Sets a reduced or full patch on a synth. Synths with a value array
+        # (SimpleFMSynth) are set with one assignment, VSTs with one set_patch
+        # call (the host still sets their parameters one by one).
+        patch = np.asarray(patch, dtype=np.float64)
+        if len(patch) == self.num_params and self.num_free != self.num_params:
+            patch = patch[self.free]
+        values = getattr(synth, 'values', None)
+        if isinstance(values, np.ndarray):
+            values[self.free] = patch
+            synth.rendered_patch = False
+        else:
+            synth.set_patch(list(zip(self._free_ids, patch.tolist())))
+
+
+# Compiled files are named by a hash of the state file's contents and kept
+# here, never next to the state files (some of which are committed)
+CACHE_FOLDER = os.path.join(tempfile.gettempdir(), 'param_space_cache')
+
+# Spaces already loaded by this process, by state file and modification time
+_loaded = {}
+
+def compiledPath(synth_state, cache_folder=None):
+    with open(synth_state, 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    return os.path.join(cache_folder or CACHE_FOLDER, digest + '.pspace')
+
+def loadParamSpace(synth_state, cache_folder=None):
+    # ParamSpace for a JSON state file. The first call compiles it to a .pspace
+    # file in cache_folder (CACHE_FOLDER by default), later calls (and other
+    # processes) load that instead until the state file changes.
+    stat = os.stat(synth_state)
+    key = (os.path.abspath(synth_state), stat.st_mtime_ns, stat.st_size)
+    if key in _loaded:
+        return _loaded[key]
+
+    path = compiledPath(synth_state, cache_folder)
+    space = None
+    if os.path.exists(path):
+        try:
+            space = ParamSpace.load(path)
+        except (OSError, ValueError, struct.error):
+            space = None
+    if space is None:
+        space = ParamSpace.from_state(synth_state)
+        # Written under a per process name first since workers may compile at once
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        space.save(tmp_path)
+        os.replace(tmp_path, path)
+
+    _loaded[key] = space
+    return space
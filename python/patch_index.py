@@ -0,0 +1,251 @@
+import spiegelib as spgl
+import numpy as np
+import json
+import os
+import shutil
+from chunked_dataset import ChunkedDataset
+from synth_config import renderPatches
+from batch_features import BatchMFCC
+from instrumentation import timed
+
+INDEX_FILE = 'index.json'
+MODEL_FILE = 'projection.npz'
+
+
+def _nearest(data, centroids, batch_size=8192):
+    # Index of the closest centroid for every row
+    result = np.empty(len(data), dtype=np.int32)
+    centroid_norms = (centroids ** 2).sum(axis=1)
+    for start in range(0, len(data), batch_size):
+        block = data[start:start + batch_size]
+        distances = centroid_norms[np.newaxis, :] - 2.0 * block @ centroids.T
+        result[start:start + batch_size] = np.argmin(distances, axis=1)
+    return result
+
+def _kmeans(data, num_clusters, iterations=20, seed=0):
+    rng = np.random.default_rng(seed)
+    centroids = data[rng.choice(len(data), num_clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = _nearest(data, centroids)
+        for c in range(num_clusters):
+            members = data[assignments == c]
+            if len(members):
+                centroids[c] = members.mean(axis=0)
+    return centroids
+
+def _sampleFeatures(dataset, size, rng):
+    # Random rows of a ChunkedDataset without loading every chunk fully
+    sample = np.sort(rng.choice(len(dataset), min(size, len(dataset)), replace=False))
+    rows, start = [], 0
+    for chunk in dataset.features:
+        picked = sample[(sample >= start) & (sample < start + len(chunk))] - start
+        rows.append(np.asarray(chunk[picked], dtype=np.float32))
+        start += len(chunk)
+    return np.concatenate(rows).reshape(len(sample), -1)
+
+
+class PatchIndex():
+    """
+    Approximate nearest neighbour index from scaled MFCC features to the
+    patches that produced them. Features are flattened and projected onto
+    their first principal components, then bucketed into k-means cells; a
+    query only scans the n_probe cells closest to it. The projection and
+    cells stay fixed once built, so new data is appended as extra segment
+    files instead of rebuilding the index.
+    """
+
+    def __init__(self, index_folder):
+        self.index_folder = index_folder
+        with open(os.path.join(index_folder, INDEX_FILE), 'r') as f:
+            self.info = json.load(f)
+        model = np.load(os.path.join(index_folder, MODEL_FILE))
+        self.mean = model['mean']
+        self.components = model['components'] if 'components' in model else None
+        self.centroids = model['centroids']
+
+        segments = [np.load(os.path.join(index_folder, name)) for name in self.info['segments']]
+        dim = len(self.centroids[0])
+        self._setData(np.concatenate([s['vectors'] for s in segments] + [np.zeros((0, dim), np.float32)]),
+                      np.concatenate([s['patches'] for s in segments] +
+                                     [np.zeros((0, self.info['num_params']), np.float32)]),
+                      np.concatenate([s['cells'] for s in segments] + [np.zeros(0, np.int32)]))
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def _setData(self, vectors, patches, cells):
+        # Rows are kept sorted by cell so each cell is a contiguous slice
+        order = np.argsort(cells, kind='stable')
+        self.vectors = vectors[order]
+        self.patches = patches[order]
+        self.cells = cells[order]
+        self.offsets = np.searchsorted(self.cells, np.arange(len(self.centroids) + 1))
+
+    def project(self, features):
+        flat = np.asarray(features, dtype=np.float32).reshape(len(features), -1) - self.mean
+        return flat @ self.components.T if self.components is not None else flat
+
+    def add(self, features, patches):
+        # Appends (features, patches) as a new segment. Features have to be
+        # scaled with the index's data_scaler.pkl, see generateDatasetParallel's
+        # scaler_path.
+        vectors = self.project(features)
+        patches = np.asarray(patches, dtype=np.float32)
+        cells = _nearest(vectors, self.centroids)
+        name = 'segment_%05d.npz' % len(self.info['segments'])
+        with timed('file_io.write_index', items=len(vectors)):
+            np.savez(os.path.join(self.index_folder, name), vectors=vectors, patches=patches, cells=cells)
+
+        # index.json is written last, so an interrupted add leaves an unused file
+        self.info['segments'].append(name)
+        with open(os.path.join(self.index_folder, INDEX_FILE), 'w') as f:
+            json.dump(self.info, f, indent=4)
+        self._setData(np.concatenate([self.vectors, vectors]), np.concatenate([self.patches, patches]),
+                      np.concatenate([self.cells, cells]))
+
+    def add_dataset(self, dataset_folder, file_prefix='train_', batch_size=8192):
+        # Appends a generated dataset (chunked or plain .npy files)
+        dataset = ChunkedDataset(dataset_folder, file_prefix)
+        for features, patches in dataset.batches(batch_size, shuffle=False):
+            self.add(features, patches)
+
+    def search(self, features, k=5, n_probe=None):
+        # (distances, indices) of the k nearest stored samples for each query,
+        # nearest first, padded with inf/-1 when the probed cells hold fewer
+        # than k samples. The patches are self.patches[indices].
+        n_probe = min(n_probe or self.info['n_probe'], len(self.centroids))
+        queries = self.project(features)
+        cell_distances = ((queries[:, np.newaxis, :] - self.centroids[np.newaxis, :, :]) ** 2).sum(axis=-1)
+        probes = np.argsort(cell_distances, axis=1)[:, :n_probe]
+
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        for q, cells in enumerate(probes):
+            candidates = np.concatenate([np.arange(self.offsets[c], self.offsets[c + 1]) for c in cells])
+            if not len(candidates):
+                continue
+            d = ((self.vectors[candidates] - queries[q]) ** 2).sum(axis=1)
+            best = np.argsort(d)[:k]
+            distances[q, :len(best)] = np.sqrt(d[best])
+            indices[q, :len(best)] = candidates[best]
+        return distances, indices
+
+
+def buildPatchIndex(index_folder, dataset_folder, file_prefix='train_', num_mfccs=13, frame_size=2048,
+                    hop_size=1024, num_components=64, num_cells=None, n_probe=8, sample_size=20000, seed=0):
+    # Builds an index over a generated dataset and saves it to index_folder with
+    # the dataset's scaler and the MFCC settings the dataset was made with,
+    # which queries need to match. num_components=None indexes the flattened
+    # features as they are. The default num_cells is about sqrt(dataset size).
+    dataset = ChunkedDataset(dataset_folder, file_prefix)
+
+    # Projection and cells are fit on a sample of the dataset
+    sample = _sampleFeatures(dataset, sample_size, np.random.default_rng(seed))
+    model = {'mean': sample.mean(axis=0)}
+    sample = sample - model['mean']
+    if num_components is not None and num_components < sample.shape[1]:
+        _, _, vt = np.linalg.svd(sample, full_matrices=False)
+        model['components'] = vt[:num_components].astype(np.float32)
+        sample = sample @ model['components'].T
+    num_cells = min(num_cells or int(np.clip(np.sqrt(len(dataset)), 1, 4096)), len(sample))
+    model['centroids'] = _kmeans(sample, num_cells, seed=seed).astype(np.float32)
+
+    shutil.rmtree(index_folder, ignore_errors=True)
+    os.makedirs(index_folder)
+    np.savez(os.path.join(index_folder, MODEL_FILE), **model)
+    shutil.copy(os.path.join(dataset_folder, 'data_scaler.pkl'), os.path.join(index_folder, 'data_scaler.pkl'))
+    info = {
+        'num_mfccs': num_mfccs,
+        'frame_size': frame_size,
+        'hop_size': hop_size,
+        'features_shape': list(dataset.features_shape),
+        'num_params': int(dataset.num_params),
+        'n_probe': n_probe,
+        'segments': []
+    }
+    with open(os.path.join(index_folder, INDEX_FILE), 'w') as f:
+        json.dump(info, f, indent=4)
+
+    index = PatchIndex(index_folder)
+    index.add_dataset(dataset_folder, file_prefix)
+    return index
+
+
+class KNNEstimator(spgl.estimator.EstimatorBase):
+    """
+    Estimator that looks targets up in a PatchIndex and returns the patch of
+    the nearest stored sample. A spiegelib estimator, so it can be passed to
+    SoundMatch with MFCCs scaled by the index's data_scaler.pkl. Takes the
+    features of one target or a batch. With a synth and refine_steps > 0 the k
+    nearest patches are rendered and the closest one in feature space is
+    improved by a short local search: each step renders refine_batch
+    gaussian perturbations of the best patch so far, halving the step size
+    whenever none of them is closer.
+    """
+
+    def __init__(self, index, synth=None, k=5, n_probe=None, refine_steps=0, refine_batch=32, refine_sigma=0.05,
+                 seed=None):
+        if refine_steps and synth is None:
+            raise ValueError("Refining the nearest patches needs a synth to render them")
+        super().__init__()
+        self.index = index
+        self.synth = synth
+        self.k = k
+        self.n_probe = n_probe
+        self.refine_steps = refine_steps
+        self.refine_batch = refine_batch
+        self.refine_sigma = refine_sigma
+        self.rng = np.random.default_rng(seed)
+
+        # Same MFCCs and scaling as the indexed dataset
+        self.extractor = BatchMFCC(num_mfccs=index.info['num_mfccs'], frame_size=index.info['frame_size'],
+                                   hop_size=index.info['hop_size'], time_major=True, scale=True)
+        self.extractor.load_scaler(os.path.join(index.index_folder, 'data_scaler.pkl'))
+
+    def extract(self, targets):
+        audio = np.stack([target.get_audio() for target in targets])
+        with timed('features.BatchMFCC', items=len(audio)):
+            return self.extractor(audio, targets[0].get_sample_rate())
+
+    def predict(self, features):
+        # One patch per row of (scaled) features, or one patch for one target
+        features = np.asarray(features)
+        single = features.ndim == len(self.index.info['features_shape'])
+        if single:
+            features = features[np.newaxis]
+
+        with timed('knn.search', items=len(features)):
+            _, indices = self.index.search(features, k=self.k, n_probe=self.n_probe)
+            # Search -1 pads when the probed cells are empty, look those
+            # targets up in every cell instead
+            missing = indices[:, 0] < 0
+            if missing.any():
+                _, indices[missing] = self.index.search(features[missing], k=self.k,
+                                                        n_probe=len(self.index.centroids))
+                if (indices[:, 0] < 0).any():
+                    raise ValueError("The PatchIndex in %s is empty" % self.index.index_folder)
+
+        if not self.refine_steps:
+            patches = self.index.patches[indices[:, 0]]
+        else:
+            patches = np.stack([self.refine(f, self.index.patches[i[i >= 0]]) for f, i in zip(features, indices)])
+        return patches[0] if single else patches
+
+    def _distances(self, target, patches):
+        audio = np.concatenate(list(renderPatches(self.synth, patches)))
+        with timed('features.BatchMFCC', items=len(audio)):
+            features = self.extractor(audio, self.synth.sample_rate)
+        return np.sqrt(((features.reshape(len(features), -1) - target.reshape(-1)) ** 2).sum(axis=1))
+
+    def refine(self, target, patches):
+        distances = self._distances(target, patches)
+        best, best_distance = patches[np.argmin(distances)], distances.min()
+        sigma = self.refine_sigma
+        for _ in range(self.refine_steps):
+            candidates = np.clip(best + self.rng.normal(0.0, sigma, (self.refine_batch, len(best))), 0.0, 1.0)
+            distances = self._distances(target, candidates)
+            if distances.min() < best_distance:
+                best, best_distance = candidates[np.argmin(distances)], distances.min()
+            else:
+                sigma /= 2.0
+        return best
@@ -0,0 +1,506 @@
+import argparse
+import ast
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+import traceback
+from multiprocessing.connection import wait
+from lite_inference import liteModelPath
+
+# Same settings main.py used to hard code. Per run overrides are passed to
+# runPipeline and saved with the run.
+DEFAULT_CONFIG = {
+    'synth_path': "/home/ubuntu/spiegelib_tests/WaveTableSynth/WaveTableSynth.so",
+    'synth_config': 'wavetable',     # or 'dexed' (use with synth_path "simple_fm" for the built in FM synth)
+    'note_len': 1.5,
+    'render_len': 1.5,
+    'mfccs': 13,
+    'frame': 1024,
+    'hop': 512,
+    'eval_samples': 30,
+    'train_size': 30000,
+    'test_size': 8000,
+    'epochs': 100,
+    'pop_size': 300,
+    'gen_size': 100,
+    'shard_size': 1000,
+    'scaler_fit_size': 10000,        # training samples the data scaler is fit on (None for all of them)
+    'num_workers': None,             # None uses every core of the machine running the node
+    'parallel_dataset': True,        # sharded generateDatasetParallel instead of generateDataset
+    'stream_dataset': False,         # train the first dl_model while the dataset renders (one node for both)
+    'parallel_ga': False,            # process pool GA instead of spiegelib's BasicGA/NSGA3
+    'batch_dl': False,               # match with every dl_model in one runBatchDL node (match_dl)
+    'dl_models': ['bi_lstm'],
+    'ga_models': ['ga', 'nsga'],     # 'surrogate_ga' is seeded by and waits for the dl_models
+    'surrogate_pop_size': 100,
+    'surrogate_gen_size': 30,
+    'inference_precision': None,     # 'float16' or 'int8' to match with TFLite exports of the dl_models
+    'knn': False,                    # nearest neighbour lookup in an index over the training set
+    'knn_refine_steps': 0,           # local search steps after the lookup (0 returns the nearest patch)
+    'render_cache': False,           # configureRenderCache in every node that renders
+    'incremental_eval': False,       # evaluateIncremental, which only re-scores models whose estimates changed
+    'instrument': False,             # per node instrumentation reports under nodes/<node>/
+}
+
+TRAINERS = {'mlp': 'trainMLP', 'lstm': 'trainLSTM', 'bi_lstm': 'trainBiLSTM'}
+DL_MATCHERS = {'mlp': 'runMLP', 'lstm': 'runLSTM', 'bi_lstm': 'runBiLSTM'}
+GA_MATCHERS = {'ga': 'runGeneticAlgBasic', 'nsga': 'runGeneticAlgNSGA'}
+PARALLEL_GA_MATCHERS = {'ga': 'runGeneticAlgBasicParallel', 'nsga': 'runGeneticAlgNSGAParallel'}
+MODEL_OUTPUTS = {'mlp': 'simple_fm_mlp.h5', 'lstm': 'simple_fm_lstm.h5', 'bi_lstm': 'simple_fm_bi_lstm.h5'}
+
+# Node modules are looked up here, anything else they import counts as a library
+SOURCE_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+
+class Node():
+    """
+    One pipeline step: a module level function called with keyword arguments,
+    the nodes it depends on and the files or folders (relative to the run
+    folder) it produces.
+    """
+
+    def __init__(self, name, module, function, kwargs, outputs, deps=()):
+        self.name = name
+        self.module = module
+        self.function = function
+        self.kwargs = kwargs
+        self.outputs = outputs
+        self.deps = list(deps)
+
+
+# Node functions that need feature extractors build them here, so node kwargs
+# stay plain JSON and can be fingerprinted
+
+def configureSynth(synth_path, synth_state, synth_config):
+    from synth_config import configDexed, configWTSynth
+    if synth_config == 'dexed':
+        configDexed(synth_path, synth_state)
+    else:
+        configWTSynth(synth_path, synth_state)
+
+def generateDatasetNode(synth_path, output_folder, synth_state, num_mfccs, frame_size, hop_size, train_size,
+                        test_size, note_len, render_len, parallel, num_workers, shard_size, scaler_fit_size):
+    from dataset_generation import initMFCCFeatures, generateDataset, generateDatasetParallel
+    features = initMFCCFeatures(num_mfccs=num_mfccs, frame_size=frame_size, hop_size=hop_size)
+    if parallel:
+        generateDatasetParallel(synth_path, output_folder, synth_state, features, train_size=train_size,
+                                test_size=test_size, note_len=note_len, render_len=render_len,
+                                num_workers=num_workers, shard_size=shard_size, output_format='chunked',
+                                scaler_fit_size=scaler_fit_size)
+    else:
+        generateDataset(synth_path, output_folder, synth_state, features, train_size=train_size,
+                        test_size=test_size, note_len=note_len, render_len=render_len)
+
+def streamTrainNode(synth_path, output_folder, synth_state, num_mfccs, frame_size, hop_size, train_size, test_size,
+                    note_len, render_len, num_workers, shard_size, models, epochs):
+    from dataset_generation import initMFCCFeatures
+    from train_dl_models import trainWhileGenerating
+    features = initMFCCFeatures(num_mfccs=num_mfccs, frame_size=frame_size, hop_size=hop_size)
+    trainWhileGenerating(synth_path, output_folder, synth_state, features, models=models, epochs=epochs,
+                         train_size=train_size, test_size=test_size, note_len=note_len, render_len=render_len,
+                         num_workers=num_workers, shard_size=shard_size)
+
+def generateEvalNode(synth_path, output_folder, synth_state, num_mfccs, frame_size, hop_size, num_samples,
+                     note_len, render_len):
+    from dataset_generation import initMFCCFeatures, generateEval
+    features = initMFCCFeatures(num_mfccs=num_mfccs, frame_size=frame_size, hop_size=hop_size)
+    generateEval(synth_path, output_folder, synth_state, features, num_samples=num_samples, note_len=note_len,
+                 render_len=render_len)
+
+
+def buildPipeline(run_folder, config):
+    # The experiment in main.py as a list of nodes
+    c = config
+    synth_state = os.path.join(run_folder, "modified_param_space.json")
+    eval_folder = os.path.join(run_folder, "evaluation")
+    synth_args = dict(synth_path=c['synth_path'], synth_state=synth_state)
+    feature_args = dict(num_mfccs=c['mfccs'], frame_size=c['frame'], hop_size=c['hop'])
+    length_args = dict(note_len=c['note_len'], render_len=c['render_len'])
+    match_args = dict(synth_args, model_folder=run_folder, output_folder_eval=eval_folder,
+                      num_mfccs=c['mfccs'], hop_size=c['hop'], **length_args)
+
+    nodes = [
+        Node('config_synth', 'pipeline', 'configureSynth',
+             dict(synth_args, synth_config=c['synth_config']),
+             outputs=["modified_param_space.json"]),
+    ]
+
+    # With stream_dataset the dl_models are trained in the dataset node itself,
+    # so there are no separate train nodes for their matchers to wait for
+    if c['stream_dataset']:
+        nodes.append(Node('dataset', 'pipeline', 'streamTrainNode',
+                          dict(synth_args, output_folder=run_folder, train_size=c['train_size'],
+                               test_size=c['test_size'], num_workers=c['num_workers'], shard_size=c['shard_size'],
+                               models=c['dl_models'], epochs=c['epochs'], **feature_args, **length_args),
+                          outputs=["train_manifest.json", "test_manifest.json", "data_scaler.pkl"] +
+                                  [MODEL_OUTPUTS[m] for m in c['dl_models']] +
+                                  ["%s_logger.json" % m for m in c['dl_models']],
+                          deps=['config_synth']))
+        trained = {model: 'dataset' for model in c['dl_models']}
+    else:
+        nodes.append(Node('dataset', 'pipeline', 'generateDatasetNode',
+                          dict(synth_args, output_folder=run_folder, train_size=c['train_size'],
+                               test_size=c['test_size'], parallel=c['parallel_dataset'],
+                               num_workers=c['num_workers'], shard_size=c['shard_size'],
+                               scaler_fit_size=c['scaler_fit_size'], **feature_args, **length_args),
+                          outputs=(["train_manifest.json", "test_manifest.json", "data_scaler.pkl"]
+                                   if c['parallel_dataset'] else
+                                   ["train_features.npy", "train_patches.npy", "test_features.npy",
+                                    "test_patches.npy", "data_scaler.pkl"]),
+                          deps=['config_synth']))
+        trained = {model: 'train_%s' % model for model in c['dl_models']}
+
+    nodes.append(Node('eval_targets', 'pipeline', 'generateEvalNode',
+                      dict(synth_args, output_folder=eval_folder, num_samples=c['eval_samples'], **feature_args,
+                           **length_args),
+                      outputs=["evaluation/audio"], deps=['config_synth']))
+
+    # Node that writes each model's estimates to evaluation/<model>
+    matchers = {}
+    dl_deps = []
+    for model in c['dl_models']:
+        if not c['stream_dataset']:
+            nodes.append(Node('train_%s' % model, 'train_dl_models', TRAINERS[model],
+                              dict(output_folder=run_folder, epochs=c['epochs']),
+                              outputs=[MODEL_OUTPUTS[model], "%s_logger.json" % model], deps=['dataset']))
+        if c['inference_precision']:
+            nodes.append(Node('export_%s' % model, 'train_dl_models', 'exportLiteModel',
+                              dict(model_path=os.path.join(run_folder, MODEL_OUTPUTS[model]),
+                                   precision=c['inference_precision']),
+                              outputs=[liteModelPath(MODEL_OUTPUTS[model], c['inference_precision'])],
+                              deps=[trained[model]]))
+            model_dep = 'export_%s' % model
+        else:
+            model_dep = trained[model]
+        if c['batch_dl']:
+            dl_deps.append(model_dep)
+            matchers[model] = 'match_dl'
+        else:
+            nodes.append(Node('match_%s' % model, 'sound_match_dl', DL_MATCHERS[model],
+                              dict(match_args, precision=c['inference_precision']),
+                              outputs=["evaluation/%s" % model], deps=[model_dep, 'eval_targets']))
+            matchers[model] = 'match_%s' % model
+
+    if c['batch_dl'] and c['dl_models']:
+        nodes.append(Node('match_dl', 'sound_match_dl', 'runBatchDL',
+                          dict(match_args, models=c['dl_models'], num_workers=c['num_workers'],
+                               precision=c['inference_precision']),
+                          outputs=["evaluation/%s" % model for model in c['dl_models']],
+                          deps=sorted(set(dl_deps)) + ['eval_targets']))
+
+    if c['inference_precision'] and c['dl_models']:
+        nodes.append(Node('inference_report', 'train_dl_models', 'compareLiteModels',
+                          dict(output_folder=run_folder, models=c['dl_models'], precision=c['inference_precision']),
+                          outputs=["inference_report_%s.json" % c['inference_precision']],
+                          deps=['dataset'] + ['export_%s' % model for model in c['dl_models']]))
+
+    for model in c['ga_models']:
+        if model == 'surrogate_ga':
+            matchers[model] = 'match_surrogate_ga'
+            nodes.append(Node('match_surrogate_ga', 'sound_match_genetic', 'runSurrogateGA',
+                              dict(match_args, models=c['dl_models'], pop_size=c['surrogate_pop_size'],
+                                   gen_size=c['surrogate_gen_size'], num_workers=c['num_workers']),
+                              outputs=["evaluation/surrogate_ga", "evaluation/surrogate_ga_renders.json"],
+                              deps=['eval_targets'] + sorted(set(trained.values()))))
+            continue
+        if c['parallel_ga']:
+            function = PARALLEL_GA_MATCHERS[model]
+            kwargs = dict(match_args, pop_size=c['pop_size'], gen_size=c['gen_size'], num_workers=c['num_workers'])
+        else:
+            function = GA_MATCHERS[model]
+            kwargs = dict(match_args, pop_size=c['pop_size'], gen_size=c['gen_size'])
+        nodes.append(Node('match_%s' % model, 'sound_match_genetic', function, kwargs,
+                          outputs=["evaluation/%s" % model], deps=['eval_targets']))
+        matchers[model] = 'match_%s' % model
+
+    if c['knn']:
+        nodes.append(Node('patch_index', 'patch_index', 'buildPatchIndex',
+                          dict(index_folder=os.path.join(run_folder, "patch_index"), dataset_folder=run_folder,
+                               **feature_args),
+                          outputs=["patch_index"], deps=['dataset']))
+        nodes.append(Node('match_knn', 'sound_match_knn', 'runKNN',
+                          dict(synth_args, index_folder=os.path.join(run_folder, "patch_index"),
+                               output_folder_eval=eval_folder, refine_steps=c['knn_refine_steps'], **length_args),
+                          outputs=["evaluation/knn", "evaluation/knn_patches.json"],
+                          deps=['patch_index', 'eval_targets']))
+        matchers['knn'] = 'match_knn'
+
+    models = c['ga_models'] + c['dl_models'] + (['knn'] if c['knn'] else [])
+    if c['incremental_eval']:
+        function, kwargs = 'evaluateIncremental', dict(eval_folder=eval_folder, models=models,
+                                                       num_workers=c['num_workers'])
+    else:
+        function, kwargs = 'evaluate', dict(eval_folder=eval_folder, models=models)
+    nodes.append(Node('evaluate', 'evaluation', function, kwargs,
+                      outputs=["evaluation/evaluation_stats.json", "evaluation/evaluation_scores.json"],
+                      deps=sorted(set(matchers[model] for model in models))))
+    return nodes
+
+
+def _outputSignature(run_folder, outputs):
+    # Size and modification time of every output file (recursively for folders),
+    # or None if any output is missing
+    signature = []
+    for output in outputs:
+        path = os.path.join(run_folder, output)
+        if os.path.isdir(path):
+            for root, _, files in sorted(os.walk(path)):
+                for name in sorted(files):
+                    stat = os.stat(os.path.join(root, name))
+                    signature.append([os.path.relpath(os.path.join(root, name), run_folder), stat.st_size,
+                                      stat.st_mtime_ns])
+        elif os.path.exists(path):
+            stat = os.stat(path)
+            signature.append([output, stat.st_size, stat.st_mtime_ns])
+        else:
+            return None
+    return signature
+
+def _outputDigest(run_folder, outputs):
+    # Hash of the paths and contents of every output file, so a node that is
+    # re-run but writes the same files does not invalidate its dependents
+    h = hashlib.sha1()
+    for output in outputs:
+        path = os.path.join(run_folder, output)
+        files = [path]
+        if os.path.isdir(path):
+            files = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+        for file_path in files:
+            h.update(os.path.relpath(file_path, run_folder).encode())
+            with open(file_path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    h.update(block)
+    return h.hexdigest()
+
+def _localModule(name, source_folder):
+    # Source file of a module that lives next to this one, or None
+    path = os.path.join(source_folder, name.split('.')[0] + '.py')
+    return path if os.path.exists(path) else None
+
+def _localImports(tree, source_folder):
+    # Local modules imported anywhere in an AST (including inside functions)
+    modules = set()
+    for child in ast.walk(tree):
+        if isinstance(child, ast.Import):
+            names = [alias.name for alias in child.names]
+        elif isinstance(child, ast.ImportFrom) and child.module and not child.level:
+            names = [child.module]
+        else:
+            continue
+        modules.update(name.split('.')[0] for name in names if _localModule(name, source_folder))
+    return modules
+
+def _sourceDigest(module, function, source_folder=SOURCE_FOLDER):
+    # Hash of the source a node function runs: its own definition and the
+    # definitions it uses from its module, plus the whole source of every
+    # local module those import, followed transitively. Sources are parsed,
+    # not imported, so the scheduler never imports TensorFlow itself.
+    with open(_localModule(module, source_folder), 'r') as f:
+        source = f.read()
+    tree = ast.parse(source)
+
+    definitions, imported = {}, {}
+    for statement in tree.body:
+        if isinstance(statement, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            definitions[statement.name] = statement
+        elif isinstance(statement, (ast.Assign, ast.AnnAssign)):
+            targets = statement.targets if isinstance(statement, ast.Assign) else [statement.target]
+            for target in targets:
+                for name in ast.walk(target):
+                    if isinstance(name, ast.Name):
+                        definitions[name.id] = statement
+        elif isinstance(statement, ast.Import):
+            for alias in statement.names:
+                if _localModule(alias.name, source_folder):
+                    imported[alias.asname or alias.name.split('.')[0]] = alias.name.split('.')[0]
+        elif isinstance(statement, ast.ImportFrom) and statement.module and not statement.level:
+            if _localModule(statement.module, source_folder):
+                for alias in statement.names:
+                    imported[alias.asname or alias.name] = statement.module.split('.')[0]
+
+    if function not in definitions:
+        raise ValueError("%s.%s is not defined at module level" % (module, function))
+    used, pending, modules = set(), [function], set()
+    while pending:
+        name = pending.pop()
+        if name in used:
+            continue
+        used.add(name)
+        modules.update(_localImports(definitions[name], source_folder))
+        for child in ast.walk(definitions[name]):
+            if isinstance(child, ast.Name):
+                if child.id in imported:
+                    modules.add(imported[child.id])
+                elif child.id in definitions:
+                    pending.append(child.id)
+
+    h = hashlib.sha1()
+    for name in sorted(used):
+        h.update(ast.get_source_segment(source, definitions[name]).encode())
+    seen, pending = set(), sorted(modules - {module})
+    while pending:
+        name = pending.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        with open(_localModule(name, source_folder), 'rb') as f:
+            module_source = f.read()
+        h.update(name.encode())
+        h.update(module_source)
+        pending.extend(sorted(_localImports(ast.parse(module_source), source_folder) - seen - {module}))
+    return h.hexdigest()
+
+def _fingerprint(node, config, done):
+    # Hash of the source the node function runs, its arguments, the options
+    # that change its output and the contents of its deps' outputs
+    options = {k: config[k] for k in ('render_cache',)}
+    h = hashlib.sha1()
+    h.update(json.dumps([node.module, node.function, _sourceDigest(node.module, node.function), node.kwargs,
+                         options], sort_keys=True).encode())
+    for dep in node.deps:
+        h.update(done[dep]['digest'].encode())
+    return h.hexdigest()
+
+def _runNode(module, function, kwargs, run_folder, node_name, config, conn):
+    # Runs in its own process, reports success or the traceback back over conn
+    try:
+        if config['render_cache']:
+            from render_cache import configureRenderCache
+            configureRenderCache(cache_folder=os.path.join(run_folder, 'render_cache'))
+        if config['instrument']:
+            from instrumentation import enableInstrumentation
+            enableInstrumentation(os.path.join(run_folder, 'nodes', node_name))
+
+        # num_workers None is resolved here rather than in the config, so the
+        # node's fingerprint doesn't depend on the machine's core count
+        if 'num_workers' in kwargs and kwargs['num_workers'] is None:
+            kwargs = dict(kwargs, num_workers=os.cpu_count())
+        getattr(__import__(module), function)(**kwargs)
+
+        if config['instrument']:
+            from instrumentation import writeInstrumentationReport
+            writeInstrumentationReport()
+        conn.send(None)
+    except BaseException:
+        conn.send(traceback.format_exc())
+    finally:
+        conn.close()
+
+def _upstream(nodes, names):
+    # names plus everything they depend on
+    selected, pending = set(), list(names)
+    while pending:
+        name = pending.pop()
+        if name not in selected:
+            selected.add(name)
+            pending.extend(nodes[name].deps)
+    return selected
+
+def runPipeline(name, config=None, targets=None, force=(), max_parallel=2, runs_folder="./runs"):
+    # Runs the pipeline in runs/<name>/. A node is skipped when its source,
+    # arguments and the contents of its input artifacts match the last
+    # successful run and its outputs are untouched. Nodes whose deps are done run at the same time
+    # (up to max_parallel), each in its own process. targets limits the run to
+    # those nodes and what they depend on, force re-runs nodes regardless.
+    run_folder = os.path.join(runs_folder, name)
+    os.makedirs(run_folder, exist_ok=True)
+    unknown = sorted(set(config or {}) - set(DEFAULT_CONFIG))
+    if unknown:
+        raise ValueError("Unknown config settings %s" % unknown)
+    config = dict(DEFAULT_CONFIG, **(config or {}))
+    with open(os.path.join(run_folder, 'pipeline_config.json'), 'w') as f:
+        json.dump(config, f, indent=4)
+
+    nodes = {node.name: node for node in buildPipeline(run_folder, config)}
+    for node_name in list(targets or []) + list(force):
+        if node_name not in nodes:
+            raise ValueError("Unknown node '%s', nodes are %s" % (node_name, list(nodes)))
+    selected = _upstream(nodes, targets or list(nodes))
+
+    state_path = os.path.join(run_folder, 'pipeline_state.json')
+    previous = {}
+    if os.path.exists(state_path):
+        with open(state_path, 'r') as f:
+            previous = json.load(f)
+
+    def saveState():
+        with open(state_path + '.tmp', 'w') as f:
+            json.dump(previous, f, indent=4)
+        os.replace(state_path + '.tmp', state_path)
+
+    context = multiprocessing.get_context('spawn')
+    done, running, failed = {}, {}, []
+    while len(done) + len(failed) < len(selected):
+        blocked = set(n for n in selected if any(d in failed for d in nodes[n].deps))
+        ready = [n for n in selected if n not in done and n not in running and n not in failed and
+                 n not in blocked and all(d in done for d in nodes[n].deps)]
+
+        for node_name in ready:
+            node = nodes[node_name]
+            fingerprint = _fingerprint(node, config, done)
+            last = previous.get(node_name)
+            if (node_name not in force and last is not None and 'digest' in last and
+                    last['fingerprint'] == fingerprint and
+                    last['outputs'] == _outputSignature(run_folder, node.outputs)):
+                print("%s: up to date" % node_name)
+                done[node_name] = last
+                continue
+            if len(running) >= max_parallel:
+                continue
+
+            print("%s: running" % node_name)
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=_runNode, args=(node.module, node.function, node.kwargs,
+                                                             run_folder, node_name, config, sender))
+            process.start()
+            sender.close()
+            running[node_name] = (process, receiver, fingerprint, time.perf_counter())
+
+        if not running:
+            # Nothing left that can run, the rest depends on a failed node
+            failed.extend(n for n in blocked if n not in failed)
+            continue
+
+        finished = wait([process.sentinel for process, _, _, _ in running.values()])
+        for node_name in [n for n, r in running.items() if r[0].sentinel in finished]:
+            process, receiver, fingerprint, start = running.pop(node_name)
+            error = receiver.recv() if receiver.poll() else "exited with code %s" % process.exitcode
+            process.join()
+            outputs = _outputSignature(run_folder, nodes[node_name].outputs)
+            if error is None and outputs is None:
+                error = "did not produce all of its outputs %s" % nodes[node_name].outputs
+
+            if error is None:
+                print("%s: finished in %.1fs" % (node_name, time.perf_counter() - start))
+                done[node_name] = {'fingerprint': fingerprint, 'outputs': outputs,
+                                   'digest': _outputDigest(run_folder, nodes[node_name].outputs)}
+                previous[node_name] = done[node_name]
+                saveState()
+            else:
+                print("%s: failed\n%s" % (node_name, error))
+                previous.pop(node_name, None)
+                saveState()
+                failed.append(node_name)
+
+    if failed:
+        raise RuntimeError("Pipeline nodes failed or were skipped because a dependency failed: %s" % failed)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the sound matching experiment as a cached pipeline")
+    parser.add_argument('name', help="run name, outputs go to runs/<name>/")
+    parser.add_argument('--config', help="JSON file with settings overriding DEFAULT_CONFIG")
+    parser.add_argument('--targets', nargs='+', help="only run these nodes and their dependencies")
+    parser.add_argument('--force', nargs='+', default=[], help="re-run these nodes even if up to date")
+    parser.add_argument('--max-parallel', type=int, default=2)
+    parser.add_argument('--runs-folder', default="./runs")
+    args = parser.parse_args()
+
+    overrides = None
+    if args.config:
+        with open(args.config, 'r') as f:
+            overrides = json.load(f)
+    runPipeline(args.name, overrides, targets=args.targets, force=args.force, max_parallel=args.max_parallel,
+                runs_folder=args.runs_folder)
@@ -0,0 +1,218 @@
+import spiegelib as spgl
+import numpy as np
+import functools
+import hashlib
+import os
+from collections import OrderedDict
+from batch_features import extractBatch
+from instrumentation import timed, uninstrumentedType
+
+# Cache settings applied by loadSynth, set with configureRenderCache
+_config = None
+_caches = {}
+
+
+def configureRenderCache(max_bytes=512 * 1024 * 1024, cache_folder=None, decimals=4):
+    # Turns on render/feature caching for every synth created through loadSynth
+    # from now on in this process. Pool workers get the settings through their
+    # initializer, see renderCacheConfig. Pass max_bytes=None to turn it off again.
+    setRenderCacheConfig(None if max_bytes is None else {
+        'max_bytes': max_bytes,
+        'cache_folder': cache_folder,
+        'decimals': decimals
+    })
+
+def renderCacheConfig():
+    # The current settings, for pool initializers to pass on to setRenderCacheConfig
+    # (spawned workers start with a fresh copy of this module)
+    return _config
+
+def setRenderCacheConfig(config):
+    global _config
+    _config = config
+    _caches.clear()
+
+def getRenderCache(synth_state, note_len, render_len):
+    if _config is None:
+        return None
+    key = (synth_state, note_len, render_len)
+    if key not in _caches:
+        _caches[key] = RenderCache(synth_state, note_len, render_len, **_config)
+    return _caches[key]
+
+def extractorConfig(extractor):
+    # Class name plus the plain settings of an extractor (frame size, hop size, ...)
+    settings = sorted((k, v) for k, v in vars(extractor).items()
+                      if isinstance(v, (int, float, str, bool)) or v is None)
+    return '%s%s' % (uninstrumentedType(extractor).__name__, settings)
+
+
+class RenderCache():
+    """
+    Content addressed cache for rendered audio and extracted features. Keys are
+    a hash of the synth state file, note/render length, the patch rounded to
+    `decimals` places and (for features) the extractor settings. Recently used
+    entries are kept in memory up to max_bytes, everything is also written to
+    cache_folder when one is given.
+    """
+
+    def __init__(self, synth_state, note_len, render_len, max_bytes=512 * 1024 * 1024, cache_folder=None,
+                 decimals=4):
+        with open(synth_state, 'rb') as f:
+            state_hash = hashlib.sha1(f.read()).hexdigest()
+        self.prefix = ('%s:%r:%r' % (state_hash, note_len, render_len)).encode()
+        self.max_bytes = max_bytes
+        self.cache_folder = cache_folder
+        self.decimals = decimals
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if cache_folder:
+            os.makedirs(cache_folder, exist_ok=True)
+
+    def key(self, patch, extractor=None):
+        h = hashlib.sha1(self.prefix)
+        h.update(np.round(np.asarray(patch, dtype=np.float64), self.decimals).tobytes())
+        if extractor is not None:
+            h.update(extractorConfig(extractor).encode())
+        return h.hexdigest()
+
+    def get(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return self.memory[key]
+
+        path = self._diskPath(key)
+        if path and os.path.exists(path):
+            value = np.load(path)
+            self._remember(key, value)
+            self.disk_hits += 1
+            return value
+
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self._remember(key, value)
+        path = self._diskPath(key)
+        if path and not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = path + '.%d.tmp' % os.getpid()
+            with open(tmp_path, 'wb') as f:
+                np.save(f, value)
+            os.replace(tmp_path, path)
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            'memory_items': len(self.memory),
+            'memory_bytes': self.memory_bytes
+        }
+
+    def _remember(self, key, value):
+        if key in self.memory:
+            self.memory_bytes -= self.memory.pop(key).nbytes
+        self.memory[key] = value
+        self.memory_bytes += value.nbytes
+        while self.memory_bytes > self.max_bytes and len(self.memory) > 1:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_bytes -= evicted.nbytes
+
+    def _diskPath(self, key):
+        if not self.cache_folder:
+            return None
+        return os.path.join(self.cache_folder, key[:2], key + '.npy')
+
+
+class CachedSynth():
+    """
+    Synth mixin that serves renders from a RenderCache. cachedSynth applies it
+    to a loaded synth through a subclass of the synth's own class, so the
+    result is still that SynthBase (for SoundMatch, estimators and
+    renderPatches) with only rendering changed.
+    """
+
+    def render_patch(self):
+        patch = np.array([p[1] for p in self.get_patch()])
+        self.cached_audio = self.render_batch(patch[np.newaxis])[0]
+        self.rendered_patch = True
+
+    def get_audio(self):
+        if not self.rendered_patch:
+            raise Exception('Patch must be rendered before audio can be retrieved')
+        return spgl.AudioBuffer(self.cached_audio, self.sample_rate)
+
+    def _freeParameters(self, patches):
+        # Full patches (every parameter) are keyed and rendered by their free
+        # parameters, the synth ignores the overridden values they carry
+        patches = np.atleast_2d(patches)
+        space = self.param_space
+        if patches.shape[-1] == space.num_params and space.num_free != space.num_params:
+            return space.to_reduced(patches)
+        return patches
+
+    def render_batch(self, patches):
+        patches = self._freeParameters(patches)
+        keys = [self.cache.key(patch) for patch in patches]
+        audio = [self.cache.get(key) for key in keys]
+
+        missing = [i for i, a in enumerate(audio) if a is None]
+        if missing:
+            for i, rendered in zip(missing, self._render(patches[missing])):
+                self.cache.put(keys[i], rendered)
+                audio[i] = rendered
+        return np.stack(audio)
+
+    def features(self, extractors, patches):
+        # Features from every extractor for each patch, as a list with one
+        # (patches, ...) array per extractor. Patches with all features cached
+        # are not rendered at all.
+        patches = self._freeParameters(patches)
+        keys = [[self.cache.key(patch, extractor) for extractor in extractors] for patch in patches]
+        values = [[self.cache.get(key) for key in row] for row in keys]
+
+        missing = [i for i, row in enumerate(values) if any(v is None for v in row)]
+        if missing:
+            audio = self.render_batch(patches[missing])
+            for j, extractor in enumerate(extractors):
+                with timed('features.%s' % uninstrumentedType(extractor).__name__, items=len(audio)):
+                    extracted = extractBatch(extractor, audio, self.sample_rate)
+                for i, feature in zip(missing, extracted):
+                    self.cache.put(keys[i][j], feature)
+                    values[i][j] = feature
+
+        return [np.stack([row[j] for row in values]) for j in range(len(extractors))]
+
+    def _render(self, patches):
+        # Renders with the synth's own methods
+        if hasattr(super(), 'render_batch'):
+            return super().render_batch(patches)
+
+        audio = []
+        for patch in patches:
+            self.param_space.apply(self, patch)
+            super().render_patch()
+            audio.append(super().get_audio().get_audio())
+        return np.stack(audio)
+
+
+@functools.lru_cache(maxsize=None)
+def _cachedClass(cls):
+    return type('Cached%s' % cls.__name__, (CachedSynth, cls), {})
+
+def cachedSynth(synth, cache):
+    # The synth as an instance of its cached subclass. Takes over the synth's
+    # state (and engine), the original object should not be used afterwards.
+    cached = object.__new__(_cachedClass(type(synth)))
+    cached.__dict__.update(vars(synth))
+    cached.cache = cache
+    cached.cached_audio = None
+    return cached
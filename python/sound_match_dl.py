@@ -2,100 +2,94 @@ import spiegelib as spgl
 import numpy as np
 import matplotlib.pyplot as plt
 import os
-from pydub import AudioSegment
+from synth_config import loadSynth
+from audio_output import EstimateWriter
+from batch_matching import BatchMatcher, loadModel
+from instrumentation import instrumentedStage, instrumentedFeatures, instrumentedEstimator, instrumentationTarget, timed
 
-def runMLP(synth_path, model_folder, output_folder_eval, synth_state, num_mfccs=13, hop_size=1024, note_len=1.0, render_len=1.0):
-    synth = spgl.synth.SynthVST(synth_path,
-                                note_length_secs=note_len, render_length_secs=render_len)
-    synth.load_state(synth_state)
+@instrumentedStage
+def runMLP(synth_path, model_folder, output_folder_eval, synth_state, num_mfccs=13, hop_size=1024, note_len=1.0, render_len=1.0, save_concat=True, precision=None):
+    synth = loadSynth(synth_path, synth_state, note_len=note_len, render_len=render_len)
 
-    mlp = spgl.estimator.TFEstimatorBase.load(os.path.join(model_folder, 'simple_fm_mlp.h5'))
+    mlp = loadModel(model_folder, 'mlp', precision)
 
     # MLP feature extractor with a modifying function that flattens the time slice arrays at the end of the feature
     # extraction pipeline
     mlp_extractor = spgl.features.MFCC(num_mfccs=num_mfccs, time_major=True, hop_size=hop_size, scale=True)
     mlp_extractor.load_scaler(os.path.join(model_folder, 'data_scaler.pkl'))
     mlp_extractor.add_modifier(lambda data : data.flatten(), type='output')
-    mlp_matcher = spgl.SoundMatch(synth, mlp, mlp_extractor)
-
-    input_folder_audio = os.path.join(output_folder_eval, 'audio')
-    targets = spgl.AudioBuffer.load_folder(os.path.join(output_folder_eval, 'audio'))
-    output_folder_pred = os.path.join(output_folder_eval, 'mlp')
-    output_folder_concat = os.path.join(output_folder_eval, 'mlp_concat')
-    if not os.path.exists(output_folder_concat):
-        os.mkdir(output_folder_concat)
+    mlp_matcher = spgl.SoundMatch(synth, instrumentedEstimator(mlp, 'mlp'), instrumentedFeatures(mlp_extractor))
+
+    with timed('file_io.load_audio'):
+        targets = spgl.AudioBuffer.load_folder(os.path.join(output_folder_eval, 'audio'))
+    writer = EstimateWriter(output_folder_eval, 'mlp', concat=save_concat)
     for i in range(len(targets)):
-        target_path = os.path.join(input_folder_audio, 'output_%s.wav' % i)
-        est_path = os.path.join(output_folder_pred, 'mlp_prediction_%s.wav' % i)
-        concat_path = os.path.join(output_folder_concat, 'concat_mlp_prediction_%s.wav' % i)
-        audio = mlp_matcher.match(targets[i])
-        audio.save(est_path)
-        estimation = AudioSegment.from_wav(est_path)
-        target = AudioSegment.from_wav(target_path)
-        concat = target + estimation
-        concat.export(concat_path, format="wav")
+        with instrumentationTarget(i):
+            audio = mlp_matcher.match(targets[i])
+            writer.write(i, targets[i], audio)
+    writer.close()
 
 
         
 
-def runLSTM(synth_path, model_folder, output_folder_eval, synth_state, num_mfccs=13, hop_size=1024, note_len=1.0, render_len=1.0):
-    synth = spgl.synth.SynthVST(synth_path,
-                                note_length_secs=note_len, render_length_secs=render_len)
-    synth.load_state(synth_state)
+@instrumentedStage
+def runLSTM(synth_path, model_folder, output_folder_eval, synth_state, num_mfccs=13, hop_size=1024, note_len=1.0, render_len=1.0, save_concat=True, precision=None):
+    synth = loadSynth(synth_path, synth_state, note_len=note_len, render_len=render_len)
 
-    lstm = spgl.estimator.TFEstimatorBase.load(os.path.join(model_folder, 'simple_fm_lstm.h5'))
+    lstm = loadModel(model_folder, 'lstm', precision)
 
     # LSTM & LSTM++ feature extractor -- time series of MFCC frames
     lstm_extractor = spgl.features.MFCC(num_mfccs=num_mfccs, time_major=True, hop_size=hop_size, scale=True)
     lstm_extractor.load_scaler(os.path.join(model_folder, 'data_scaler.pkl'))
-    lstm_matcher = spgl.SoundMatch(synth, lstm, lstm_extractor)
-
-    input_folder_audio = os.path.join(output_folder_eval, 'audio')
-    targets = spgl.AudioBuffer.load_folder(os.path.join(output_folder_eval, 'audio'))
-    output_folder_pred = os.path.join(output_folder_eval, 'lstm')
-    output_folder_concat = os.path.join(output_folder_eval, 'lstm_concat')
-    if not os.path.exists(output_folder_concat):
-        os.mkdir(output_folder_concat)
+    lstm_matcher = spgl.SoundMatch(synth, instrumentedEstimator(lstm, 'lstm'), instrumentedFeatures(lstm_extractor))
+
+    with timed('file_io.load_audio'):
+        targets = spgl.AudioBuffer.load_folder(os.path.join(output_folder_eval, 'audio'))
+    writer = EstimateWriter(output_folder_eval, 'lstm', concat=save_concat)
     for i in range(len(targets)):
-        target_path = os.path.join(input_folder_audio, 'output_%s.wav' % i)
-        est_path = os.path.join(output_folder_pred, 'lstm_prediction_%s.wav' % i)
-        concat_path = os.path.join(output_folder_concat, 'concat_lstm_prediction_%s.wav' % i)
-        audio = lstm_matcher.match(targets[i])
-        audio.save(est_path)
-        estimation = AudioSegment.from_wav(est_path)
-        target = AudioSegment.from_wav(target_path)
-        concat = target + estimation
-        concat.export(concat_path, format="wav")
+        with instrumentationTarget(i):
+            audio = lstm_matcher.match(targets[i])
+            writer.write(i, targets[i], audio)
+    writer.close()
 
 
 
 
-def runBiLSTM(synth_path, model_folder, output_folder_eval, synth_state, num_mfccs=13, hop_size=1024, note_len=1.0, render_len=1.0):
-    synth = spgl.synth.SynthVST(synth_path,
-                                note_length_secs=note_len, render_length_secs=render_len)
-    synth.load_state(synth_state)
+@instrumentedStage
+def runBiLSTM(synth_path, model_folder, output_folder_eval, synth_state, num_mfccs=13, hop_size=1024, note_len=1.0, render_len=1.0, save_concat=True, precision=None):
+    synth = loadSynth(synth_path, synth_state, note_len=note_len, render_len=render_len)
 
-    bi_lstm = spgl.estimator.TFEstimatorBase.load(os.path.join(model_folder, 'simple_fm_bi_lstm.h5'))
+    bi_lstm = loadModel(model_folder, 'bi_lstm', precision)
 
     # LSTM & LSTM++ feature extractor -- time series of MFCC frames
     lstm_extractor = spgl.features.MFCC(num_mfccs=num_mfccs, time_major=True, hop_size=hop_size, scale=True)
     lstm_extractor.load_scaler(os.path.join(model_folder, 'data_scaler.pkl'))
-    bi_lstm_matcher = spgl.SoundMatch(synth, bi_lstm, lstm_extractor)
-
-    input_folder_audio = os.path.join(output_folder_eval, 'audio')
-    targets = spgl.AudioBuffer.load_folder(os.path.join(output_folder_eval, 'audio'))
-    output_folder_pred = os.path.join(output_folder_eval, 'bi_lstm')
-    output_folder_concat = os.path.join(output_folder_eval, 'bi_lstm_concat')
-    if not os.path.exists(output_folder_concat):
-        os.mkdir(output_folder_concat)
-    for i in range(len(targets)):
-        target_path = os.path.join(input_folder_audio, 'output_%s.wav' % i)
-        est_path = os.path.join(output_folder_pred, 'bi_lstm_prediction_%s.wav' % i)
-        concat_path = os.path.join(output_folder_concat, 'concat_bi_lstm_prediction_%s.wav' % i)
-        audio = bi_lstm_matcher.match(targets[i])
-        audio.save(est_path)
-        estimation = AudioSegment.from_wav(est_path)
-        target = AudioSegment.from_wav(target_path)
-        concat = target + estimation
-        concat.export(concat_path, format="wav")
+    bi_lstm_matcher = spgl.SoundMatch(synth, instrumentedEstimator(bi_lstm, 'bi_lstm'), instrumentedFeatures(lstm_extractor))
 
+    with timed('file_io.load_audio'):
+        targets = spgl.AudioBuffer.load_folder(os.path.join(output_folder_eval, 'audio'))
+    writer = EstimateWriter(output_folder_eval, 'bi_lstm', concat=save_concat)
+    for i in range(len(targets)):
+        with instrumentationTarget(i):
+            audio = bi_lstm_matcher.match(targets[i])
+            writer.write(i, targets[i], audio)
+    writer.close()
+
+
+@instrumentedStage
+def runBatchDL(synth_path, model_folder, output_folder_eval, synth_state, models=['mlp', 'lstm', 'bi_lstm'], num_mfccs=13, hop_size=1024, note_len=1.0, render_len=1.0, num_workers=None, save_concat=True, precision=None):
+    # Runs all the given models over every target in one pass, sharing the
+    # extracted MFCCs and scaler, with one batched prediction per model
+    matcher = BatchMatcher(synth_path, synth_state, model_folder, models=models, num_mfccs=num_mfccs,
+                           hop_size=hop_size, note_len=note_len, render_len=render_len, num_workers=num_workers,
+                           precision=precision)
+
+    with timed('file_io.load_audio'):
+        targets = spgl.AudioBuffer.load_folder(os.path.join(output_folder_eval, 'audio'))
+    results = matcher.match(targets)
+
+    for model_name, (_, estimations) in results.items():
+        writer = EstimateWriter(output_folder_eval, model_name, concat=save_concat)
+        for i in range(len(targets)):
+            writer.write(i, targets[i], estimations[i])
+        writer.close()
@@ -1,14 +1,19 @@
 import spiegelib as spgl
-from pydub import AudioSegment
 import os
+import json
+from synth_config import loadSynth
+from audio_output import EstimateWriter
+from parallel_genetic import ParallelBasicGA, ParallelNSGA3
+from surrogate_genetic import SurrogateGA
+from instrumentation import instrumentedStage, instrumentedFeatures, instrumentationTarget, timed
+import numpy as np
 
-def runGeneticAlgBasic(synth_path, model_folder, output_folder_eval, synth_state, num_mfccs=13, hop_size=1024, note_len=1.0, render_len=1.0, pop_size=300,gen_size=100):
-    synth = spgl.synth.SynthVST(synth_path,
-                                note_length_secs=note_len, render_length_secs=render_len)
-    synth.load_state(synth_state)
+@instrumentedStage
+def runGeneticAlgBasic(synth_path, model_folder, output_folder_eval, synth_state, num_mfccs=13, hop_size=1024, note_len=1.0, render_len=1.0, pop_size=300,gen_size=100, save_concat=True):
+    synth = loadSynth(synth_path, synth_state, note_len=note_len, render_len=render_len)
 
     # MFCC features
-    ga_extractor = spgl.features.MFCC(num_mfccs=num_mfccs, hop_size=hop_size)
+    ga_extractor = instrumentedFeatures(spgl.features.MFCC(num_mfccs=num_mfccs, hop_size=hop_size))
 
     # Basic Genetic Algorithm estimator
     ga = spgl.estimator.BasicGA(synth, ga_extractor, pop_size=pop_size, ngen=gen_size)
@@ -16,33 +21,25 @@ def runGeneticAlgBasic(synth_path, model_folder, output_folder_eval, synth_state
     # Sound matching helper class
     ga_matcher = spgl.SoundMatch(synth, ga)
 
-    input_folder_audio = os.path.join(output_folder_eval, 'audio')
-    targets = spgl.AudioBuffer.load_folder(os.path.join(output_folder_eval, 'audio'))
-    output_folder_pred = os.path.join(output_folder_eval, 'ga')
-    output_folder_concat = os.path.join(output_folder_eval, 'ga_concat')
-    if not os.path.exists(output_folder_concat):
-        os.mkdir(output_folder_concat)
+    with timed('file_io.load_audio'):
+        targets = spgl.AudioBuffer.load_folder(os.path.join(output_folder_eval, 'audio'))
+    writer = EstimateWriter(output_folder_eval, 'ga', concat=save_concat)
     for i in range(len(targets)):
-        target_path = os.path.join(input_folder_audio, 'output_%s.wav' % i)
-        est_path = os.path.join(output_folder_pred, 'ga_prediction_%s.wav' % i)
-        concat_path = os.path.join(output_folder_concat, 'concat_ga_prediction_%s.wav' % i)
-        audio = ga_matcher.match(targets[i])
-        audio.save(est_path)
-        estimation = AudioSegment.from_wav(est_path)
-        target = AudioSegment.from_wav(target_path)
-        concat = target + estimation
-        concat.export(concat_path, format="wav")
-
-
-def runGeneticAlgNSGA(synth_path, model_folder, output_folder_eval, synth_state, num_mfccs=13, hop_size=1024, note_len=1.0, render_len=1.0, pop_size=300,gen_size=100):
-    synth = spgl.synth.SynthVST(synth_path,
-                                note_length_secs=note_len, render_length_secs=render_len)
-    synth.load_state(synth_state)
+        with instrumentationTarget(i):
+            audio = ga_matcher.match(targets[i])
+            writer.write(i, targets[i], audio)
+    writer.close()
+
+
+@instrumentedStage
+def runGeneticAlgNSGA(synth_path, model_folder, output_folder_eval, synth_state, num_mfccs=13, hop_size=1024, note_len=1.0, render_len=1.0, pop_size=300,gen_size=100, save_concat=True):
+    synth = loadSynth(synth_path, synth_state, note_len=note_len, render_len=render_len)
 
     # Feature extractors for Multi-Objective GA
     nsga_extractors = [spgl.features.MFCC(num_mfccs=num_mfccs, hop_size=hop_size),
                     spgl.features.SpectralSummarized(hop_size=hop_size),
                     spgl.features.FFT(output='magnitude')]
+    nsga_extractors = [instrumentedFeatures(extractor) for extractor in nsga_extractors]
 
     # NSGA3 Multi-Objective Genetic Algorithm
     nsga = spgl.estimator.NSGA3(synth, nsga_extractors, pop_size=pop_size, ngen=gen_size)
@@ -50,19 +47,90 @@ def runGeneticAlgNSGA(synth_path, model_folder, output_folder_eval, synth_state,
     # Sound matching helper class
     nsga_matcher = spgl.SoundMatch(synth, nsga)
 
-    input_folder_audio = os.path.join(output_folder_eval, 'audio')
-    targets = spgl.AudioBuffer.load_folder(os.path.join(output_folder_eval, 'audio'))
-    output_folder_pred = os.path.join(output_folder_eval, 'nsga')
-    output_folder_concat = os.path.join(output_folder_eval, 'nsga_concat')
-    if not os.path.exists(output_folder_concat):
-        os.mkdir(output_folder_concat)
+    with timed('file_io.load_audio'):
+        targets = spgl.AudioBuffer.load_folder(os.path.join(output_folder_eval, 'audio'))
+    writer = EstimateWriter(output_folder_eval, 'nsga', concat=save_concat)
     for i in range(len(targets)):
-        target_path = os.path.join(input_folder_audio, 'output_%s.wav' % i)
-        est_path = os.path.join(output_folder_pred, 'nsga_prediction_%s.wav' % i)
-        concat_path = os.path.join(output_folder_concat, 'concat_nsga_prediction_%s.wav' % i)
-        audio = nsga_matcher.match(targets[i])
-        audio.save(est_path)
-        estimation = AudioSegment.from_wav(est_path)
-        target = AudioSegment.from_wav(target_path)
-        concat = target + estimation
-        concat.export(concat_path, format="wav")
+        with instrumentationTarget(i):
+            audio = nsga_matcher.match(targets[i])
+            writer.write(i, targets[i], audio)
+    writer.close()
+
+
+@instrumentedStage
+def runGeneticAlgBasicParallel(synth_path, model_folder, output_folder_eval, synth_state, num_mfccs=13, hop_size=1024, note_len=1.0, render_len=1.0, pop_size=300, gen_size=100, num_workers=None, save_concat=True):
+    # Basic GA with each generation rendered and scored across a process pool
+    ga = ParallelBasicGA(synth_path, synth_state, num_mfccs=num_mfccs, hop_size=hop_size, note_len=note_len,
+                         render_len=render_len, pop_size=pop_size, ngen=gen_size, num_workers=num_workers)
+    ga_matcher = spgl.SoundMatch(ga.synth, ga)
+
+    with timed('file_io.load_audio'):
+        targets = spgl.AudioBuffer.load_folder(os.path.join(output_folder_eval, 'audio'))
+    # The worker pool is closed even if matching or writing fails
+    try:
+        writer = EstimateWriter(output_folder_eval, 'ga', concat=save_concat)
+        for i in range(len(targets)):
+            with instrumentationTarget(i):
+                audio = ga_matcher.match(targets[i])
+                print("Target %d: %.3fs per generation" % (i, np.mean(ga.generation_times)))
+                writer.write(i, targets[i], audio)
+        writer.close()
+        if ga.worker_cache_stats:
+            print("Render cache: %s" % ga.cacheStats())
+    finally:
+        ga.close()
+
+
+@instrumentedStage
+def runGeneticAlgNSGAParallel(synth_path, model_folder, output_folder_eval, synth_state, num_mfccs=13, hop_size=1024, note_len=1.0, render_len=1.0, pop_size=300, gen_size=100, num_workers=None, save_concat=True):
+    # NSGA3 with each generation rendered once per individual and scored on all
+    # three objectives across a process pool
+    nsga = ParallelNSGA3(synth_path, synth_state, num_mfccs=num_mfccs, hop_size=hop_size, note_len=note_len,
+                         render_len=render_len, pop_size=pop_size, ngen=gen_size, num_workers=num_workers)
+    nsga_matcher = spgl.SoundMatch(nsga.synth, nsga)
+
+    with timed('file_io.load_audio'):
+        targets = spgl.AudioBuffer.load_folder(os.path.join(output_folder_eval, 'audio'))
+    # The worker pool is closed even if matching or writing fails
+    try:
+        writer = EstimateWriter(output_folder_eval, 'nsga', concat=save_concat)
+        for i in range(len(targets)):
+            with instrumentationTarget(i):
+                audio = nsga_matcher.match(targets[i])
+                print("Target %d: %.3fs per generation" % (i, np.mean(nsga.generation_times)))
+                writer.write(i, targets[i], audio)
+        writer.close()
+        if nsga.worker_cache_stats:
+            print("Render cache: %s" % nsga.cacheStats())
+    finally:
+        nsga.close()
+
+
+@instrumentedStage
+def runSurrogateGA(synth_path, model_folder, output_folder_eval, synth_state, models=['bi_lstm'], num_mfccs=13, hop_size=1024, note_len=1.0, render_len=1.0, pop_size=100, gen_size=30, num_workers=None, save_concat=True):
+    # GA seeded with the trained networks' predictions (loaded from model_folder)
+    # that only renders the offspring a surrogate ranks as most promising. Renders
+    # per target are saved to surrogate_ga_renders.json.
+    ga = SurrogateGA(synth_path, synth_state, model_folder, models=models, num_mfccs=num_mfccs, hop_size=hop_size,
+                     note_len=note_len, render_len=render_len, pop_size=pop_size, ngen=gen_size,
+                     num_workers=num_workers)
+    ga_matcher = spgl.SoundMatch(ga.synth, ga)
+
+    with timed('file_io.load_audio'):
+        targets = spgl.AudioBuffer.load_folder(os.path.join(output_folder_eval, 'audio'))
+    # The worker pool is closed even if matching or writing fails
+    try:
+        writer = EstimateWriter(output_folder_eval, 'surrogate_ga', concat=save_concat)
+        renders = []
+        for i in range(len(targets)):
+            with instrumentationTarget(i):
+                audio = ga_matcher.match(targets[i])
+                renders.append(ga.renders)
+                print("Target %d: %d renders, %.3fs per generation" % (i, ga.renders, np.mean(ga.generation_times)))
+                writer.write(i, targets[i], audio)
+        writer.close()
+    finally:
+        ga.close()
+
+    with open(os.path.join(output_folder_eval, 'surrogate_ga_renders.json'), 'w') as f:
+        json.dump({'renders': renders, 'mean': float(np.mean(renders))}, f, indent=4)
@@ -0,0 +1,33 @@
+import spiegelib as spgl
+import numpy as np
+import json
+import os
+from synth_config import loadSynth, renderPatches
+from audio_output import EstimateWriter
+from patch_index import PatchIndex, KNNEstimator
+from instrumentation import instrumentedStage, timed
+
+@instrumentedStage
+def runKNN(synth_path, index_folder, output_folder_eval, synth_state, k=5, n_probe=None, refine_steps=0,
+           refine_batch=32, note_len=1.0, render_len=1.0, seed=0, save_concat=True):
+    # Matches every target with the nearest patch in a PatchIndex (see
+    # buildPatchIndex), optionally refined with a short local search. The
+    # matched patches are also saved to knn_patches.json, e.g. to seed a GA.
+    synth = loadSynth(synth_path, synth_state, note_len=note_len, render_len=render_len)
+    with timed('file_io.load_index'):
+        index = PatchIndex(index_folder)
+    knn = KNNEstimator(index, synth=synth, k=k, n_probe=n_probe, refine_steps=refine_steps,
+                       refine_batch=refine_batch, seed=seed)
+
+    with timed('file_io.load_audio'):
+        targets = spgl.AudioBuffer.load_folder(os.path.join(output_folder_eval, 'audio'))
+    patches = knn.predict(knn.extract(targets))
+    audio = np.concatenate(list(renderPatches(synth, patches)))
+
+    writer = EstimateWriter(output_folder_eval, 'knn', concat=save_concat)
+    for i in range(len(targets)):
+        writer.write(i, targets[i], spgl.AudioBuffer(audio[i], synth.sample_rate))
+    writer.close()
+
+    with open(os.path.join(output_folder_eval, 'knn_patches.json'), 'w') as f:
+        json.dump(patches.tolist(), f)
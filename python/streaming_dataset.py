@@ -0,0 +1,232 @@
+import numpy as np
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataset_generation import _initWorker, _generateShard, _planShards
+from chunked_dataset import ChunkedDataset, ChunkedDatasetWriter
+from render_cache import renderCacheConfig
+from instrumentation import timed, instrumentationConfig, mergeWorkerInstrumentation
+
+
+class _Producer():
+    """
+    Renders train and test shards in a process pool and scales them in a
+    background thread. The scaler is fit on the first warmup_size training
+    samples. Training batches go into a bounded queue for the first epoch,
+    and both splits are written as chunked datasets for the later epochs
+    and the other models. close() stops it early, e.g. when training fails.
+    """
+
+    def __init__(self, synth_path, output_folder, synth_state, features, train_size, test_size, note_len,
+                 render_len, num_workers, shard_size, seed, batch_size, warmup_size, max_queued_batches,
+                 max_pending_shards):
+        self.output_folder = output_folder
+        self.features = features
+        self.batch_size = batch_size
+        self.num_workers = num_workers or os.cpu_count()
+        self.max_pending_shards = max_pending_shards or 2 * self.num_workers
+        self.pool_args = (synth_path, synth_state, features, note_len, render_len, renderCacheConfig(),
+                          instrumentationConfig())
+        self.batches = queue.Queue(maxsize=max_queued_batches)
+        self.ready = threading.Event()
+        self.finished = threading.Event()
+        self.stopping = threading.Event()
+        self.error = None
+
+        # Same shard layout and seeds as generateDatasetParallel, so shards are
+        # shared with (and resumed from) non streaming runs
+        self.shard_folder = os.path.join(output_folder, 'shards')
+        os.makedirs(self.shard_folder, exist_ok=True)
+        train = [('train_', s) for s in _planShards(self.shard_folder, 'train_', train_size, shard_size, seed)]
+        test = [('test_', s) for s in _planShards(self.shard_folder, 'test_', test_size, shard_size, seed + 1)]
+
+        # Warm-up shards come first, the rest of the test shards are spread
+        # between the training shards so both splits finish around the same time
+        num_warmup = min(len(train), -(-warmup_size // shard_size))
+        self.num_warmup = num_warmup
+        rest = train[num_warmup:] + test
+        position = [i / max(1, len(train) - num_warmup) for i in range(len(train) - num_warmup)] + \
+                   [i / max(1, len(test)) for i in range(len(test))]
+        self.schedule = train[:num_warmup] + [rest[i] for i in np.argsort(position, kind='stable')]
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        # Stops rendering and waits for the pool to shut down. Shards already
+        # written are kept and resumed by the next run.
+        self.stopping.set()
+        self.thread.join()
+
+    def _put(self, item):
+        # Blocks while the queue is full, returns False once close() is called
+        while not self.stopping.is_set():
+            try:
+                self.batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _stop(self, pool):
+        # Shards that haven't started are dropped, running ones still finish
+        pool.shutdown(cancel_futures=True)
+        self.error = RuntimeError("Stopped before the dataset was complete")
+
+    def _paths(self, shard):
+        prefix = os.path.join(self.shard_folder, shard['prefix'])
+        return prefix + 'features.npy', prefix + 'patches.npy'
+
+    def _shards(self, pool):
+        # Yields (file_prefix, features, patches) per shard in schedule order.
+        # At most max_pending_shards are rendering or waiting to be consumed,
+        # so a slow consumer stalls the workers instead of piling up shards.
+        pending = deque()
+        upcoming = iter(self.schedule)
+        while True:
+            while len(pending) < self.max_pending_shards:
+                item = next(upcoming, None)
+                if item is None:
+                    break
+                file_prefix, shard = item
+                features_path, patches_path = self._paths(shard)
+                future = None
+                if not (os.path.exists(features_path) and os.path.exists(patches_path)):
+                    future = pool.submit(_generateShard, os.path.join(self.shard_folder, shard['prefix']),
+                                         shard['size'], shard['seed'])
+                pending.append((file_prefix, shard, future))
+            if not pending:
+                return
+
+            file_prefix, shard, future = pending.popleft()
+            if future is not None:
+                mergeWorkerInstrumentation(future.result()[1])
+            features_path, patches_path = self._paths(shard)
+            yield file_prefix, np.load(features_path), np.load(patches_path)
+
+    def _run(self):
+        try:
+            writers = {prefix: ChunkedDatasetWriter(self.output_folder, prefix, scaler='data_scaler.pkl')
+                       for prefix in ('train_', 'test_')}
+            leftover = None
+            # Spawned workers, forking after TensorFlow has started its thread
+            # pools (training runs on the main thread) can deadlock
+            with ProcessPoolExecutor(max_workers=self.num_workers, mp_context=multiprocessing.get_context('spawn'),
+                                     initializer=_initWorker, initargs=self.pool_args) as pool:
+                shards = self._shards(pool)
+
+                # Scaler fit on the warm-up prefix of the training set
+                warmup = [next(shards) for _ in range(self.num_warmup)]
+                with timed('fit_scaler'):
+                    self.features.fit_scaler(np.concatenate([features for _, features, _ in warmup]), transform=False)
+                self.features.save_scaler(os.path.join(self.output_folder, 'data_scaler.pkl'))
+                self.features_shape = warmup[0][1].shape[1:]
+                self.features_dtype = self.features.scale(warmup[0][1][:1]).dtype
+                self.patches_dtype = warmup[0][2].dtype
+                self.num_params = warmup[0][2].shape[-1]
+                self.ready.set()
+
+                for file_prefix, features, patches in itertools.chain(warmup, shards):
+                    if self.stopping.is_set():
+                        return self._stop(pool)
+                    features = self.features.scale(features)
+                    writers[file_prefix].append(features, patches)
+                    if file_prefix != 'train_':
+                        continue
+                    if leftover is not None:
+                        features = np.concatenate([leftover[0], features])
+                        patches = np.concatenate([leftover[1], patches])
+                    end = len(features) - len(features) % self.batch_size
+                    for start in range(0, end, self.batch_size):
+                        if not self._put((features[start:start + self.batch_size],
+                                          patches[start:start + self.batch_size])):
+                            return self._stop(pool)
+                    leftover = (features[end:], patches[end:]) if end < len(features) else None
+
+            if leftover is not None:
+                self._put(leftover)
+            for writer in writers.values():
+                writer.close()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.ready.set()
+            self.finished.set()
+            self._put(None)
+
+    def check(self):
+        if self.error is not None:
+            raise RuntimeError("Streaming dataset generation failed") from self.error
+
+
+class StreamingSplit():
+    """
+    One split of a streamed dataset, with the same interface as a
+    ChunkedDataset so it can be passed straight to the trainers. The first
+    pass over the training split consumes batches as they are rendered
+    (shards are already i.i.d. random patches, so they are not shuffled
+    across shards); later passes, and every pass over the test split, read
+    the chunked dataset written alongside once it is complete.
+    """
+
+    def __init__(self, producer, file_prefix, num_samples):
+        self.producer = producer
+        self.file_prefix = file_prefix
+        self.num_samples = num_samples
+        self.features_shape = producer.features_shape
+        self.features_dtype = producer.features_dtype
+        self.patches_dtype = producer.patches_dtype
+        self.num_params = producer.num_params
+        self.streamed = file_prefix != 'train_'
+        self.stored = None
+
+    def __len__(self):
+        return self.num_samples
+
+    def batches(self, batch_size=64, shuffle=True, seed=None):
+        if not self.streamed:
+            if batch_size != self.producer.batch_size:
+                raise ValueError("The streamed pass uses batch_size=%d" % self.producer.batch_size)
+            self.streamed = True
+            yield from self._stream()
+            return
+
+        if self.stored is None:
+            self.producer.finished.wait()
+            self.producer.check()
+            self.stored = ChunkedDataset(self.producer.output_folder, self.file_prefix)
+        yield from self.stored.batches(batch_size, shuffle=shuffle, seed=seed)
+
+    def _stream(self):
+        while True:
+            with timed('wait_for_batch'):
+                batch = self.producer.batches.get()
+            if batch is None:
+                self.producer.check()
+                return
+            yield batch
+
+
+def generateDatasetStreaming(synth_path, output_folder, synth_state, features, train_size=10000, test_size=1000,
+                             note_len=1.0, render_len=1.0, num_workers=None, shard_size=1000, seed=0,
+                             batch_size=64, warmup_size=2000, max_queued_batches=64, max_pending_shards=None):
+    # Starts rendering in the background and returns (train, test) splits to
+    # train on right away, e.g. trainBiLSTM(output_folder, train_data=train,
+    # test_data=test). Blocks only until the warm-up shards are rendered and the
+    # scaler is fit. Beyond the shard files, memory in flight is bounded by
+    # max_queued_batches * batch_size samples, the shard being scaled and one
+    # shard per rendering worker. When it is done the folder holds the same
+    # chunked dataset, shards and data_scaler.pkl as generateDatasetParallel
+    # with output_format='chunked', except the scaler is fit on the warm-up
+    # samples only.
+    os.makedirs(output_folder, exist_ok=True)
+    producer = _Producer(synth_path, output_folder, synth_state, features, train_size, test_size, note_len,
+                         render_len, num_workers, shard_size, seed, batch_size, warmup_size, max_queued_batches,
+                         max_pending_shards)
+    producer.ready.wait()
+    producer.check()
+    return StreamingSplit(producer, 'train_', train_size), StreamingSplit(producer, 'test_', test_size)
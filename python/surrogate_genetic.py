@@ -0,0 +1,103 @@
+import numpy as np
+from deap import tools, algorithms
+from parallel_genetic import ParallelGABase, registerNSGA3
+from batch_matching import BatchMatcher
+
+
+def idwPredict(archive_patches, archive_errors, candidates, k=8):
+    # Inverse distance weighted k nearest neighbour estimate of the error of each
+    # candidate from the patches rendered so far
+    k = min(k, len(archive_patches))
+    distances = np.sqrt(((candidates[:, np.newaxis, :] - archive_patches[np.newaxis, :, :]) ** 2).sum(axis=-1))
+    nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    nearest_distances = np.take_along_axis(distances, nearest, axis=1)
+    weights = 1.0 / (nearest_distances + 1e-9)
+    return (weights * archive_errors[nearest]).sum(axis=1) / weights.sum(axis=1)
+
+
+class SurrogateGA(ParallelGABase):
+    """
+    Genetic sound matching warm started and filtered with cheap estimates. The
+    initial population holds the trained networks' predictions for the target
+    and mutations around them, the rest is random. Each generation breeds
+    candidate_factor * pop_size offspring, ranks them with a nearest neighbour
+    surrogate fitted on every render made for the target so far, and renders
+    only render_fraction * pop_size of them: mostly the best ranked, plus
+    explore_fraction picked at random. Survivors are picked from parents and
+    rendered offspring together. `renders` holds the render count
+    for the last target.
+    """
+
+    def __init__(self, synth_path, synth_state, model_folder, models=['bi_lstm'], objectives=['mfcc'], num_mfccs=13,
+                 hop_size=1024, note_len=1.0, render_len=1.0, seed_fraction=0.25, seed_sigma=0.05,
+                 candidate_factor=3, render_fraction=0.5, explore_fraction=0.25, surrogate_k=8, **kwargs):
+        kwargs.setdefault('cxpb', 1.0)
+        kwargs.setdefault('mutpb', 1.0)
+        super().__init__(synth_path, synth_state, objectives, num_mfccs=num_mfccs, hop_size=hop_size,
+                         note_len=note_len, render_len=render_len, **kwargs)
+        self.matcher = BatchMatcher(synth_path, synth_state, model_folder, models=models, num_mfccs=num_mfccs,
+                                    hop_size=hop_size, note_len=note_len, render_len=render_len)
+        self.seed_fraction = seed_fraction
+        self.seed_sigma = seed_sigma
+        self.candidate_factor = candidate_factor
+        self.render_fraction = render_fraction
+        self.explore_fraction = explore_fraction
+        self.surrogate_k = surrogate_k
+        self.rng = np.random.default_rng(kwargs.get('seed'))
+        self.archive_patches = []
+        self.archive_errors = []
+
+        # Real valued SBX and polynomial mutation as in NSGA3 for every objective
+        # count, BasicGA's bit flips would throw the seeded patches away
+        registerNSGA3(self.toolbox, len(objectives), self.num_params)
+        if len(objectives) > 1:
+            self.toolbox.register('parents', tools.selRandom)
+        else:
+            self.toolbox.register('select', tools.selBest)
+            self.toolbox.register('parents', tools.selTournament, tournsize=3)
+
+    def initial_population(self, target):
+        self.archive_patches = []
+        self.archive_errors = []
+
+        predictions = self.matcher.predict(self.matcher.extract([target]))
+        seeds = np.concatenate(list(predictions.values()))
+        num_seeded = min(self.pop_size, max(len(seeds), int(self.pop_size * self.seed_fraction)))
+        seeds = seeds[:num_seeded]
+        around = seeds[np.arange(num_seeded - len(seeds)) % len(seeds)]
+        around = np.clip(around + self.rng.normal(0.0, self.seed_sigma, around.shape), 0.0, 1.0)
+
+        population = self.toolbox.population(n=self.pop_size - num_seeded)
+        for patch in np.concatenate([seeds, around]):
+            population.append(self.toolbox.individual())
+            population[-1][:] = list(patch)
+        return population
+
+    def evaluate_population(self, individuals):
+        super().evaluate_population(individuals)
+        for individual in individuals:
+            self.archive_patches.append(list(individual))
+            self.archive_errors.append(individual.fitness.values[0])
+
+    def next_generation(self, population):
+        num_candidates = self.pop_size * self.candidate_factor
+        candidates = []
+        while len(candidates) < num_candidates:
+            parents = self.toolbox.parents(population, len(population))
+            offspring = algorithms.varAnd(parents, self.toolbox, self.cxpb, self.mutpb)
+            candidates.extend(ind for ind in offspring if not ind.fitness.valid)
+        candidates = candidates[:num_candidates]
+
+        estimates = idwPredict(np.array(self.archive_patches), np.array(self.archive_errors),
+                               np.array(candidates), k=self.surrogate_k)
+        # Only the candidates the surrogate rates best are rendered, plus a few
+        # picked at random so a misleading surrogate can't stall the search
+        num_render = max(1, int(self.pop_size * self.render_fraction))
+        num_explore = int(num_render * self.explore_fraction)
+        ranked = np.argsort(estimates)
+        chosen = list(ranked[:num_render - num_explore])
+        chosen.extend(self.rng.choice(ranked[num_render - num_explore:], num_explore, replace=False))
+        screened = [candidates[i] for i in chosen]
+        self.evaluate_population(screened)
+        return self.toolbox.select(population + screened, self.pop_size)
+
@@ -1,7 +1,12 @@
 import spiegelib as spgl
+import numpy as np
+from fm_synth import SimpleFMSynth, SIMPLE_FM_SYNTH
+from render_cache import cachedSynth, getRenderCache
+from param_space import loadParamSpace
+from instrumentation import instrumentedSynth
 
 def configWTSynth(synth_path, synth_state):
-    synth = spgl.synth.SynthVST(synth_path, note_length_secs=1.0, render_length_secs=1.0)
+    synth = createSynth(synth_path)
 
     # turn off LFO and misc unneeded params
     overridden_parameters = [
@@ -21,10 +26,11 @@ def configWTSynth(synth_path, synth_state):
     # Set overridden parameters in synth
     synth.set_overridden_parameters(overridden_parameters)
     synth.save_state(synth_state)
+    loadParamSpace(synth_state)
 
 
 def configDexed(synth_path, synth_state):
-    synth = spgl.synth.SynthVST(synth_path, note_length_secs=1.0, render_length_secs=1.0)
+    synth = createSynth(synth_path)
 
     # The algorithm sets the arrangement of the FM operators. 
     # There are 32 differen arrangements available in Dexed.
@@ -102,3 +108,38 @@ def configDexed(synth_path, synth_state):
     # Set overridden parameters in synth
     synth.set_overridden_parameters(overridden_parameters)
     synth.save_state(synth_state)
+    loadParamSpace(synth_state)
+
+
+def createSynth(synth_path, note_len=1.0, render_len=1.0):
+    # SIMPLE_FM_SYNTH selects the built in NumPy FM synth, anything else is a VST path
+    if synth_path == SIMPLE_FM_SYNTH:
+        return SimpleFMSynth(note_length_secs=note_len, render_length_secs=render_len)
+    return spgl.synth.SynthVST(synth_path, note_length_secs=note_len, render_length_secs=render_len)
+
+def loadSynth(synth_path, synth_state, note_len=1.0, render_len=1.0):
+    synth = createSynth(synth_path, note_len=note_len, render_len=render_len)
+    synth.load_state(synth_state)
+    # Compiled state for converting and applying whole patches, see ParamSpace
+    synth.param_space = loadParamSpace(synth_state)
+
+    # Serve renders from the cache if one was set up with configureRenderCache
+    cache = getRenderCache(synth_state, note_len, render_len)
+    if cache is not None:
+        synth = cachedSynth(synth, cache)
+    return instrumentedSynth(synth)
+
+def renderPatches(synth, patch_set, batch_size=64):
+    # Yields (batch, samples) blocks of audio for a (patches, free parameters)
+    # array. Synths with a batch renderer render a whole block per call.
+    for start in range(0, len(patch_set), batch_size):
+        block = patch_set[start:start + batch_size]
+        if hasattr(synth, 'render_batch'):
+            yield synth.render_batch(block)
+        else:
+            audio = []
+            for patch in block:
+                synth.param_space.apply(synth, patch)
+                synth.render_patch()
+                audio.append(synth.get_audio().get_audio())
+            yield np.stack(audio)
@@ -0,0 +1,48 @@
+import os
+import sys
+import pytest
+
+# The modules in python/ import each other by name, as they do when run from there
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# spiegelib's TFEstimatorBase.load reads layer.input_shape, which only the
+# Keras 2 API (tf_keras) still has
+os.environ.setdefault('TF_USE_LEGACY_KERAS', '1')
+
+SYNTH_PATH = "simple_fm"
+
+# Sound length the saved_models/ networks were trained on
+EVAL_LENGTHS = dict(note_len=1.0, render_len=1.0)
+SAVED_MODELS = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                            'saved_models')
+
+
+@pytest.fixture(scope='session')
+def synth_state(tmp_path_factory):
+    # Dexed style state for the built in FM synth, as configDexed writes it
+    from synth_config import configDexed
+    path = str(tmp_path_factory.mktemp('synth') / 'modified_param_space.json')
+    configDexed(SYNTH_PATH, path)
+    return path
+
+
+@pytest.fixture(scope='session')
+def eval_folder(tmp_path_factory, synth_state):
+    # A few targets in the layout generateEval writes (audio/ plus features)
+    from dataset_generation import generateEval, initMFCCFeatures
+    folder = str(tmp_path_factory.mktemp('eval'))
+    generateEval(SYNTH_PATH, folder, synth_state, initMFCCFeatures(), num_samples=2, **EVAL_LENGTHS)
+    return folder
+
+
+@pytest.fixture(scope='session')
+def model_folder(tmp_path_factory, synth_state):
+    # The saved networks with a data_scaler.pkl fit on a small dataset, the
+    # scaler they were trained with is not in the repo
+    from dataset_generation import generateDatasetParallel, initMFCCFeatures
+    folder = tmp_path_factory.mktemp('models')
+    generateDatasetParallel(SYNTH_PATH, str(folder), synth_state, initMFCCFeatures(), train_size=40, test_size=10,
+                            shard_size=20, num_workers=2, **EVAL_LENGTHS)
+    for name in os.listdir(SAVED_MODELS):
+        os.symlink(os.path.join(SAVED_MODELS, name), str(folder / name))
+    return str(folder)
@@ -0,0 +1,41 @@
+import io
+import os
+import numpy as np
+import scipy.io.wavfile
+import spiegelib as spgl
+from audio_output import wavBytes, EstimateWriter
+
+
+def _audio(num_samples=1000, seed=0):
+    return np.random.default_rng(seed).uniform(-1.0, 1.0, num_samples).astype(np.float32)
+
+
+def test_wav_bytes_match_scipy(tmp_path):
+    audio = _audio()
+    data = wavBytes(audio, 44100)
+    sample_rate, read = scipy.io.wavfile.read(io.BytesIO(data))
+    assert sample_rate == 44100 and read.dtype == np.float32
+    np.testing.assert_array_equal(read, audio)
+
+    # Byte for byte what AudioBuffer.save (scipy.io.wavfile.write) produces
+    path = str(tmp_path / 'saved.wav')
+    spgl.AudioBuffer(audio, 44100).save(path)
+    with open(path, 'rb') as f:
+        assert f.read() == data
+
+
+def test_estimate_writer(tmp_path):
+    targets = [spgl.AudioBuffer(_audio(seed=i), 44100) for i in range(3)]
+    estimates = [spgl.AudioBuffer(_audio(seed=10 + i), 44100) for i in range(3)]
+    for background in (True, False):
+        folder = str(tmp_path / str(background))
+        writer = EstimateWriter(folder, 'mlp', background=background)
+        for i in range(3):
+            writer.write(i, targets[i], estimates[i])
+        writer.close()
+
+        for i in range(3):
+            _, estimate = scipy.io.wavfile.read(os.path.join(folder, 'mlp', 'mlp_prediction_%d.wav' % i))
+            _, concat = scipy.io.wavfile.read(os.path.join(folder, 'mlp_concat', 'concat_mlp_prediction_%d.wav' % i))
+            np.testing.assert_array_equal(estimate, estimates[i].get_audio())
+            np.testing.assert_array_equal(concat, np.concatenate([targets[i].get_audio(), estimates[i].get_audio()]))
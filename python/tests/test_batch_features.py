@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+import spiegelib as spgl
+from batch_features import batchFeaturesFor, extractBatch
+from synth_config import loadSynth, renderPatches
+from conftest import SYNTH_PATH
+
+
+@pytest.fixture(scope='module')
+def audio(synth_state):
+    synth = loadSynth(SYNTH_PATH, synth_state, note_len=0.25, render_len=0.5)
+    patches = np.random.default_rng(0).uniform(0.0, 1.0, (4, synth.param_space.num_free))
+    return np.concatenate(list(renderPatches(synth, patches)))
+
+
+def _expected(features, audio, scale=None):
+    return np.stack([features(spgl.AudioBuffer(a, 44100), scale=scale) for a in audio])
+
+
+@pytest.mark.parametrize('features', [
+    spgl.features.MFCC(num_mfccs=13, hop_size=1024, time_major=True),
+    spgl.features.MFCC(num_mfccs=20, frame_size=1024, hop_size=256, time_major=False),
+    spgl.features.STFT(fft_size=2048, hop_size=1024, output='magnitude', time_major=True),
+    spgl.features.STFT(fft_size=512, hop_size=256, output='power_phase', time_major=False),
+    spgl.features.STFT(fft_size=1024, hop_size=512),
+])
+def test_matches_spiegelib(features, audio):
+    batch = batchFeaturesFor(features)(audio, 44100)
+    expected = _expected(features, audio)
+    assert batch.shape == expected.shape
+    assert batch.dtype == expected.dtype
+    scale = np.abs(expected).max()
+    np.testing.assert_allclose(batch, expected, rtol=1e-3, atol=1e-3 * scale)
+
+
+def test_scaler_and_modifiers(audio, tmp_path):
+    features = spgl.features.MFCC(num_mfccs=13, hop_size=1024, time_major=True, scale=True)
+    features.add_modifier(lambda data: data[:, :5], type='prescale')
+    features.fit_scaler(_expected(features, audio, scale=False), transform=False)
+    features.save_scaler(str(tmp_path / 'data_scaler.pkl'))
+    features.add_modifier(lambda data: data.flatten(), type='output')
+
+    expected = _expected(features, audio)
+    assert expected.shape == (len(audio), 22 * 5)
+    np.testing.assert_allclose(extractBatch(features, audio, 44100), expected, rtol=1e-3, atol=1e-3)
+
+    loaded = batchFeaturesFor(spgl.features.MFCC(num_mfccs=13, hop_size=1024, time_major=True, scale=True))
+    loaded.load_scaler(str(tmp_path / 'data_scaler.pkl'))
+    assert loaded.should_scale and loaded.has_scaler()
+    raw = extractBatch(features, audio, 44100, scale=False)
+    assert raw.shape == expected.shape and not np.allclose(raw, expected)
+
+
+def test_input_modifiers_use_spiegelib(audio):
+    features = spgl.features.MFCC(num_mfccs=13, hop_size=1024, time_major=True)
+    features.add_modifier(lambda buffer: spgl.AudioBuffer(buffer.get_audio() * 0.5, 44100), type='input')
+    assert batchFeaturesFor(features) is None
+    np.testing.assert_array_equal(extractBatch(features, audio, 44100), _expected(features, audio))
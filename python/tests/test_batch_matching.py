@@ -0,0 +1,35 @@
+import os
+import numpy as np
+import spiegelib as spgl
+from batch_matching import BatchMatcher, loadModel
+from sound_match_dl import runBatchDL
+from conftest import SYNTH_PATH, EVAL_LENGTHS
+
+MODELS = ['mlp', 'lstm', 'bi_lstm']
+
+
+def _targets(eval_folder):
+    return spgl.AudioBuffer.load_folder(os.path.join(eval_folder, 'audio'))
+
+
+def test_matches_single_predictions(synth_state, model_folder, eval_folder):
+    matcher = BatchMatcher(SYNTH_PATH, synth_state, model_folder, models=MODELS, **EVAL_LENGTHS)
+    targets = _targets(eval_folder)
+    predictions = matcher.predict(matcher.extract(targets))
+
+    # Same as the per target spiegelib pipeline in runMLP/runLSTM/runBiLSTM
+    extractor = spgl.features.MFCC(num_mfccs=13, time_major=True, hop_size=1024, scale=True)
+    extractor.load_scaler(os.path.join(model_folder, 'data_scaler.pkl'))
+    for name in MODELS:
+        model = loadModel(model_folder, name)
+        for target, patch in zip(targets, predictions[name]):
+            features = extractor(target)
+            expected = model.predict(features.flatten() if name == 'mlp' else features)
+            np.testing.assert_allclose(patch, np.clip(np.reshape(expected, -1), 0.0, 1.0), atol=1e-4)
+
+
+def test_run_batch_dl(synth_state, model_folder, eval_folder):
+    runBatchDL(SYNTH_PATH, model_folder, eval_folder, synth_state, models=MODELS, **EVAL_LENGTHS)
+    for name in MODELS:
+        files = sorted(os.listdir(os.path.join(eval_folder, name)))
+        assert files == ['%s_prediction_%d.wav' % (name, i) for i in range(len(_targets(eval_folder)))]
@@ -0,0 +1,31 @@
+import pytest
+import benchmark
+
+
+def _run(samples_per_sec, peak_rss_mb):
+    return {'results': {'small': {'generate_eval': {'samples_per_sec': samples_per_sec,
+                                                     'peak_rss_mb': peak_rss_mb}}}}
+
+
+def test_regressions_against_baseline(tmp_path):
+    folder = str(tmp_path)
+    assert benchmark.findRegressions(_run(10.0, 100.0), folder) == []
+
+    benchmark.saveBaseline(_run(10.0, 100.0), folder)
+    assert benchmark.findRegressions(_run(9.0, 110.0), folder, tolerance=0.15) == []
+    regressions = benchmark.findRegressions(_run(5.0, 200.0), folder, tolerance=0.15)
+    assert len(regressions) == 2
+    assert all(r.startswith('generate_eval (small)') for r in regressions)
+
+
+def test_stage_runs_in_spawned_process(tmp_path):
+    result = benchmark.benchmarkStage('generate_eval', str(tmp_path), 'small')
+    assert result['samples'] == benchmark.SIZES['small']['eval_samples']
+    assert result['wall_secs'] > 0 and result['samples_per_sec'] > 0 and result['peak_rss_mb'] > 0
+    assert len(list((tmp_path / 'evaluation' / 'audio').iterdir())) == result['samples']
+
+
+def test_failed_stage_raises(tmp_path):
+    # The child raises before putting a result, the parent must not wait forever
+    with pytest.raises(RuntimeError):
+        benchmark.benchmarkStage('unknown', str(tmp_path), 'small')
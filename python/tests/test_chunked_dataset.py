@@ -0,0 +1,27 @@
+import numpy as np
+from chunked_dataset import ChunkedDataset, ChunkedDatasetWriter
+
+
+def test_batches_round_trip(tmp_path):
+    rng = np.random.default_rng(0)
+    features = rng.normal(size=(150, 4, 3)).astype(np.float32)
+    patches = rng.uniform(size=(150, 5)).astype(np.float32)
+    writer = ChunkedDatasetWriter(str(tmp_path), 'train_')
+    for start in range(0, 150, 70):
+        writer.append(features[start:start + 70], patches[start:start + 70])
+    writer.close()
+
+    dataset = ChunkedDataset(str(tmp_path), 'train_')
+    assert len(dataset) == 150 and dataset.features_shape == (4, 3) and dataset.num_params == 5
+
+    # Default batch size is spiegelib's TFEstimatorBase default of 64
+    batches = list(dataset.batches(shuffle=False))
+    assert [len(b[0]) for b in batches] == [64, 64, 22]
+    np.testing.assert_array_equal(np.concatenate([b[0] for b in batches]), features)
+    np.testing.assert_array_equal(np.concatenate([b[1] for b in batches]), patches)
+
+    # A shuffled pass still holds every sample once, with features and patches kept together
+    shuffled = list(dataset.batches(32, seed=1))
+    order = np.argsort(np.concatenate([b[1][:, 0] for b in shuffled]))
+    np.testing.assert_array_equal(np.concatenate([b[0] for b in shuffled])[order],
+                                  features[np.argsort(patches[:, 0])])
@@ -0,0 +1,79 @@
+import numpy as np
+import os
+import pytest
+from conftest import SYNTH_PATH
+from dataset_generation import initMFCCFeatures, generateDatasetParallel
+from chunked_dataset import ChunkedDataset
+
+SIZES = dict(train_size=50, test_size=20, shard_size=20, render_len=0.5, note_len=0.25)
+
+
+def _generate(folder, synth_state, **kwargs):
+    features = initMFCCFeatures(num_mfccs=13, frame_size=1024, hop_size=512)
+    generateDatasetParallel(SYNTH_PATH, str(folder), synth_state, features, **dict(SIZES, **kwargs))
+
+def _load(folder, prefix):
+    return np.load(os.path.join(folder, prefix + 'features.npy')), np.load(os.path.join(folder, prefix + 'patches.npy'))
+
+
+def test_worker_count_does_not_change_the_dataset(tmp_path, synth_state):
+    _generate(tmp_path / 'one', synth_state, num_workers=1)
+    _generate(tmp_path / 'three', synth_state, num_workers=3)
+    for prefix in ('train_', 'test_'):
+        for a, b in zip(_load(tmp_path / 'one', prefix), _load(tmp_path / 'three', prefix)):
+            np.testing.assert_array_equal(a, b)
+
+def test_resume_after_lost_shards(tmp_path, synth_state):
+    folder = tmp_path / 'run'
+    _generate(folder, synth_state, num_workers=2)
+    expected = [_load(folder, prefix) for prefix in ('train_', 'test_')]
+
+    # As if the run had crashed part way: some shards and the merged files are missing
+    shard_folder = folder / 'shards'
+    os.remove(shard_folder / 'train_shard_00001_features.npy')
+    os.remove(shard_folder / 'test_shard_00000_patches.npy')
+    os.remove(folder / 'train_features.npy')
+    kept = os.path.getmtime(shard_folder / 'train_shard_00000_features.npy')
+    _generate(folder, synth_state, num_workers=2)
+
+    assert os.path.getmtime(shard_folder / 'train_shard_00000_features.npy') == kept
+    for prefix, (features, patches) in zip(('train_', 'test_'), expected):
+        resumed_features, resumed_patches = _load(folder, prefix)
+        np.testing.assert_array_equal(resumed_features, features)
+        np.testing.assert_array_equal(resumed_patches, patches)
+
+def test_merged_dataset_matches_shards(tmp_path, synth_state):
+    folder = tmp_path / 'run'
+    _generate(folder, synth_state, num_workers=2)
+    features, patches = _load(folder, 'train_')
+    assert features.shape[0] == patches.shape[0] == SIZES['train_size']
+
+    # The merged set is the shards in order, scaled with the saved scaler
+    shards = sorted(name for name in os.listdir(folder / 'shards') if name.startswith('train_shard'))
+    raw = np.concatenate([np.load(folder / 'shards' / n) for n in shards if n.endswith('features.npy')])
+    extractor = initMFCCFeatures()
+    extractor.load_scaler(os.path.join(folder, 'data_scaler.pkl'))
+    np.testing.assert_allclose(features, extractor.scale(raw), rtol=1e-5, atol=1e-5)
+
+    # The chunked format holds the same data
+    _generate(tmp_path / 'chunked', synth_state, num_workers=2, output_format='chunked')
+    chunked = ChunkedDataset(str(tmp_path / 'chunked'), 'train_')
+    merged = list(chunked.batches(SIZES['train_size'], shuffle=False))
+    np.testing.assert_allclose(merged[0][0], features, rtol=1e-6)
+    np.testing.assert_array_equal(merged[0][1], patches)
+
+def test_changed_layout_is_refused(tmp_path, synth_state):
+    folder = tmp_path / 'run'
+    _generate(folder, synth_state, num_workers=1)
+    with pytest.raises(ValueError):
+        _generate(folder, synth_state, num_workers=1, shard_size=10)
+
+def test_scaler_is_fit_on_a_prefix_of_the_training_set(tmp_path, synth_state):
+    folder = tmp_path / 'run'
+    _generate(folder, synth_state, num_workers=2, scaler_fit_size=25)
+    raw = np.concatenate([np.load(folder / 'shards' / ('train_shard_%05d_features.npy' % i)) for i in range(2)])
+    expected = initMFCCFeatures()
+    expected.fit_scaler(raw[:25], transform=False)
+
+    features, _ = _load(folder, 'train_')
+    np.testing.assert_allclose(features[:20], expected.scale(raw[:20]), rtol=1e-5, atol=1e-5)
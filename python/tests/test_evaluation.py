@@ -0,0 +1,94 @@
+import json
+import os
+import shutil
+import numpy as np
+import spiegelib as spgl
+from evaluation import METRICS, evaluate, evaluateIncremental, _scoreModel
+
+MODELS = ['mlp', 'ga']
+
+
+def _makeEval(folder, eval_folder):
+    # Estimates are the targets with a different amount of noise per model
+    shutil.copytree(os.path.join(eval_folder, 'audio'), os.path.join(folder, 'audio'))
+    targets = spgl.AudioBuffer.load_folder(os.path.join(folder, 'audio'))
+    rng = np.random.default_rng(0)
+    for j, model in enumerate(MODELS):
+        os.makedirs(os.path.join(folder, model))
+        for i, target in enumerate(targets):
+            audio = target.get_audio() + rng.normal(0.0, 0.01 * (j + 1), len(target.get_audio()))
+            spgl.AudioBuffer(audio.astype(np.float32), 44100).save(
+                os.path.join(folder, model, '%s_prediction_%d.wav' % (model, i)))
+
+def _load(folder, name):
+    with open(os.path.join(folder, name), 'r') as f:
+        return json.load(f)
+
+def _assertClose(a, b):
+    assert type(a) == type(b)
+    if isinstance(a, dict):
+        assert sorted(a) == sorted(b)
+        for key in a:
+            _assertClose(a[key], b[key])
+    else:
+        np.testing.assert_allclose(a, b, rtol=1e-3)
+
+
+def test_incremental_matches_mfcc_eval(tmp_path, eval_folder):
+    full, incremental = str(tmp_path / 'full'), str(tmp_path / 'incremental')
+    _makeEval(full, eval_folder)
+    _makeEval(incremental, eval_folder)
+
+    evaluate(full, models=MODELS)
+    evaluateIncremental(incremental, models=MODELS)
+    for name in ('evaluation_scores.json', 'evaluation_stats.json'):
+        _assertClose(_load(incremental, name), _load(full, name))
+    assert 'euclidian_distance' in _load(incremental, 'evaluation_scores.json')['target_0']['source_0']
+
+
+def test_only_changed_models_are_scored(tmp_path, eval_folder, capsys):
+    folder = str(tmp_path)
+    _makeEval(folder, eval_folder)
+    evaluateIncremental(folder, models=MODELS)
+    capsys.readouterr()
+
+    path = os.path.join(folder, 'ga', 'ga_prediction_0.wav')
+    audio = spgl.AudioBuffer(path, 44100)
+    spgl.AudioBuffer(audio.get_audio() * 0.5, 44100).save(path)
+    evaluateIncremental(folder, models=MODELS)
+    out = capsys.readouterr().out
+    assert 'Scoring ga' in out and 'Scoring mlp' not in out
+
+    evaluate(folder, models=MODELS)
+    expected = _load(folder, 'evaluation_scores.json')
+    evaluateIncremental(folder, models=MODELS)
+    _assertClose(_load(folder, 'evaluation_scores.json'), expected)
+
+
+def test_model_scores_match_spiegelib_metrics(tmp_path):
+    # Two feature shapes, so the pairs are stacked in two groups
+    rng = np.random.default_rng(0)
+    shapes = [(44, 13), (22, 13), (44, 13)]
+    targets, estimates = [], []
+    for i, shape in enumerate(shapes):
+        for name, paths in (('target', targets), ('estimate', estimates)):
+            paths.append(str(tmp_path / ('%s_%d.npy' % (name, i))))
+            np.save(paths[-1], rng.normal(size=shape).astype(np.float32))
+
+    scores = _scoreModel(targets, estimates)
+    base = spgl.evaluation.EvaluationBase
+    for score, target, estimate in zip(scores, targets, estimates):
+        assert list(score) == [name for name, _ in METRICS]
+        a, b = np.load(target), np.load(estimate)
+        expected = [base.mean_abs_error(a, b), base.mean_squared_error(a, b), base.euclidian_distance(a, b),
+                    base.manhattan_distance(a, b)]
+        np.testing.assert_allclose(list(score.values()), expected, rtol=1e-5)
+
+
+def test_scoring_in_a_pool_matches_mfcc_eval(tmp_path, eval_folder):
+    folder = str(tmp_path)
+    _makeEval(folder, eval_folder)
+    evaluate(folder, models=MODELS)
+    expected = _load(folder, 'evaluation_scores.json')
+    evaluateIncremental(folder, models=MODELS, num_workers=2)
+    _assertClose(_load(folder, 'evaluation_scores.json'), expected)
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+import spiegelib as spgl
+from fm_synth import SimpleFMSynth, NUM_PARAMETERS
+from synth_config import createSynth
+from conftest import SYNTH_PATH
+
+
+@pytest.fixture
+def synth(synth_state):
+    synth = createSynth(SYNTH_PATH, note_len=0.25, render_len=0.5)
+    synth.load_state(synth_state)
+    return synth
+
+
+def test_is_synth_base(synth):
+    assert isinstance(synth, spgl.synth.SynthBase)
+    assert len(synth.get_parameters()) == NUM_PARAMETERS
+    assert len(synth.get_patch(skip_overridden=False)) == NUM_PARAMETERS
+    assert len(synth.get_patch()) == NUM_PARAMETERS - len(synth.overridden_params)
+
+
+def test_set_patch_follows_synth_base(synth):
+    overridden = dict(synth.overridden_params)
+    free = [i for i, _ in synth.get_patch()]
+
+    synth.set_patch([2.0] * len(free))
+    assert all(value == 1.0 for _, value in synth.get_patch())
+    synth.set_patch([0.5] * NUM_PARAMETERS)
+    assert all(value == 0.5 for _, value in synth.get_patch())
+    synth.set_patch([(i, 0.25) for i in range(NUM_PARAMETERS)])
+    assert all(value == 0.25 for _, value in synth.get_patch())
+    assert dict(synth.overridden_params) == overridden
+
+    with pytest.raises(Exception):
+        synth.get_audio()
+    with pytest.raises(Exception):
+        synth.set_patch([0.5] * (len(free) - 1))
+
+
+def test_state_round_trip(synth, tmp_path):
+    synth.randomize_patch()
+    path = str(tmp_path / 'state.json')
+    synth.save_state(path)
+
+    loaded = SimpleFMSynth()
+    loaded.load_state(path)
+    assert loaded.get_patch(skip_overridden=False) == synth.get_patch(skip_overridden=False)
+    assert loaded.overridden_params == synth.overridden_params
+
+
+def test_render_batch_matches_render_patch(synth):
+    patches = np.random.default_rng(0).uniform(0.0, 1.0, (3, len(synth.get_patch())))
+    audio = synth.render_batch(patches)
+    for patch, expected in zip(patches, audio):
+        synth.set_patch(list(patch))
+        synth.render_patch()
+        np.testing.assert_array_equal(synth.get_audio().get_audio(), expected)
+
+
+def test_works_with_spiegelib(synth, tmp_path):
+    features = spgl.features.MFCC(num_mfccs=13, hop_size=1024, time_major=True)
+    generator = spgl.DatasetGenerator(synth, features, output_folder=str(tmp_path))
+    generator.generate(4, file_prefix='train_')
+    assert np.load(str(tmp_path / 'train_patches.npy')).shape == (4, len(synth.get_patch()))
+
+    target = synth.get_random_example()
+    ga = spgl.estimator.BasicGA(synth, features, pop_size=4, ngen=1)
+    matcher = spgl.SoundMatch(synth, ga)
+    assert len(matcher.match(target).get_audio()) == len(target.get_audio())
@@ -0,0 +1,87 @@
+import os
+import numpy as np
+import pytest
+import spiegelib as spgl
+import instrumentation
+from instrumentation import (enableInstrumentation, instrumentationReport, instrumentationTarget,
+                             instrumentedFeatures, instrumentedEstimator)
+from audio_output import EstimateWriter
+from batch_features import batchFeaturesFor, extractBatch
+from dataset_generation import generateDatasetParallel, initMFCCFeatures
+from parallel_genetic import ParallelBasicGA, scorePatches
+from synth_config import loadSynth, renderPatches
+from conftest import SYNTH_PATH, EVAL_LENGTHS
+
+
+@pytest.fixture
+def instrument(tmp_path, monkeypatch):
+    # Recording is switched off again when the test ends
+    monkeypatch.setattr(instrumentation, '_state', None)
+    enableInstrumentation(str(tmp_path))
+
+
+def test_instrumented_objects_keep_their_type(instrument, synth_state, eval_folder):
+    synth = loadSynth(SYNTH_PATH, synth_state, **EVAL_LENGTHS)
+    features = spgl.features.MFCC(num_mfccs=13, hop_size=1024)
+    timed_features = instrumentedFeatures(features)
+    assert isinstance(synth, spgl.synth.SynthBase)
+    assert isinstance(timed_features, spgl.features.MFCC)
+    assert type(batchFeaturesFor(timed_features)).__name__ == 'BatchMFCC'
+
+    # Attributes are shared with the original object
+    timed_features.frame_size = 1024
+    assert features.frame_size == 1024
+
+    ga = instrumentedEstimator(spgl.estimator.BasicGA(synth, timed_features, pop_size=4, ngen=1), 'ga')
+    assert isinstance(ga, spgl.estimator.EstimatorBase)
+    target = spgl.AudioBuffer.load_folder(os.path.join(eval_folder, 'audio'))[0]
+    spgl.SoundMatch(synth, ga).match(target)
+
+    timers = instrumentationReport()[instrumentation.NO_STAGE]['timers']
+    assert timers['ga.predict']['count'] == 1
+    assert timers['synth.render_patch']['count'] > 4
+    assert timers['features.MFCC.get_features']['count'] > 4
+
+
+def test_background_writes_count_for_their_target(instrument, tmp_path):
+    writer = EstimateWriter(str(tmp_path), 'mlp', concat=False)
+    for i in range(3):
+        with instrumentationTarget(i):
+            audio = spgl.AudioBuffer(np.zeros(1000, dtype=np.float32), 44100)
+            writer.write(i, audio, audio)
+    writer.close()
+
+    targets = instrumentationReport()[instrumentation.NO_STAGE]['targets']
+    assert sorted(targets) == ['0', '1', '2']
+    for target in targets.values():
+        assert target['timers']['file_io.write_wav']['count'] == 1
+
+
+def test_pool_workers_report_render_and_features(instrument, synth_state, eval_folder, tmp_path):
+    generateDatasetParallel(SYNTH_PATH, str(tmp_path / 'dataset'), synth_state, initMFCCFeatures(), train_size=20,
+                            test_size=10, shard_size=10, num_workers=2, **EVAL_LENGTHS)
+    workers = instrumentationReport()['generateDatasetParallel']['worker_timers']
+    assert workers['synth.render_batch']['items'] == 30
+    assert workers['features.MFCC']['items'] == 30
+
+    ga = ParallelBasicGA(SYNTH_PATH, synth_state, pop_size=8, ngen=1, num_workers=2, seed=0, **EVAL_LENGTHS)
+    try:
+        with instrumentationTarget('ga'):
+            ga.predict(spgl.AudioBuffer.load_folder(os.path.join(eval_folder, 'audio'))[0])
+    finally:
+        ga.close()
+    target = instrumentationReport()[instrumentation.NO_STAGE]['targets']['ga']
+    assert target['worker_timers']['synth.render_batch']['items'] == ga.renders
+    assert target['worker_timers']['features.MFCC']['items'] == ga.renders
+
+
+def test_instrumented_extractors_are_timed_under_their_own_name(instrument, synth_state):
+    synth = loadSynth(SYNTH_PATH, synth_state, note_len=0.25, render_len=0.5)
+    extractor = spgl.features.MFCC(num_mfccs=13, hop_size=1024)
+    patches = np.random.default_rng(0).uniform(0.0, 1.0, (2, synth.param_space.num_free))
+    target = extractBatch(extractor, np.concatenate(list(renderPatches(synth, patches[:1]))), synth.sample_rate)[0]
+    scorePatches(synth, [instrumentedFeatures(extractor)], patches, [target])
+
+    timers = instrumentationReport()[instrumentation.NO_STAGE]['timers']
+    assert timers['features.MFCC']['items'] == 2
+    assert not any(name.startswith('features.Instrumented') for name in timers)
@@ -0,0 +1,69 @@
+import os
+import subprocess
+import sys
+import numpy as np
+import pytest
+import spiegelib as spgl
+from batch_matching import loadModel
+from chunked_dataset import ChunkedDataset
+from lite_inference import liteModelPath, measureLoad
+from sound_match_dl import runMLP
+from train_dl_models import exportLiteModel, compareLiteModels
+from conftest import SYNTH_PATH, EVAL_LENGTHS
+
+
+@pytest.fixture(scope='module')
+def lite_model(model_folder):
+    return exportLiteModel(os.path.join(model_folder, 'simple_fm_mlp.h5'), precision='float16')
+
+
+@pytest.fixture(scope='module')
+def inputs(model_folder):
+    test = ChunkedDataset(model_folder, 'test_')
+    features, _ = next(test.batches(len(test), shuffle=False))
+    return features.reshape(len(features), -1).astype(np.float32)
+
+
+def test_export_matches_keras(model_folder, lite_model, inputs):
+    assert lite_model == liteModelPath(os.path.join(model_folder, 'simple_fm_mlp.h5'), 'float16')
+    lite = loadModel(model_folder, 'mlp', 'float16')
+    assert isinstance(lite, spgl.estimator.EstimatorBase)
+
+    reference = loadModel(model_folder, 'mlp').model.predict(inputs, verbose=0)
+    np.testing.assert_allclose(lite.predict(inputs), reference, atol=0.01)
+    np.testing.assert_allclose(lite.predict(inputs[0]), reference[0], atol=0.01)
+
+
+def test_runner_matches_with_lite_model(synth_state, model_folder, eval_folder, lite_model):
+    runMLP(SYNTH_PATH, model_folder, eval_folder, synth_state, precision='float16', save_concat=False,
+           **EVAL_LENGTHS)
+    num_targets = len(os.listdir(os.path.join(eval_folder, 'audio')))
+    assert len(os.listdir(os.path.join(eval_folder, 'mlp'))) == num_targets
+
+
+def test_loader_imports_neither_tensorflow_nor_spiegelib(lite_model, inputs):
+    code = ("import sys, numpy as np\n"
+            "from lite_inference import LiteModel\n"
+            "LiteModel(sys.argv[1]).predict(np.zeros(%d, np.float32))\n"
+            "assert 'tensorflow' not in sys.modules and 'spiegelib' not in sys.modules\n" % inputs.shape[1])
+    folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.run([sys.executable, '-c', code, lite_model], check=True, cwd=folder)
+
+
+def test_measure_load(model_folder, lite_model, inputs):
+    keras = measureLoad('batch_matching', 'loadModel', [model_folder, 'mlp'], inputs[0])
+    lite = measureLoad('lite_inference', 'LiteModel', [lite_model], inputs[0])
+    for result in (keras, lite):
+        assert set(result) == {'import_secs', 'load_secs', 'first_prediction_secs', 'peak_rss_mb'}
+    assert lite['peak_rss_mb'] < keras['peak_rss_mb'] / 2
+
+    with pytest.raises(RuntimeError):
+        measureLoad('lite_inference', 'LiteModel', [lite_model + '.missing'], inputs[0])
+
+
+def test_compare_lite_models(model_folder, lite_model):
+    report = compareLiteModels(model_folder, models=['mlp'], precision='float16', num_samples=10, latency_runs=2)
+    result = report['models']['mlp']
+    assert result['passed']
+    assert os.path.exists(os.path.join(model_folder, 'inference_report_float16.json'))
+    assert set(result['startup']) == {'float32', 'float16'}
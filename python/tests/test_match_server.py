@@ -0,0 +1,75 @@
+import base64
+import json
+import os
+import threading
+import urllib.request
+import numpy as np
+import pytest
+import spiegelib as spgl
+from http.server import ThreadingHTTPServer
+from match_server import MatchService, makeHandler
+from audio_output import wavBytes
+from conftest import SYNTH_PATH, EVAL_LENGTHS
+
+
+@pytest.fixture
+def service(synth_state, model_folder):
+    service = MatchService(SYNTH_PATH, synth_state, model_folder, models=['mlp', 'lstm'], max_batch_size=8,
+                           max_wait_ms=200.0, **EVAL_LENGTHS)
+    yield service
+    service.close()
+
+
+def _targets(eval_folder):
+    return [t.get_audio() for t in spgl.AudioBuffer.load_folder(os.path.join(eval_folder, 'audio'))]
+
+
+def test_micro_batches(service, eval_folder):
+    targets = _targets(eval_folder) * 3
+    results = [None] * len(targets)
+
+    def request(i):
+        results[i] = service.match(targets[i], model=['mlp', 'lstm'][i % 2])
+
+    threads = [threading.Thread(target=request, args=(i,)) for i in range(len(targets))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Requests arriving within max_wait_ms share a batch, and batching does
+    # not change what each one gets back
+    stats = service.stats()
+    assert stats['requests'] == len(targets) and stats['batches'] < len(targets)
+    assert stats['mean_batch_size'] > 1 and stats['p50_ms'] <= stats['p99_ms'] and stats['queue_depth'] == 0
+    features = service.matcher.extractor(np.stack(targets), service.synth.sample_rate)
+    for i, result in enumerate(results):
+        expected = service.matcher.predict_model(result['model'], features[i:i + 1])[0]
+        np.testing.assert_allclose(result['patch'], expected, atol=1e-5)
+        assert [p for p, _ in result['parameters']] == service.param_ids
+
+
+def test_http_and_shutdown(service, eval_folder):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), makeHandler(service))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = 'http://127.0.0.1:%d' % server.server_address[1]
+    try:
+        body = wavBytes(_targets(eval_folder)[0], service.synth.sample_rate)
+        request = urllib.request.Request(url + '/match?model=lstm&render=1', data=body,
+                                         headers={'Content-Type': 'audio/wav'})
+        with urllib.request.urlopen(request) as response:
+            result = json.loads(response.read())
+        assert result['model'] == 'lstm' and len(result['patch']) == len(service.param_ids)
+        assert base64.b64decode(result['audio'])[:4] == b'RIFF'
+
+        with urllib.request.urlopen(url + '/stats') as response:
+            assert json.loads(response.read())['requests'] == 1
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    service.close()
+    assert not service.worker.is_alive()
+    with pytest.raises(RuntimeError):
+        service.match(_targets(eval_folder)[0], model='lstm')
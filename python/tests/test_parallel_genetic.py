@@ -0,0 +1,42 @@
+import multiprocessing
+import os
+import pytest
+import sound_match_genetic
+import spiegelib as spgl
+from parallel_genetic import ParallelBasicGA, ParallelNSGA3
+from sound_match_genetic import runGeneticAlgBasicParallel, runGeneticAlgNSGAParallel
+from conftest import SYNTH_PATH, EVAL_LENGTHS
+
+SETTINGS = dict(pop_size=8, ngen=2, num_workers=2, seed=0, **EVAL_LENGTHS)
+
+
+@pytest.mark.parametrize('cls', [ParallelBasicGA, ParallelNSGA3])
+def test_sound_match(cls, synth_state, eval_folder):
+    ga = cls(SYNTH_PATH, synth_state, **SETTINGS)
+    try:
+        assert isinstance(ga, spgl.estimator.EstimatorBase)
+        target = spgl.AudioBuffer.load_folder(os.path.join(eval_folder, 'audio'))[0]
+        audio = spgl.SoundMatch(ga.synth, ga).match(target)
+        assert len(audio.get_audio()) == len(target.get_audio())
+        assert len(ga.generation_times) == SETTINGS['ngen'] + 1
+    finally:
+        ga.close()
+
+
+def test_run_parallel(synth_state, eval_folder):
+    runGeneticAlgBasicParallel(SYNTH_PATH, None, eval_folder, synth_state, pop_size=8, gen_size=1, num_workers=2,
+                               **EVAL_LENGTHS)
+    assert sorted(os.listdir(os.path.join(eval_folder, 'ga'))) == ['ga_prediction_0.wav', 'ga_prediction_1.wav']
+
+
+@pytest.mark.parametrize('run', [runGeneticAlgBasicParallel, runGeneticAlgNSGAParallel])
+def test_failed_run_closes_the_pool(run, synth_state, eval_folder, tmp_path, monkeypatch):
+    class FailingWriter(sound_match_genetic.EstimateWriter):
+        def write(self, *args):
+            raise IOError("disk full")
+
+    monkeypatch.setattr(sound_match_genetic, 'EstimateWriter', FailingWriter)
+    # The traceback keeps the run's frame, and the GA in it, alive
+    with pytest.raises(IOError) as failure:
+        run(SYNTH_PATH, None, eval_folder, synth_state, pop_size=4, gen_size=1, num_workers=2, **EVAL_LENGTHS)
+    assert failure.traceback and not multiprocessing.active_children()
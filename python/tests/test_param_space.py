@@ -0,0 +1,50 @@
+import os
+import shutil
+import numpy as np
+import param_space
+from param_space import ParamSpace, loadParamSpace
+from fm_synth import SimpleFMSynth
+from synth_config import loadSynth
+from conftest import SYNTH_PATH
+
+SYNTH_PARAMS = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                            'synth_params')
+
+
+def test_compiles_into_the_cache_folder(tmp_path, monkeypatch):
+    state = str(tmp_path / 'state' / 'dexed_simple_fm.json')
+    os.makedirs(os.path.dirname(state))
+    shutil.copy(os.path.join(SYNTH_PARAMS, 'dexed_simple_fm.json'), state)
+
+    space = loadParamSpace(state, cache_folder=str(tmp_path / 'cache'))
+    assert os.listdir(os.path.dirname(state)) == ['dexed_simple_fm.json']
+    assert len(os.listdir(str(tmp_path / 'cache'))) == 1
+
+    # A new process loads the compiled file, which holds the same space
+    monkeypatch.setattr(param_space, '_loaded', {})
+    loaded = loadParamSpace(state, cache_folder=str(tmp_path / 'cache'))
+    np.testing.assert_array_equal(loaded.values, space.values)
+    np.testing.assert_array_equal(loaded.overridden, space.overridden)
+    assert loaded.descriptions == space.descriptions == ParamSpace.from_state(state).descriptions
+
+
+def test_full_and_reduced_patches(synth_state):
+    space = loadParamSpace(synth_state)
+    reduced = np.random.default_rng(0).uniform(0.0, 1.0, (3, space.num_free))
+    full = space.to_full(reduced)
+    assert full.shape == (3, space.num_params)
+    np.testing.assert_array_equal(full[:, space.fixed], np.tile(space.values[space.fixed], (3, 1)))
+    np.testing.assert_array_equal(space.to_reduced(full), reduced)
+
+
+def test_loaded_synth_saves_its_state(synth_state, tmp_path):
+    synth = loadSynth(SYNTH_PATH, synth_state)
+    patch = np.random.default_rng(0).uniform(0.0, 1.0, synth.param_space.num_free)
+    synth.param_space.apply(synth, patch)
+    path = str(tmp_path / 'saved.json')
+    synth.save_state(path)
+
+    loaded = SimpleFMSynth()
+    loaded.load_state(path)
+    assert loaded.get_patch(skip_overridden=False) == synth.get_patch(skip_overridden=False)
+    np.testing.assert_allclose([v for _, v in loaded.get_patch()], patch)
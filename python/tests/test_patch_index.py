@@ -0,0 +1,103 @@
+import json
+import os
+import numpy as np
+import pytest
+import spiegelib as spgl
+from chunked_dataset import ChunkedDataset
+from patch_index import PatchIndex, KNNEstimator, buildPatchIndex
+from synth_config import loadSynth
+from sound_match_knn import runKNN
+from conftest import SYNTH_PATH, EVAL_LENGTHS
+
+
+def _bruteForce(vectors, queries, k):
+    distances = np.sqrt(((queries[:, np.newaxis, :] - vectors[np.newaxis, :, :]) ** 2).sum(axis=-1))
+    indices = np.argsort(distances, axis=1, kind='stable')[:, :k]
+    return np.take_along_axis(distances, indices, axis=1), indices
+
+
+@pytest.fixture(scope='module')
+def dataset(model_folder):
+    train = ChunkedDataset(model_folder, 'train_')
+    features, patches = next(train.batches(len(train), shuffle=False))
+    test = ChunkedDataset(model_folder, 'test_')
+    return features, patches, next(test.batches(len(test), shuffle=False))[0]
+
+
+@pytest.mark.parametrize('num_components', [None, 8])
+def test_search_probing_every_cell_is_exact(num_components, model_folder, dataset, tmp_path):
+    features, patches, queries = dataset
+    index = buildPatchIndex(str(tmp_path / 'index'), model_folder, num_components=num_components, num_cells=4)
+    assert len(index) == len(features)
+
+    distances, indices = index.search(queries, k=5, n_probe=4)
+    expected_distances, expected = _bruteForce(index.project(features), index.project(queries), 5)
+    np.testing.assert_allclose(distances, expected_distances, rtol=1e-4, atol=1e-4)
+    # Indices refer to the index's own order, compare the patches they hold
+    np.testing.assert_allclose(index.patches[indices], patches[expected].astype(np.float32))
+
+
+def test_probing_fewer_cells_finds_most_neighbours(model_folder, dataset, tmp_path):
+    features, _, queries = dataset
+    index = buildPatchIndex(str(tmp_path / 'index'), model_folder, num_components=None, num_cells=4, n_probe=2)
+    _, indices = index.search(queries, k=5)
+    _, exact = index.search(queries, k=5, n_probe=4)
+    recall = np.mean([len(set(a) & set(b)) / 5.0 for a, b in zip(indices, exact)])
+    assert recall >= 0.5
+
+
+def test_add_grows_the_saved_index(model_folder, dataset, tmp_path):
+    features, patches, queries = dataset
+    index = buildPatchIndex(str(tmp_path / 'index'), model_folder, num_components=8, num_cells=4)
+    index.add(queries, np.zeros((len(queries), patches.shape[1])))
+
+    loaded = PatchIndex(str(tmp_path / 'index'))
+    assert len(loaded) == len(features) + len(queries)
+    distances, indices = loaded.search(queries, k=1, n_probe=4)
+    np.testing.assert_allclose(distances[:, 0], 0.0, atol=1e-3)
+    assert not loaded.patches[indices[:, 0]].any()
+
+
+def test_run_knn(synth_state, model_folder, eval_folder, dataset, tmp_path):
+    buildPatchIndex(str(tmp_path / 'index'), model_folder, num_cells=4)
+    runKNN(SYNTH_PATH, str(tmp_path / 'index'), eval_folder, synth_state, refine_steps=1, refine_batch=4,
+           save_concat=False, **EVAL_LENGTHS)
+    num_targets = len(os.listdir(os.path.join(eval_folder, 'audio')))
+    assert len(os.listdir(os.path.join(eval_folder, 'knn'))) == num_targets
+    with open(os.path.join(eval_folder, 'knn_patches.json'), 'r') as f:
+        assert np.array(json.load(f)).shape == (num_targets, dataset[1].shape[1])
+
+
+def test_knn_estimator_in_sound_match(synth_state, model_folder, eval_folder, dataset, tmp_path):
+    features, _, queries = dataset
+    index = buildPatchIndex(str(tmp_path / 'index'), model_folder, num_cells=4)
+    knn = KNNEstimator(index)
+    assert isinstance(knn, spgl.estimator.EstimatorBase)
+    np.testing.assert_array_equal(knn.predict(queries[0]), knn.predict(queries)[0])
+
+    # SoundMatch extracts the target's scaled MFCCs and predicts one target at a time
+    mfcc = spgl.features.MFCC(num_mfccs=13, frame_size=2048, hop_size=1024, time_major=True, scale=True)
+    mfcc.load_scaler(str(tmp_path / 'index' / 'data_scaler.pkl'))
+    synth = loadSynth(SYNTH_PATH, synth_state, **EVAL_LENGTHS)
+    target = spgl.AudioBuffer.load_folder(os.path.join(eval_folder, 'audio'))[0]
+    matcher = spgl.SoundMatch(synth, knn, mfcc)
+    np.testing.assert_array_equal(matcher.match_parameters(target), knn.predict(knn.extract([target]))[0])
+
+
+def test_knn_estimator_searches_every_cell_when_probed_ones_are_empty(model_folder, dataset, tmp_path):
+    _, _, queries = dataset
+    index = buildPatchIndex(str(tmp_path / 'index'), model_folder, num_components=8, num_cells=4, n_probe=1)
+    _, exact = index.search(queries, k=1, n_probe=4)
+
+    # Empty the cell the first query probes
+    cell = np.argmin(((index.project(queries[:1]) - index.centroids) ** 2).sum(axis=1))
+    keep = index.cells != cell
+    index._setData(index.vectors[keep], index.patches[keep], index.cells[keep])
+    assert index.search(queries[:1], k=1)[1][0, 0] == -1
+
+    _, widened = index.search(queries[:1], k=1, n_probe=4)
+    np.testing.assert_array_equal(KNNEstimator(index).predict(queries[0]), index.patches[widened[0, 0]])
+
+    index._setData(index.vectors[:0], index.patches[:0], index.cells[:0])
+    with pytest.raises(ValueError):
+        KNNEstimator(index).predict(queries)
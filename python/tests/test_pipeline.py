@@ -0,0 +1,97 @@
+import os
+import shutil
+import pipeline
+import pytest
+from pipeline import DEFAULT_CONFIG, buildPipeline, runPipeline, _fingerprint, _sourceDigest
+
+CONFIG = dict(synth_path='simple_fm', synth_config='dexed', note_len=0.25, render_len=0.5, eval_samples=2,
+              dl_models=[], ga_models=[])
+
+
+def _write(folder, name, source):
+    with open(str(folder / name), 'w') as f:
+        f.write(source)
+
+
+def test_source_digest_follows_local_sources(tmp_path):
+    _write(tmp_path, 'node.py', "import json\nfrom helper import scale\n\n"
+                                "def run(x):\n    return scale(_offset(x))\n\n"
+                                "def _offset(x):\n    return x + 1\n\n"
+                                "def unrelated():\n    return 0\n")
+    _write(tmp_path, 'helper.py', "import other\n\ndef scale(x):\n    return x * other.FACTOR\n")
+    _write(tmp_path, 'other.py', "FACTOR = 2\n")
+    digest = lambda: _sourceDigest('node', 'run', source_folder=str(tmp_path))
+    first = digest()
+
+    # Other functions of the node's module don't count
+    _write(tmp_path, 'node.py', open(str(tmp_path / 'node.py')).read().replace('return 0', 'return 1'))
+    assert digest() == first
+
+    # Helpers in the same module and modules imported transitively do
+    _write(tmp_path, 'node.py', open(str(tmp_path / 'node.py')).read().replace('x + 1', 'x + 2'))
+    second = digest()
+    assert second != first
+    _write(tmp_path, 'other.py', "FACTOR = 3\n")
+    assert digest() != second
+
+
+def test_pipeline_nodes_cover_what_they_import(tmp_path):
+    # The pipeline module's node functions import their work inside the function
+    for name in os.listdir(pipeline.SOURCE_FOLDER):
+        if name.endswith('.py'):
+            shutil.copy(os.path.join(pipeline.SOURCE_FOLDER, name), str(tmp_path / name))
+    digests = lambda: {function: _sourceDigest('pipeline', function, source_folder=str(tmp_path))
+                       for function in ('configureSynth', 'generateDatasetNode', 'generateEvalNode')}
+    first = digests()
+
+    # Editing the scheduler itself leaves the node functions alone
+    _write(tmp_path, 'pipeline.py', open(str(tmp_path / 'pipeline.py')).read() + "\n# edited\n")
+    assert digests() == first
+
+    # fm_synth is reached through dataset_generation and synth_config
+    _write(tmp_path, 'fm_synth.py', open(str(tmp_path / 'fm_synth.py')).read() + "\n# edited\n")
+    second = digests()
+    assert all(second[function] != first[function] for function in first)
+
+
+def test_rerun_with_same_output_keeps_dependents(tmp_path, capsys):
+    targets = ['config_synth', 'eval_targets']
+    runPipeline('run', CONFIG, targets=targets, runs_folder=str(tmp_path))
+    assert 'eval_targets: running' in capsys.readouterr().out
+
+    runPipeline('run', CONFIG, targets=targets, runs_folder=str(tmp_path))
+    out = capsys.readouterr().out
+    assert 'config_synth: up to date' in out and 'eval_targets: up to date' in out
+
+    # A new mtime re-runs config_synth, which writes the same state again
+    state = str(tmp_path / 'run' / 'modified_param_space.json')
+    os.utime(state, ns=(0, 0))
+    runPipeline('run', CONFIG, targets=targets, runs_folder=str(tmp_path))
+    out = capsys.readouterr().out
+    assert 'config_synth: running' in out and 'eval_targets: up to date' in out
+
+
+def test_batched_matching_and_incremental_evaluation(tmp_path):
+    config = dict(DEFAULT_CONFIG, dl_models=['mlp', 'bi_lstm'], ga_models=['ga'], batch_dl=True,
+                  incremental_eval=True, inference_precision='float16')
+    nodes = {node.name: node for node in buildPipeline(str(tmp_path), config)}
+    assert not any(name in nodes for name in ('match_mlp', 'match_bi_lstm'))
+    assert nodes['match_dl'].function == 'runBatchDL'
+    assert nodes['match_dl'].kwargs['models'] == ['mlp', 'bi_lstm']
+    assert nodes['match_dl'].deps == ['export_bi_lstm', 'export_mlp', 'eval_targets']
+    assert nodes['evaluate'].function == 'evaluateIncremental'
+    assert nodes['evaluate'].deps == ['match_dl', 'match_ga']
+
+
+def test_fingerprints_do_not_depend_on_the_core_count(tmp_path, monkeypatch):
+    config = dict(DEFAULT_CONFIG, **CONFIG)
+    done = {'config_synth': {'digest': '0'}}
+
+    def fingerprint(cores):
+        monkeypatch.setattr(pipeline.os, 'cpu_count', lambda: cores)
+        nodes = {node.name: node for node in buildPipeline(str(tmp_path), config)}
+        return _fingerprint(nodes['dataset'], config, done)
+    assert fingerprint(2) == fingerprint(64)
+
+    with pytest.raises(ValueError):
+        runPipeline('run', dict(CONFIG, num_wokers=2), runs_folder=str(tmp_path))
@@ -0,0 +1,60 @@
+import multiprocessing
+import os
+import numpy as np
+import pytest
+import spiegelib as spgl
+import batch_matching
+from render_cache import CachedSynth, configureRenderCache, renderCacheConfig
+from synth_config import loadSynth
+from conftest import SYNTH_PATH
+
+
+@pytest.fixture
+def cache_folder(tmp_path):
+    configureRenderCache(cache_folder=str(tmp_path / 'cache'))
+    yield str(tmp_path / 'cache')
+    configureRenderCache(max_bytes=None)
+
+
+def _cachedFiles(folder):
+    return sorted(name for _, _, names in os.walk(folder) for name in names)
+
+
+def test_cached_synth_is_the_synth(synth_state, cache_folder):
+    synth = loadSynth(SYNTH_PATH, synth_state, note_len=0.25, render_len=0.5)
+    assert isinstance(synth, CachedSynth) and isinstance(synth, spgl.synth.SynthBase)
+    spgl.SoundMatch(synth, spgl.estimator.BasicGA(synth, spgl.features.MFCC()))
+
+    synth.randomize_patch()
+    synth.render_patch()
+    first = synth.get_audio().get_audio()
+    synth.render_patch()
+    np.testing.assert_array_equal(synth.get_audio().get_audio(), first)
+    assert synth.cache.stats()['hits'] == 1 and synth.cache.stats()['misses'] == 1
+    np.testing.assert_array_equal(first, synth.render_batch(np.array([p[1] for p in synth.get_patch()]))[0])
+
+
+def test_spawned_workers_use_the_cache(synth_state, cache_folder):
+    patches = np.random.default_rng(0).uniform(0.0, 1.0, (4, loadSynth(SYNTH_PATH, synth_state).param_space.num_free))
+    with multiprocessing.get_context('spawn').Pool(1, initializer=batch_matching._initRenderWorker,
+                                                   initargs=(SYNTH_PATH, synth_state, 0.25, 0.5,
+                                                             renderCacheConfig(), False)) as pool:
+        audio, _ = pool.map(batch_matching._renderChunk, [patches])[0]
+    assert len(_cachedFiles(cache_folder)) == len(patches)
+
+    synth = loadSynth(SYNTH_PATH, synth_state, note_len=0.25, render_len=0.5)
+    np.testing.assert_array_equal(synth.render_batch(patches), audio)
+    assert synth.cache.stats()['disk_hits'] == len(patches)
+
+
+def test_full_and_free_patches_share_a_key(synth_state, cache_folder):
+    synth = loadSynth(SYNTH_PATH, synth_state, note_len=0.25, render_len=0.5)
+    space = synth.param_space
+    patches = np.random.default_rng(0).uniform(0.0, 1.0, (2, space.num_free))
+    audio = synth.render_batch(patches)
+
+    # Full patches with different overridden values are the same sounds
+    full = space.to_full(patches)
+    full[:, ~np.isin(np.arange(space.num_params), space.free)] = 0.123
+    np.testing.assert_array_equal(synth.render_batch(full), audio)
+    assert synth.cache.stats()['hits'] == 2 and synth.cache.stats()['misses'] == 2
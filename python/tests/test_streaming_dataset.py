@@ -0,0 +1,46 @@
+import multiprocessing
+import numpy as np
+import pytest
+import train_dl_models
+from chunked_dataset import ChunkedDataset
+from dataset_generation import initMFCCFeatures
+from streaming_dataset import generateDatasetStreaming
+from train_dl_models import trainWhileGenerating
+from conftest import SYNTH_PATH
+
+SETTINGS = dict(train_size=60, test_size=20, shard_size=20, warmup_size=20, num_workers=2, note_len=0.25,
+                render_len=0.5)
+
+
+def test_streamed_pass_matches_stored_dataset(synth_state, tmp_path):
+    train, test = generateDatasetStreaming(SYNTH_PATH, str(tmp_path), synth_state, initMFCCFeatures(),
+                                           batch_size=16, **SETTINGS)
+    streamed = list(train.batches(16))
+    assert [len(b[0]) for b in streamed] == [16, 16, 16, 12]
+
+    # Later passes read the chunked dataset, which holds the same samples
+    stored = ChunkedDataset(str(tmp_path), 'train_')
+    features, patches = next(stored.batches(len(stored), shuffle=False))
+    np.testing.assert_array_equal(np.concatenate([b[0] for b in streamed]), features)
+    np.testing.assert_array_equal(np.concatenate([b[1] for b in streamed]), patches)
+    assert len(list(test.batches(16, shuffle=False))) == 2
+
+
+def test_failed_training_stops_the_producer(synth_state, tmp_path, monkeypatch):
+    producers = []
+
+    def failingTrainer(output_folder, train_data, **kwargs):
+        producers.append(train_data.producer)
+        next(train_data.batches(8))
+        raise ValueError("training failed")
+
+    monkeypatch.setitem(train_dl_models.TRAINERS, 'mlp', failingTrainer)
+    with pytest.raises(ValueError):
+        trainWhileGenerating(SYNTH_PATH, str(tmp_path), synth_state, initMFCCFeatures(), models=['mlp'],
+                             batch_size=8, max_queued_batches=1, **SETTINGS)
+
+    # The producer was blocked on the full queue, close() lets it and the pool exit
+    assert not producers[0].thread.is_alive()
+    assert not multiprocessing.active_children()
+    with pytest.raises(RuntimeError):
+        producers[0].check()
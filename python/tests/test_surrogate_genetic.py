@@ -0,0 +1,65 @@
+import json
+import multiprocessing
+import os
+import numpy as np
+import pytest
+import sound_match_genetic
+import spiegelib as spgl
+from parallel_genetic import ParallelBasicGA
+from surrogate_genetic import SurrogateGA
+from sound_match_genetic import runSurrogateGA
+from conftest import SYNTH_PATH, EVAL_LENGTHS
+
+SETTINGS = dict(pop_size=8, ngen=3, num_workers=2, seed=0, **EVAL_LENGTHS)
+
+
+def _target(eval_folder):
+    return spgl.AudioBuffer.load_folder(os.path.join(eval_folder, 'audio'))[0]
+
+
+def test_renders_fewer_than_unseeded_ga(synth_state, model_folder, eval_folder):
+    target = _target(eval_folder)
+    surrogate = SurrogateGA(SYNTH_PATH, synth_state, model_folder, models=['mlp'], **SETTINGS)
+    try:
+        # The network's prediction and mutations around it seed the population
+        prediction = surrogate.matcher.predict(surrogate.matcher.extract([target]))['mlp'][0]
+        population = surrogate.initial_population(target)
+        num_seeded = int(SETTINGS['pop_size'] * surrogate.seed_fraction)
+        np.testing.assert_allclose(population[-num_seeded], prediction)
+        assert np.abs(np.array(population[-1]) - prediction).max() < 0.5
+
+        spgl.SoundMatch(surrogate.synth, surrogate).match(target)
+        renders_per_gen = int(SETTINGS['pop_size'] * surrogate.render_fraction)
+        assert surrogate.renders == SETTINGS['pop_size'] + SETTINGS['ngen'] * renders_per_gen
+    finally:
+        surrogate.close()
+
+    unseeded = ParallelBasicGA(SYNTH_PATH, synth_state, **SETTINGS)
+    try:
+        spgl.SoundMatch(unseeded.synth, unseeded).match(target)
+    finally:
+        unseeded.close()
+    assert surrogate.renders < unseeded.renders
+
+
+def test_run_surrogate_ga(synth_state, model_folder, eval_folder):
+    runSurrogateGA(SYNTH_PATH, model_folder, eval_folder, synth_state, models=['mlp', 'bi_lstm'], pop_size=8,
+                   gen_size=1, num_workers=2, save_concat=False, **EVAL_LENGTHS)
+    num_targets = len(os.listdir(os.path.join(eval_folder, 'audio')))
+    assert len(os.listdir(os.path.join(eval_folder, 'surrogate_ga'))) == num_targets
+    with open(os.path.join(eval_folder, 'surrogate_ga_renders.json'), 'r') as f:
+        renders = json.load(f)
+    assert renders['renders'] == [8 + 4] * num_targets
+
+
+def test_failed_run_closes_the_pool(synth_state, model_folder, eval_folder, monkeypatch):
+    class FailingWriter(sound_match_genetic.EstimateWriter):
+        def write(self, *args):
+            raise IOError("disk full")
+
+    monkeypatch.setattr(sound_match_genetic, 'EstimateWriter', FailingWriter)
+    # The traceback keeps the run's frame, and the GA in it, alive
+    with pytest.raises(IOError) as failure:
+        runSurrogateGA(SYNTH_PATH, model_folder, eval_folder, synth_state, models=['mlp'], pop_size=4, gen_size=1,
+                       num_workers=2, **EVAL_LENGTHS)
+    assert failure.traceback and not multiprocessing.active_children()
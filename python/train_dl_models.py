@@ -3,88 +3,230 @@ import numpy as np
 import tensorflow as tf
 import os
 import json
-
-def trainMLP(output_folder, epochs=100):
-    trainFeatures = np.load(os.path.join(output_folder, 'train_features.npy'))
-    trainParams = np.load(os.path.join(output_folder, 'train_patches.npy'))
-    testFeatures = np.load(os.path.join(output_folder, 'test_features.npy'))
-    testParams = np.load(os.path.join(output_folder, 'test_patches.npy'))
-
-    # Flatten feature time slices
-    trainFeatures = trainFeatures.reshape(trainFeatures.shape[0], -1)
-    testFeatures = testFeatures.reshape(testFeatures.shape[0], -1)
+import time
+from chunked_dataset import ChunkedDataset
+from streaming_dataset import generateDatasetStreaming
+from batch_matching import MODEL_FILES, FLATTENED_INPUT
+from lite_inference import LiteModel, liteModelPath, measureLoad
+from instrumentation import instrumentedStage, timed
+
+def openDatasets(output_folder):
+    # Memory-mapped train/test sets, open once and pass to each trainer to train
+    # every model from the same mapped copy
+    return ChunkedDataset(output_folder, 'train_'), ChunkedDataset(output_folder, 'test_')
+
+def toTFDataset(dataset, batch_size=64, shuffle=True, flatten=False):
+    # Streams batches from the memory-mapped chunks with prefetching, a fresh
+    # shuffle is drawn every epoch
+    features_shape = (int(np.prod(dataset.features_shape)),) if flatten else tuple(dataset.features_shape)
+
+    def generator():
+        for features, patches in dataset.batches(batch_size, shuffle=shuffle):
+            yield features.reshape((len(features),) + features_shape), patches
+
+    tf_dataset = tf.data.Dataset.from_generator(generator, output_signature=(
+        tf.TensorSpec(shape=(None,) + features_shape, dtype=dataset.features_dtype),
+        tf.TensorSpec(shape=(None, dataset.num_params), dtype=dataset.patches_dtype)
+    ))
+    return tf_dataset.prefetch(tf.data.AUTOTUNE)
+
+@instrumentedStage
+def trainMLP(output_folder, epochs=100, batch_size=64, train_data=None, test_data=None):
+    if train_data is None or test_data is None:
+        train_data, test_data = openDatasets(output_folder)
 
     # Setup callbacks for trainings
     logger = spgl.estimator.TFEpochLogger()
     earlyStopping = tf.keras.callbacks.EarlyStopping(monitor='val_loss', patience=10)
 
-    # Instantiate MLP Model
-    mlp = spgl.estimator.MLP((trainFeatures.shape[-1],),
-                                trainParams.shape[-1],
+    # Instantiate MLP Model, features time slices are flattened
+    mlp = spgl.estimator.MLP((int(np.prod(train_data.features_shape)),),
+                                train_data.num_params,
                                 callbacks=[logger, earlyStopping])
-
-    # Add training and validation data
-    mlp.add_training_data(trainFeatures, trainParams)
-    mlp.add_testing_data(testFeatures, testParams)
     mlp.model.summary()
 
-    mlp.fit(epochs=epochs)
-    mlp.save_model(os.path.join(output_folder, 'simple_fm_mlp.h5'))
+    with timed('fit'):
+        mlp.model.fit(toTFDataset(train_data, batch_size, flatten=True),
+                      validation_data=toTFDataset(test_data, batch_size, shuffle=False, flatten=True),
+                      epochs=epochs, callbacks=[logger, earlyStopping])
+    with timed('file_io.save_model'):
+        mlp.save_model(os.path.join(output_folder, 'simple_fm_mlp.h5'))
 
     _, plot_data = logger.get_plotting_data()
     with open(os.path.join(output_folder, "mlp_logger.json"), "w") as outfile:
         json.dump(plot_data, outfile, indent=4)
 
-def trainLSTM(output_folder, epochs=100):
-    trainFeatures = np.load(os.path.join(output_folder, 'train_features.npy'))
-    trainParams = np.load(os.path.join(output_folder, 'train_patches.npy'))
-    testFeatures = np.load(os.path.join(output_folder, 'test_features.npy'))
-    testParams = np.load(os.path.join(output_folder, 'test_patches.npy'))
+@instrumentedStage
+def trainLSTM(output_folder, epochs=100, batch_size=64, train_data=None, test_data=None):
+    if train_data is None or test_data is None:
+        train_data, test_data = openDatasets(output_folder)
 
     # Setup callbacks for trainings
     logger = spgl.estimator.TFEpochLogger()
     earlyStopping = tf.keras.callbacks.EarlyStopping(monitor='val_loss', patience=10)
 
-    lstm = spgl.estimator.LSTM(trainFeatures.shape[-2:],
-                                trainParams.shape[-1],
+    lstm = spgl.estimator.LSTM(train_data.features_shape[-2:],
+                                train_data.num_params,
                                 callbacks=[logger, earlyStopping])
-
-    lstm.add_training_data(trainFeatures, trainParams)
-    lstm.add_testing_data(testFeatures, testParams)
     lstm.model.summary()
 
-    lstm.fit(epochs=epochs)
+    with timed('fit'):
+        lstm.model.fit(toTFDataset(train_data, batch_size),
+                       validation_data=toTFDataset(test_data, batch_size, shuffle=False),
+                       epochs=epochs, callbacks=[logger, earlyStopping])
 
-    lstm.save_model(os.path.join(output_folder, 'simple_fm_lstm.h5'))
+    with timed('file_io.save_model'):
+        lstm.save_model(os.path.join(output_folder, 'simple_fm_lstm.h5'))
 
     _, plot_data = logger.get_plotting_data()
     with open(os.path.join(output_folder, "lstm_logger.json"), "w") as outfile:
         json.dump(plot_data, outfile, indent=4)
 
-def trainBiLSTM(output_folder, epochs=100, highway_layers=6):
-    trainFeatures = np.load(os.path.join(output_folder, 'train_features.npy'))
-    trainParams = np.load(os.path.join(output_folder, 'train_patches.npy'))
-    testFeatures = np.load(os.path.join(output_folder, 'test_features.npy'))
-    testParams = np.load(os.path.join(output_folder, 'test_patches.npy'))
+@instrumentedStage
+def trainBiLSTM(output_folder, epochs=100, highway_layers=6, batch_size=64, train_data=None, test_data=None):
+    if train_data is None or test_data is None:
+        train_data, test_data = openDatasets(output_folder)
 
     # Setup callbacks for trainings
     logger = spgl.estimator.TFEpochLogger()
     earlyStopping = tf.keras.callbacks.EarlyStopping(monitor='val_loss', patience=10)
 
-    bi_lstm = spgl.estimator.HwyBLSTM(trainFeatures.shape[-2:],
-                                    trainParams.shape[-1],
+    bi_lstm = spgl.estimator.HwyBLSTM(train_data.features_shape[-2:],
+                                    train_data.num_params,
                                     callbacks=[logger, earlyStopping],
                                     lstm_size=512,
                                     highway_layers=highway_layers)
-
-    bi_lstm.add_training_data(trainFeatures, trainParams)
-    bi_lstm.add_testing_data(testFeatures, testParams)
     bi_lstm.model.summary()
 
-    bi_lstm.fit(epochs=epochs)
+    with timed('fit'):
+        bi_lstm.model.fit(toTFDataset(train_data, batch_size),
+                          validation_data=toTFDataset(test_data, batch_size, shuffle=False),
+                          epochs=epochs, callbacks=[logger, earlyStopping])
+
+    with timed('file_io.save_model'):
+        bi_lstm.save_model(os.path.join(output_folder, 'simple_fm_bi_lstm.h5'))
 
-    bi_lstm.save_model(os.path.join(output_folder, 'simple_fm_bi_lstm.h5'))
-    
     _, plot_data = logger.get_plotting_data()
     with open(os.path.join(output_folder, "bi_lstm_logger.json"), "w") as outfile:
         json.dump(plot_data, outfile, indent=4)
+
+TRAINERS = {'mlp': trainMLP, 'lstm': trainLSTM, 'bi_lstm': trainBiLSTM}
+
+def trainWhileGenerating(synth_path, output_folder, synth_state, features, models=['bi_lstm'], epochs=100,
+                         batch_size=64, **stream_kwargs):
+    # Trains the first model while the dataset is still being rendered (see
+    # generateDatasetStreaming), then the others from the chunked dataset it
+    # leaves behind
+    train_data, test_data = generateDatasetStreaming(synth_path, output_folder, synth_state, features,
+                                                     batch_size=batch_size, **stream_kwargs)
+    try:
+        TRAINERS[models[0]](output_folder, epochs=epochs, batch_size=batch_size, train_data=train_data,
+                            test_data=test_data)
+    except BaseException:
+        # Nothing reads the batch queue any more, stop rendering
+        train_data.producer.close()
+        raise
+    for model in models[1:]:
+        TRAINERS[model](output_folder, epochs=epochs, batch_size=batch_size)
+
+
+def exportLiteModel(model_path, precision='float16'):
+    # Converts a saved model to a TFLite file for CPU inference next to it.
+    # 'float16' stores the weights as float16, 'int8' quantizes the weights to
+    # int8 with float activations (dynamic range quantization, which keeps the
+    # LSTM layers accurate without a calibration set), 'float32' converts as is.
+    lite_path = liteModelPath(model_path, precision)
+    model = spgl.estimator.TFEstimatorBase.load(model_path).model
+
+    if len(model.input_shape) > 2:
+        # Time series models (LSTM, Bi-LSTM) only convert to TFLite's fused LSTM
+        # kernels with static shapes, so they take one example per call
+        signature = [tf.TensorSpec((1,) + tuple(model.input_shape[1:]), tf.float32)]
+        run = tf.function(lambda x: model(x, training=False), input_signature=signature)
+        converter = tf.lite.TFLiteConverter.from_concrete_functions([run.get_concrete_function()])
+    else:
+        converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if precision != 'float32':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if precision == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    with timed('convert'):
+        lite_model = converter.convert()
+
+    with open(lite_path, 'wb') as f:
+        f.write(lite_model)
+    return lite_path
+
+def _latency(predict, inputs, runs):
+    # Median and 95th percentile milliseconds per call, after a few warm-up calls
+    for _ in range(3):
+        predict(inputs)
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        predict(inputs)
+        times.append((time.perf_counter() - start) * 1000.0)
+    return {'p50_ms': float(np.percentile(times, 50)), 'p95_ms': float(np.percentile(times, 95))}
+
+def compareLiteModels(output_folder, models=['mlp', 'lstm', 'bi_lstm'], precision='float16', num_samples=1000,
+                      latency_runs=100, tolerance=0.01):
+    # Checks the TFLite exports against the float32 models on the test split and
+    # compares latency, size and start up cost. Writes
+    # {output_folder}/inference_report_{precision}.json. A model passes when its
+    # predictions differ from float32 by at most `tolerance` on average (the
+    # parameters are in [0, 1]).
+    _, test_data = openDatasets(output_folder)
+    features, patches = next(test_data.batches(min(num_samples, len(test_data)), shuffle=False))
+    report = {'precision': precision, 'num_samples': len(features), 'tolerance': tolerance, 'models': {}}
+
+    for name in models:
+        model_path = os.path.join(output_folder, MODEL_FILES[name])
+        lite_path = liteModelPath(model_path, precision)
+        inputs = features.reshape(len(features), -1) if name in FLATTENED_INPUT else features
+        inputs = inputs.astype(np.float32)
+        keras_model = spgl.estimator.TFEstimatorBase.load(model_path).model
+        lite_model = LiteModel(lite_path)
+
+        # Single target matching is what SoundMatch does for every target
+        keras_predict = lambda x: keras_model.predict(x, verbose=0)
+        reference = keras_predict(inputs)
+        predictions = lite_model.predict(inputs)
+        deviation = np.abs(predictions - reference)
+
+        report['models'][name] = {
+            'mean_abs_deviation': float(deviation.mean()),
+            'max_abs_deviation': float(deviation.max()),
+            'passed': bool(deviation.mean() <= tolerance),
+            'patch_mae': {
+                'float32': float(np.abs(np.clip(reference, 0.0, 1.0) - patches).mean()),
+                precision: float(np.abs(np.clip(predictions, 0.0, 1.0) - patches).mean())
+            },
+            'size_mb': {
+                'float32': os.path.getsize(model_path) / 2.0 ** 20,
+                precision: os.path.getsize(lite_path) / 2.0 ** 20
+            },
+            'single_latency': {
+                'float32': _latency(keras_predict, inputs[:1], latency_runs),
+                precision: _latency(lite_model.predict, inputs[:1], latency_runs)
+            },
+            'batch_secs': {
+                'float32': _latency(keras_predict, inputs, 1)['p50_ms'] / 1000.0,
+                precision: _latency(lite_model.predict, inputs, 1)['p50_ms'] / 1000.0
+            },
+            'startup': {
+                'float32': measureLoad('batch_matching', 'loadModel', [output_folder, name], inputs[0]),
+                precision: measureLoad('lite_inference', 'LiteModel', [lite_path], inputs[0])
+            }
+        }
+
+        result = report['models'][name]
+        print("%s %s: mean deviation %.5f (%s), single match %.2fms vs %.2fms, %.1fMB vs %.1fMB, "
+              "startup peak RSS %.0fMB vs %.0fMB" % (
+                  name, precision, result['mean_abs_deviation'], 'ok' if result['passed'] else 'FAILED',
+                  result['single_latency'][precision]['p50_ms'], result['single_latency']['float32']['p50_ms'],
+                  result['size_mb'][precision], result['size_mb']['float32'],
+                  result['startup'][precision]['peak_rss_mb'], result['startup']['float32']['peak_rss_mb']))
+
+    with open(os.path.join(output_folder, 'inference_report_%s.json' % precision), 'w') as f:
+        json.dump(report, f, indent=4)
+    return report